@@ -9,8 +9,18 @@ import click
 
 from flask import Flask, current_app
 
-from .directory_monitoring import DirectoryMonitoring
-from .utils import init_db, monitor_image_dir
+from .analysis import ImageAnalyzer
+from .directory_monitoring import CatalogScanner, DirectoryMonitoring
+from .jobs import JobManager
+from .leases import LeaseExpiry
+from .liveness import MountLiveness
+from .locking import ImageLocks, InflightMounts
+from .mounter_strategy import MounterStrategies
+from .mount_state import MountRegistry
+from .reaper import MountReaper
+from .reconciliation import StartupReconciliation
+from .support import SupportMatrix
+from .utils import adopt_mounts, close_connection, close_db_connections, create_schema, init_db, monitor_image_dir, save_scan_settings
 from .views import main
 
 
@@ -20,7 +30,7 @@ except DistributionNotFound:
     __version__ = "Could not find version"
 
 
-def create_app(mount_dir=None, image_dir=None, database=None, base_url=None, path_contains=None, skip_subdirectory=None, remove_directories=None):
+def create_app(mount_dir=None, image_dir=None, database=None, base_url=None, path_contains=None, skip_subdirectory=None, remove_directories=None, monitor_mode=None, scan_workers=None, keep_database=None, adopt_mounts=None):
 
     if base_url:
         static_url_path = f"{base_url}/static"
@@ -62,7 +72,35 @@ def create_app(mount_dir=None, image_dir=None, database=None, base_url=None, pat
     if remove_directories:
         app.config.update(REMOVE_DIRECTORIES=remove_directories)
 
-    app.mnt_mutex = threading.Lock()
+    if monitor_mode:
+        app.config.update(MONITOR_MODE=monitor_mode)
+
+    if scan_workers:
+        app.config.update(SCAN_WORKERS=scan_workers)
+
+    if keep_database:
+        app.config.update(KEEP_DATABASE=keep_database)
+
+    if adopt_mounts:
+        app.config.update(ADOPT_MOUNTS=adopt_mounts)
+
+    # Mounts lock their image; only mounts that may claim a shared NBD/loop device take the global lock
+    app.mount_locks = ImageLocks()
+    app.nbd_mutex = threading.Lock()
+    app.inflight_mounts = InflightMounts()
+    app.mounter_strategies = MounterStrategies(app.config["MOUNTER_OVERRIDES"])
+    app.analyzer = ImageAnalyzer(app, app.config["ANALYSIS_WORKERS"])
+    app.jobs = JobManager(app, app.config["MOUNT_WORKERS"], app.config["JOB_HISTORY"])
+    # Shared by every /mounts/batch request, so BATCH_CONCURRENCY bounds them all together
+    app.batch_slots = threading.BoundedSemaphore(app.config["BATCH_CONCURRENCY"])
+    app.last_scan = None
+    app.catalog = CatalogScanner(app)
+    app.reconciliation = None
+    app.mount_registry = MountRegistry()
+    app.liveness = MountLiveness(app)
+    app.reaper = MountReaper(app)
+    app.leases = LeaseExpiry(app)
+    app.support_matrix = SupportMatrix(app.config["SUPPORT_CACHE_TTL"], app.config["SUPPORT_PROBE_WORKERS"])
 
     # configure the rest
     configure(app, base_url)
@@ -88,17 +126,42 @@ def configure(app, base_url=None):
     )
 
     # WARNING!
-    # At app startup, this deletes the current, local sqlite database and creates a new one.
+    # Unless KEEP_DATABASE is set, this deletes the current, local sqlite database at app startup and creates a new one.
     # this may be confusing if it didn't clean up after itself previously and images are still mounted,
     # but not tracked by a new instance of the DB.
     db_file = Path(app.config["DATABASE"])
 
+    app.teardown_appcontext(close_connection)
+
     with app.app_context():
-        if db_file.is_file():
-            db_file.unlink()
+        if app.config["KEEP_DATABASE"] and db_file.is_file():
+            # Serve from the kept database while it is checked against the system in the background
+            create_schema()
+            save_scan_settings()
+            app.reconciliation = StartupReconciliation(app)
+            app.reconciliation.start()
+        elif db_file.is_file():
+            close_db_connections()
+            # A WAL left behind by the old database would otherwise be replayed into the new one
+            for path in [db_file, Path(f"{db_file}-wal"), Path(f"{db_file}-shm")]:
+                if path.exists():
+                    path.unlink()
 
         if not db_file.is_file():
             init_db()
+            app.catalog.mark_current()
+            if app.config["ADOPT_MOUNTS"]:
+                adopt_mounts()
+
+    if app.config["ANALYZE_IMAGES"]:
+        app.analyzer.start()
+    if app.config["LIVENESS_CHECKS"]:
+        app.liveness.start()
+    if app.reaper.enabled:
+        app.reaper.start()
+    app.leases.start()
+    # Check the installed tools now so the first /supported or index page request does not have to
+    app.support_matrix.refresh_in_background()
     app.logger.info("configured")
 
 
@@ -180,9 +243,34 @@ def configure_logging(app):
     is_flag=True,
     help="Unmount all mountpoints and remove all empty directories in the thumbtack mount directory",
 )
-def start_app(debug, host, port, mount_dir, image_dir, database, base_url, path_contains, skip_subdirectory, remove_directories):
+@click.option(
+    "--monitor-mode",
+    type=click.Choice(["poll", "inotify"]),
+    default=None,
+    help="How to watch the image directory for changes. inotify falls back to polling on network filesystems  [Default: poll]",
+)
+@click.option(
+    "--scan-workers",
+    type=int,
+    default=None,
+    help="Number of directories listed in parallel when scanning the image directory  [Default: 8]",
+)
+@click.option(
+    "--keep-db",
+    "keep_database",
+    default=False,
+    is_flag=True,
+    help="Keep the database from the previous run and check it against the image and mount directories in the background",
+)
+@click.option(
+    "--adopt-mounts",
+    default=False,
+    is_flag=True,
+    help="Register the volumes still mounted in the mount directory by a previous run instead of remounting them",
+)
+def start_app(debug, host, port, mount_dir, image_dir, database, base_url, path_contains, skip_subdirectory, remove_directories, monitor_mode, scan_workers, keep_database, adopt_mounts):
     app = create_app(
-        mount_dir=mount_dir, image_dir=image_dir, database=database, base_url=base_url, path_contains=path_contains, skip_subdirectory=skip_subdirectory, remove_directories=remove_directories,
+        mount_dir=mount_dir, image_dir=image_dir, database=database, base_url=base_url, path_contains=path_contains, skip_subdirectory=skip_subdirectory, remove_directories=remove_directories, monitor_mode=monitor_mode, scan_workers=scan_workers, keep_database=keep_database, adopt_mounts=adopt_mounts,
     )
     directory_monitoring_thread = DirectoryMonitoring(app)
     directory_monitoring_thread.start()
@@ -0,0 +1,358 @@
+import os
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from imagemounter_mitre._util import expand_path
+
+from .mounter_strategy import format_signature
+from .utils import ANALYSIS_VERSION, analysis_is_current, get_images_to_analyze, save_image_analysis
+
+# pytsk3 understands more volume systems than the DOS/GPT parsing below, and pyewf lets EWF images be read
+# without mounting them. Both are optional, like in imagemounter
+try:
+    import pytsk3
+except ImportError:
+    pytsk3 = None
+try:
+    import pyewf
+except ImportError:
+    pyewf = None
+
+SECTOR_SIZE = 512
+EXTENDED_PARTITION_TYPES = (0x05, 0x0F, 0x85)
+GPT_PROTECTIVE_TYPE = 0xEE
+
+# (offset, magic, filesystem) checked against the start of a volume, in this order
+FILESYSTEM_MAGIC = [
+    (3, b"NTFS    ", "ntfs"),
+    (3, b"EXFAT   ", "exfat"),
+    (3, b"-FVE-FS-", "bitlocker"),
+    (82, b"FAT32", "fat"),
+    (54, b"FAT12", "fat"),
+    (54, b"FAT16", "fat"),
+    (0, b"LUKS\xba\xbe", "luks"),
+    (0, b"XFSB", "xfs"),
+    (32, b"NXSB", "apfs"),
+    (512, b"LABELONE", "lvm"),
+    (1024, b"H+", "hfs+"),
+    (1024, b"HX", "hfs+"),
+    (1080, b"\x53\xef", "ext"),
+    (4086, b"SWAPSPACE2", "swap"),
+]
+FILESYSTEM_HEADER_LENGTH = 4096
+
+
+class RawImage:
+    """Reads a raw image, which may be split over numbered segment files, as one stream."""
+
+    def __init__(self, segments):
+        self._segments = [(path, os.path.getsize(path)) for path in segments]
+        self.size = sum(size for _, size in self._segments)
+
+    def read(self, offset, length):
+        data = b""
+        start = 0
+        for path, size in self._segments:
+            if length and offset < start + size:
+                with open(path, "rb") as f:
+                    f.seek(offset - start)
+                    chunk = f.read(min(length, start + size - offset))
+                data += chunk
+                offset += len(chunk)
+                length -= len(chunk)
+            start += size
+        return data
+
+    def close(self):
+        pass
+
+
+class EwfImage:
+    """Reads the media in an EWF (E01) segment set through pyewf."""
+
+    def __init__(self, segments):
+        self._handle = pyewf.handle()
+        self._handle.open(segments)
+        self.size = self._handle.get_media_size()
+
+    def read(self, offset, length):
+        self._handle.seek(offset)
+        return self._handle.read(length)
+
+    def close(self):
+        self._handle.close()
+
+
+def open_image(segments, image_format):
+    """Open the media of an image for reading, or return None for formats that cannot be read without mounting."""
+    if image_format == "unknown":
+        return RawImage(segments)
+    if image_format == "ewf" and pyewf is not None:
+        return EwfImage(segments)
+    return None
+
+
+def detect_filesystem(image, offset):
+    """Name the filesystem (or container, like LVM or LUKS) starting at offset, or None."""
+    head = image.read(offset, FILESYSTEM_HEADER_LENGTH)
+    for magic_offset, magic, filesystem in FILESYSTEM_MAGIC:
+        if head[magic_offset:magic_offset + len(magic)] == magic:
+            return filesystem
+    return None
+
+
+def read_partition_table(image):
+    """Return (volume_system, [(offset, size, description)]) from a DOS or GPT partition table, or (None, [])."""
+    mbr = image.read(0, SECTOR_SIZE)
+    if len(mbr) < SECTOR_SIZE or mbr[510:512] != b"\x55\xaa":
+        return None, []
+
+    entries = _mbr_entries(mbr)
+    if any(partition_type == GPT_PROTECTIVE_TYPE for partition_type, _, _ in entries):
+        return "gpt", _gpt_partitions(image)
+
+    partitions = []
+    for partition_type, start, count in entries:
+        if partition_type in EXTENDED_PARTITION_TYPES:
+            partitions.extend(_logical_partitions(image, start))
+        else:
+            partitions.append((start * SECTOR_SIZE, count * SECTOR_SIZE, f"DOS 0x{partition_type:02x}"))
+    return "dos", partitions
+
+
+def _mbr_entries(sector):
+    entries = []
+    for i in range(4):
+        entry = sector[446 + 16 * i:462 + 16 * i]
+        partition_type = entry[4]
+        start = int.from_bytes(entry[8:12], "little")
+        count = int.from_bytes(entry[12:16], "little")
+        if partition_type and count:
+            entries.append((partition_type, start, count))
+    return entries
+
+
+def _logical_partitions(image, extended_start):
+    partitions = []
+    ebr_start = extended_start
+    # Each extended boot record holds one logical partition and a link to the next record
+    for _ in range(128):
+        ebr = image.read(ebr_start * SECTOR_SIZE, SECTOR_SIZE)
+        if len(ebr) < SECTOR_SIZE or ebr[510:512] != b"\x55\xaa":
+            break
+        entries = _mbr_entries(ebr)
+        if not entries:
+            break
+        partition_type, start, count = entries[0]
+        partitions.append(((ebr_start + start) * SECTOR_SIZE, count * SECTOR_SIZE, f"DOS 0x{partition_type:02x}"))
+        if len(entries) < 2:
+            break
+        ebr_start = extended_start + entries[1][1]
+    return partitions
+
+
+def _gpt_partitions(image):
+    header = image.read(SECTOR_SIZE, SECTOR_SIZE)
+    if header[:8] != b"EFI PART":
+        return []
+    entries_lba = int.from_bytes(header[72:80], "little")
+    num_entries = min(int.from_bytes(header[80:84], "little"), 1024)
+    entry_size = int.from_bytes(header[84:88], "little")
+    table = image.read(entries_lba * SECTOR_SIZE, num_entries * entry_size)
+
+    partitions = []
+    for i in range(num_entries):
+        entry = table[i * entry_size:(i + 1) * entry_size]
+        if len(entry) < 128 or entry[:16] == bytes(16):
+            continue
+        first = int.from_bytes(entry[32:40], "little")
+        last = int.from_bytes(entry[40:48], "little")
+        name = entry[56:128].decode("utf-16-le", errors="replace").rstrip("\x00")
+        partitions.append((first * SECTOR_SIZE, (last - first + 1) * SECTOR_SIZE, name or "GPT partition"))
+    return partitions
+
+
+def read_tsk_partition_table(image):
+    """Like read_partition_table, using pytsk3, which also reads BSD, Mac and Sun volume systems."""
+
+    class ImageInfo(pytsk3.Img_Info):
+        def __init__(self):
+            super().__init__(url="", type=pytsk3.TSK_IMG_TYPE_EXTERNAL)
+
+        def read(self, offset, length):
+            return image.read(offset, length)
+
+        def get_size(self):
+            return image.size
+
+    try:
+        volume_info = pytsk3.Volume_Info(ImageInfo())
+    except IOError:
+        return None, []
+    block_size = volume_info.info.block_size
+    volume_system = str(volume_info.info.vstype).replace("TSK_VS_TYPE_", "").lower()
+    partitions = [
+        (part.start * block_size, part.len * block_size, part.desc.decode(errors="replace"))
+        for part in volume_info
+        if part.flags == pytsk3.TSK_VS_PART_FLAG_ALLOC
+    ]
+    return volume_system, partitions
+
+
+def analyze_image(path):
+    """Describe the image at path without mounting it.
+
+    Returns a dict with the format signature, the segment files, and, for formats that can be read
+    directly, the volume system and the offset, size, description and filesystem of every volume.
+    """
+    segments = sorted(expand_path(path))
+    signature = format_signature(path)
+    analysis = {
+        "version": ANALYSIS_VERSION,
+        "signature": signature,
+        "segments": [os.path.basename(segment) for segment in segments],
+        "readable": False,
+        "volume_system": None,
+        "volumes": [],
+    }
+
+    image = open_image(segments, signature.partition(":")[0])
+    if image is None:
+        return analysis
+    try:
+        analysis["readable"] = True
+        analysis["size"] = image.size
+        if detect_filesystem(image, 0):
+            # A boot sector also ends in 55 AA, but holds no partition table
+            volume_system, partitions = None, []
+        else:
+            volume_system, partitions = (read_tsk_partition_table if pytsk3 else read_partition_table)(image)
+        if not partitions:
+            # An unpartitioned image (or one pytsk3 could not read) may hold a single filesystem
+            volume_system, partitions = None, [(0, image.size, "Single volume")]
+
+        for index, (offset, size, description) in enumerate(partitions):
+            analysis["volumes"].append(
+                {
+                    "index": index,
+                    "offset": offset,
+                    "size": size,
+                    "description": description,
+                    "fstype": detect_filesystem(image, offset),
+                }
+            )
+        analysis["volume_system"] = volume_system
+        if volume_system is None and analysis["volumes"][0]["fstype"] is None:
+            analysis["volumes"] = []
+    finally:
+        image.close()
+    return analysis
+
+
+def _lower_priority():
+    """Give the calling thread the lowest CPU priority, where the platform allows per-thread priorities."""
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+    except (AttributeError, OSError):
+        pass
+
+
+class ImageAnalyzer:
+    """Analyzes images without a current analysis, in the background on low-priority threads.
+
+    An analysis is redone when ANALYSIS_VERSION changed and, for failed analyses, once it is
+    ANALYSIS_RETRY_INTERVAL seconds old. Those are found from the database alone every ANALYSIS_INTERVAL
+    seconds. Whether an image file changed size or mtime takes a stat, so that is only checked for the images
+    passed to :meth:`notify`: those a scan added, and those whose analysis was found outdated when it was read.
+    """
+
+    def __init__(self, app, workers):
+        self.app = app
+        self.workers = workers
+        self.analyzed = 0
+        self.failed = 0
+        self.last_pass = None
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name="thumbtack-image-analyzer", daemon=True)
+        self._thread.start()
+
+    def notify(self, full_paths):
+        """Have the images at full_paths analyzed soon, unless their analysis is current."""
+        with self._lock:
+            self._pending.update(full_paths)
+        self._wake.set()
+
+    def run(self):
+        _lower_priority()
+        with self.app.app_context():
+            outdated = True
+            while True:
+                try:
+                    self.analyze_pending(outdated)
+                except Exception:
+                    self.app.logger.exception("Background image analysis failed")
+                # Woken by notify, only the images passed to it are looked at
+                outdated = not self._wake.wait(self.app.config["ANALYSIS_INTERVAL"])
+                self._wake.clear()
+
+    def analyze_pending(self, outdated=True):
+        """Analyze the images passed to notify and, if outdated, every image with an outdated analysis.
+
+        Returns the number of images analyzed.
+        """
+        with self._lock:
+            full_paths, self._pending = self._pending, set()
+        retry_before = time.time() - self.app.config["ANALYSIS_RETRY_INTERVAL"]
+        images = get_images_to_analyze(retry_before, full_paths, outdated)
+        if not images:
+            return 0
+        start = time.perf_counter()
+        analyzed = 0
+        with ThreadPoolExecutor(self.workers, thread_name_prefix="thumbtack-analysis", initializer=_lower_priority) as pool:
+            for image, (analysis, stat) in zip(images, pool.map(self._analyze, images)):
+                if analysis is None:
+                    continue
+                save_image_analysis(image["id"], stat, analysis)
+                analyzed += 1
+                if "error" in analysis:
+                    self.failed += 1
+                else:
+                    self.analyzed += 1
+        self.last_pass = time.time()
+        if analyzed:
+            self.app.logger.info(f"Analyzed {analyzed} images in {time.perf_counter() - start:.2f}s")
+        return analyzed
+
+    def _analyze(self, image):
+        """Analyze an image unless its stored analysis is current. Returns the analysis and stat, or Nones."""
+        try:
+            stat = os.stat(image["full_path"])
+        except OSError:
+            # Removed since the scan; the next scan drops it from the catalog
+            return None, None
+        if not image["needs_analysis"] and analysis_is_current(
+            image["full_path"], image["file_size"], image["file_mtime"], stat
+        ):
+            return None, None
+        try:
+            analysis = analyze_image(image["full_path"])
+        except Exception as e:
+            analysis = {"version": ANALYSIS_VERSION, "error": str(e), "readable": False}
+            self.app.logger.warning(f"Could not analyze {image['full_path']}: {e}")
+        return analysis, stat
+
+    def as_dict(self):
+        return {
+            "analyzed": self.analyzed,
+            "failed": self.failed,
+            "pytsk3": pytsk3 is not None,
+            "pyewf": pyewf is not None,
+            "last_pass": self.last_pass,
+        }
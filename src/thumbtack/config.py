@@ -12,3 +12,96 @@ IMAGE_DIR = os.getcwd()
 MOUNT_DIR = "/mnt/thumbtack"
 DATABASE = "database.db"
 APPLICATION_ROOT = "/"
+
+# Keep the database between runs instead of rebuilding it at startup. The kept catalog and mount state are
+# checked against IMAGE_DIR and /proc/self/mountinfo in the background, with progress reported on /status
+KEEP_DATABASE = False
+
+# When the database is rebuilt at startup, register the volumes a previous run left mounted under MOUNT_DIR
+# as mounts of their images instead of remounting them (see --adopt-mounts)
+ADOPT_MOUNTS = False
+
+# How DirectoryMonitoring keeps the database in sync with IMAGE_DIR: "poll" rescans every MONITOR_INTERVAL
+# seconds, "inotify" applies filesystem events as they happen (falling back to polling where unsupported)
+MONITOR_MODE = "poll"
+MONITOR_INTERVAL = 3
+
+# Mounts left under MOUNT_DIR by a previous run (see --remove-directories) are unmounted this many at a time
+CLEANUP_WORKERS = 8
+
+# Number of directories listed concurrently when scanning IMAGE_DIR; raise for latency-bound NFS/SMB shares
+SCAN_WORKERS = 8
+
+# Skip listing directories whose mtime has not changed since the last scan, listing everything
+# every DIRECTORY_INDEX_VERIFY_INTERVAL passes as a safety net
+DIRECTORY_INDEX = True
+DIRECTORY_INDEX_VERIFY_INTERVAL = 20
+DIRECTORY_INDEX_SETTLE_SECONDS = 2
+
+# Seconds a request waits for a mount of the same image that is already in progress before giving up
+MOUNT_WAIT_TIMEOUT = 600
+
+# Mounts and unmounts requested with ?async=true, and from the web form, run as jobs on this many worker threads.
+# The form waits FORM_JOB_WAIT seconds for its job before leaving it to finish in the background, and the
+# last JOB_HISTORY finished jobs can be looked up on /jobs/<id>
+MOUNT_WORKERS = 4
+FORM_JOB_WAIT = 5
+JOB_HISTORY = 1000
+
+# Most images POST and DELETE /mounts/batch requests mount or unmount at the same time, across all requests
+BATCH_CONCURRENCY = 8
+
+# disk_mounter to try first for an image format, by signature ("vhdx:.vhdx"), format ("vhdx") or extension (".vhdx").
+# Formats not listed here try whichever mounter last worked for them, except unrecognized ones ("unknown:.dd"),
+# which always try "auto" first, e.g. {"vhdx": "qemu-nbd", ".qcow2": "qemu-nbd"}
+MOUNTER_OVERRIDES = {}
+
+# Read the format and partition layout of new images in the background, without mounting them, on
+# ANALYSIS_WORKERS low-priority threads. New images are analyzed after the scan that found them, and outdated or
+# failed analyses (see ANALYSIS_RETRY_INTERVAL) are looked for every ANALYSIS_INTERVAL seconds
+ANALYZE_IMAGES = True
+ANALYSIS_WORKERS = 2
+ANALYSIS_INTERVAL = 60
+# Images that could not be analyzed are tried again after this many seconds
+ANALYSIS_RETRY_INTERVAL = 3600
+
+# /supported and the index page report the tools imagemounter can use. They are checked in-process at startup,
+# SUPPORT_PROBE_WORKERS at a time, and again when the result is older than SUPPORT_CACHE_TTL seconds
+# or POST /supported/refresh is called
+SUPPORT_CACHE_TTL = 3600
+SUPPORT_PROBE_WORKERS = 8
+
+# Every LIVENESS_INTERVAL seconds, check that the volumes Thumbtack mounted are still in the mount table and answer
+# within LIVENESS_PROBE_TIMEOUT seconds, marking those that do not as Stale. With REMOUNT_STALE, images with stale
+# volumes are unmounted and mounted again (only images mounted without a decryption key can be remounted)
+LIVENESS_CHECKS = True
+LIVENESS_INTERVAL = 30
+LIVENESS_PROBE_TIMEOUT = 5
+REMOUNT_STALE = False
+
+# Mounts not used (mounted or looked up) for IDLE_MOUNT_TIMEOUT seconds are unmounted, checked every REAPER_INTERVAL
+# seconds. Before a new mount, the least recently used mounts are unmounted to stay within MAX_MOUNTS mounted images
+# and MAX_NBD_DEVICES images attached to NBD devices, counting mounts in progress. When mounts in progress fill the
+# budget, a new mount waits up to MOUNT_WAIT_TIMEOUT seconds for one of them to finish. None means no limit
+IDLE_MOUNT_TIMEOUT = None
+MAX_MOUNTS = None
+MAX_NBD_DEVICES = None
+REAPER_INTERVAL = 60
+
+# PUT /mounts/<image>?lease=<seconds> (or ?lease=true for LEASE_TTL seconds) returns a lease on the reference it takes.
+# Leases not renewed with PUT /leases/<id> before they expire are released every LEASE_CHECK_INTERVAL seconds,
+# unmounting the image when no reference is left
+LEASE_TTL = 300
+LEASE_CHECK_INTERVAL = 10
+
+# The index page schedules a background rescan when the image list is older than this many seconds
+CATALOG_MAX_AGE = 30
+
+# PRAGMAs applied to every SQLite connection. WAL lets pages read the catalog while the monitor thread writes to it,
+# and synchronous=NORMAL only syncs at checkpoints, which is safe in WAL mode
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "temp_store": "MEMORY",
+    "cache_size": -16000,  # KiB
+}
@@ -1,7 +1,93 @@
+import os
 import threading
 import time
 
-from .utils import monitor_image_dir, startup_remove_dirs
+from pathlib import Path
+
+from .inotify import (
+    Inotify,
+    IN_CREATE,
+    IN_DELETE,
+    IN_IGNORED,
+    IN_ISDIR,
+    IN_MOVED_FROM,
+    IN_MOVED_TO,
+    IN_ONLYDIR,
+    IN_Q_OVERFLOW,
+)
+from .mountinfo import is_network_filesystem
+from .scanning import EWF_COMPANION_EXTENSIONS
+from .utils import (
+    insert_images,
+    monitor_image_dir,
+    refresh_image,
+    remove_image,
+    remove_images_under,
+    startup_remove_dirs,
+)
+
+WATCH_MASK = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_ONLYDIR
+
+
+class CatalogScanner:
+    """Runs monitor_image_dir for an app, never more than one scan at a time.
+
+    Pages read the catalog as of the last completed scan and call :meth:`schedule` to have it
+    refreshed in the background (stale-while-revalidate) instead of scanning synchronously.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.completed = None
+        self.passes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self._lock.locked()
+
+    def age(self):
+        """Seconds since the catalog was last known to match the image directory, or None."""
+        if self.completed is None:
+            return None
+        return time.time() - self.completed
+
+    def mark_current(self):
+        self.completed = time.time()
+
+    def scan(self, blocking=True, **kwargs):
+        """Scan the image directory in the current app context.
+
+        Returns False without scanning if blocking is False and a scan is already running.
+        Other keyword arguments are passed to monitor_image_dir.
+        """
+        if not self._lock.acquire(blocking=blocking):
+            return False
+        try:
+            # Every DIRECTORY_INDEX_VERIFY_INTERVAL passes, list every directory regardless of its mtime
+            kwargs.setdefault("trust_index", self.passes % self.app.config["DIRECTORY_INDEX_VERIFY_INTERVAL"] != 0)
+            added = monitor_image_dir(**kwargs)
+            self.passes += 1
+            self.mark_current()
+        finally:
+            self._lock.release()
+        if added:
+            self.app.analyzer.notify(added)
+        return True
+
+    def schedule(self):
+        """Start a background scan unless one is already running."""
+        if self.running:
+            return False
+        threading.Thread(target=self._scan_in_app_context, name="thumbtack-catalog-scan", daemon=True).start()
+        return True
+
+    def _scan_in_app_context(self):
+        with self.app.app_context():
+            try:
+                self.scan(blocking=False)
+            except Exception:
+                self.app.logger.exception("Background scan of the image directory failed")
 
 
 class DirectoryMonitoring(threading.Thread):
@@ -16,6 +102,139 @@ class DirectoryMonitoring(threading.Thread):
                     startup_remove_dirs()
             except (KeyError, TypeError):
                 pass
-            while True:
-                time.sleep(3)
-                monitor_image_dir()
+
+            if self.app.config["MONITOR_MODE"] == "inotify":
+                watcher = self.create_watcher()
+                if watcher:
+                    try:
+                        watcher.run()
+                    except OSError as e:
+                        self.app.logger.error(f"inotify watcher failed, falling back to polling: {e}")
+                    finally:
+                        watcher.close()
+
+            self.poll()
+
+    def create_watcher(self):
+        image_dir = self.app.config["IMAGE_DIR"]
+        if is_network_filesystem(image_dir):
+            self.app.logger.info(
+                f"{image_dir} is on a network filesystem that inotify cannot watch, falling back to polling"
+            )
+            return None
+        try:
+            return ImageDirWatcher(self.app)
+        except OSError as e:
+            self.app.logger.info(f"inotify is unavailable, falling back to polling: {e}")
+            return None
+
+    def poll(self):
+        while True:
+            time.sleep(self.app.config["MONITOR_INTERVAL"])
+            # Skip this tick if a scan requested from the web interface is still running
+            self.app.catalog.scan(blocking=False)
+
+
+class ImageDirWatcher:
+    """Keeps the disk_images table in sync with IMAGE_DIR using inotify events.
+
+    Only the paths named in each event are touched, so the cost of an update is
+    proportional to the change rather than to the size of the tree.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.inotify = Inotify()
+        self.watches = {}
+
+        try:
+            self.skip_subdirs = set(app.config["SKIP_SUBDIRECTORY"])
+        except (KeyError, TypeError):
+            self.skip_subdirs = set()
+
+    def close(self):
+        self.inotify.close()
+
+    def run(self):
+        image_dir = self.app.config["IMAGE_DIR"]
+        self.app.logger.info(f"Watching {image_dir} for changes with inotify")
+
+        # Watches are added before the initial scan so nothing created in between is missed
+        self.watch_tree(image_dir)
+        self.app.catalog.scan()
+
+        while True:
+            for event in self.inotify.read_events(timeout=self.app.config["MONITOR_INTERVAL"]):
+                self.handle_event(event)
+            # All pending events have been applied, so the catalog matches the image directory
+            self.app.catalog.mark_current()
+
+    def watch_tree(self, top):
+        for root, dirs, _ in os.walk(top):
+            dirs[:] = [d for d in dirs if d not in self.skip_subdirs]
+            try:
+                wd = self.inotify.add_watch(root, WATCH_MASK)
+            except FileNotFoundError:
+                continue
+            self.watches[wd] = root
+
+    def unwatch_tree(self, top):
+        prefix = top.rstrip("/") + "/"
+        for wd, path in list(self.watches.items()):
+            if path == top or path.startswith(prefix):
+                self.inotify.rm_watch(wd)
+                del self.watches[wd]
+
+    def resync(self):
+        self.app.logger.warning("inotify event queue overflowed, rescanning the image directory")
+        for wd in list(self.watches):
+            self.inotify.rm_watch(wd)
+        self.watches.clear()
+        self.watch_tree(self.app.config["IMAGE_DIR"])
+        self.app.catalog.scan()
+
+    def handle_event(self, event):
+        if event.mask & IN_Q_OVERFLOW:
+            self.resync()
+            return
+
+        if event.mask & IN_IGNORED:
+            self.watches.pop(event.wd, None)
+            return
+
+        parent = self.watches.get(event.wd)
+        if parent is None or not event.name:
+            return
+        path = os.path.join(parent, event.name)
+
+        if event.mask & IN_ISDIR:
+            if event.name in self.skip_subdirs:
+                return
+            if event.mask & (IN_CREATE | IN_MOVED_TO):
+                self.watch_tree(path)
+                self.app.analyzer.notify(insert_images(path))
+            elif event.mask & (IN_DELETE | IN_MOVED_FROM):
+                self.unwatch_tree(path)
+                remove_images_under(path)
+            return
+
+        if event.mask & (IN_CREATE | IN_MOVED_TO):
+            refresh_image(path)
+            # New, or replacing a file that was analyzed
+            self.app.analyzer.notify([path])
+        elif event.mask & (IN_DELETE | IN_MOVED_FROM):
+            remove_image(Path(path))
+
+        # Changing an EWF companion can change whether a sibling .img file is ignored (see check_ignored)
+        base, ext = os.path.splitext(event.name)
+        if ext.lower().lstrip(".") in EWF_COMPANION_EXTENSIONS:
+            self.refresh_img_siblings(parent, base.split(".")[0].lower())
+
+    def refresh_img_siblings(self, directory, basename):
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            return
+        for name in names:
+            if name.lower().endswith("img") and name.split(".")[0].lower() == basename:
+                refresh_image(os.path.join(directory, name))
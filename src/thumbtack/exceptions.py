@@ -15,6 +15,15 @@ class DuplicateMountAttemptError(Exception):
 class EncryptedImageError(Exception):
     pass
 
+class MountWaitTimeoutError(Exception):
+    pass
+
 class DuplicateVolumeGroupError(Exception):
     def __init__(self, msg):
         super().__init__(msg)
+
+class LeasedReferenceError(Exception):
+    pass
+
+class MountBudgetExceededError(Exception):
+    pass
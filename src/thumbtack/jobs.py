@@ -0,0 +1,128 @@
+import threading
+import time
+import uuid
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# The job being run by the current worker thread, for set_phase
+_current = threading.local()
+
+
+def set_phase(phase):
+    """Record what the job running on this thread is doing. Does nothing outside of a job."""
+    job = getattr(_current, "job", None)
+    if job is not None:
+        job.phase = phase
+
+
+class Job:
+    """A mount or unmount requested by a client and run by a :class:`JobManager` worker.
+
+    ``state`` is one of queued, running, succeeded or failed. ``phase`` is a finer-grained description of
+    what a running job is doing, reported with :func:`set_phase`.
+    """
+
+    def __init__(self, operation, rel_path):
+        self.id = uuid.uuid4().hex
+        self.operation = operation
+        self.rel_path = rel_path
+        self.state = "queued"
+        self.phase = "queued"
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.result = None
+        self.error = None
+        self._done = threading.Event()
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """Wait up to timeout seconds for the job to finish. Returns whether it did."""
+        return self._done.wait(timeout)
+
+    def as_dict(self):
+        end = self.finished or time.time()
+        return {
+            "id": self.id,
+            "operation": self.operation,
+            "image_path": self.rel_path,
+            "state": self.state,
+            "phase": self.phase,
+            "submitted": self.submitted,
+            "started": self.started,
+            "finished": self.finished,
+            "queued_seconds": (self.started or end) - self.submitted,
+            "run_seconds": end - self.started if self.started else None,
+            "result": self.result,
+            "error": self.error,
+        }
+
+
+class JobManager:
+    """Runs mount jobs on a bounded pool of worker threads, so request threads only submit and poll them.
+
+    The most recent ``history`` finished jobs are kept for GET /jobs/<id>; queued and running jobs are always kept.
+    """
+
+    def __init__(self, app, workers, history):
+        self.app = app
+        self.workers = workers
+        self.history = history
+        self._lock = threading.Lock()
+        self._jobs = OrderedDict()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="thumbtack-job")
+
+    def submit(self, operation, rel_path, func, *args, describe_error=None, **kwargs):
+        """Queue func(*args, **kwargs) as a job and return the :class:`Job`.
+
+        The return value of func becomes the job result, so it should be JSON serializable. If func raises,
+        the job fails with describe_error(exception) as its error, or str(exception) if that returns None.
+        """
+        job = Job(operation, rel_path)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._trim()
+        self._pool.submit(self._run, job, func, args, kwargs, describe_error)
+        return job
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def jobs(self):
+        with self._lock:
+            return list(self._jobs.values())
+
+    def _trim(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.done]
+        for job_id in finished[: max(0, len(finished) - self.history)]:
+            del self._jobs[job_id]
+
+    def _run(self, job, func, args, kwargs, describe_error):
+        with self.app.app_context():
+            _current.job = job
+            job.started = time.time()
+            job.state = job.phase = "running"
+            try:
+                job.result = func(*args, **kwargs)
+                job.state = "succeeded"
+            except Exception as e:
+                job.error = (describe_error(e) if describe_error else None) or str(e)
+                job.state = "failed"
+                self.app.logger.error(f"{job.operation} job {job.id} for {job.rel_path} failed: {job.error}")
+            finally:
+                job.phase = "done"
+                job.finished = time.time()
+                _current.job = None
+                job._done.set()
+
+    def as_dict(self):
+        jobs = self.jobs()
+        return {
+            "workers": self.workers,
+            "queued": sum(1 for job in jobs if job.state == "queued"),
+            "running": sum(1 for job in jobs if job.state == "running"),
+        }
@@ -0,0 +1,61 @@
+import threading
+import time
+
+from .utils import get_leases, release_lease
+
+
+class LeaseExpiry:
+    """Releases the references held by leases that were not renewed in time.
+
+    A client that mounts with ``?lease=`` holds its reference for the lease's ttl, and keeps it by renewing
+    the lease with PUT /leases/<id>. A client that crashed stops renewing, so every LEASE_CHECK_INTERVAL
+    seconds its expired leases are released, unmounting their images once no reference is left.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.passes = 0
+        self.last_check = None
+        self.expired = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        threading.Thread(target=self.run, name="thumbtack-lease-expiry", daemon=True).start()
+
+    def run(self):
+        with self.app.app_context():
+            while True:
+                time.sleep(self.app.config["LEASE_CHECK_INTERVAL"])
+                try:
+                    self.expire()
+                except Exception:
+                    self.app.logger.exception("Releasing expired leases failed")
+
+    def expire(self, now=None):
+        """Release every lease that expired by now. Returns the number released."""
+        with self._lock:
+            released = 0
+            for lease in get_leases(expired_before=time.time() if now is None else now):
+                try:
+                    if not release_lease(lease["lease_id"]):
+                        continue
+                except Exception:
+                    self.app.logger.exception(f"Could not release lease {lease['lease_id']} on {lease['image_path']}")
+                    continue
+                released += 1
+                self.app.logger.warning(
+                    f"Released lease {lease['lease_id']} on {lease['image_path']}, "
+                    f"which was not renewed within {lease['ttl']:g}s"
+                )
+            self.expired += released
+            self.passes += 1
+            self.last_check = time.time()
+        return released
+
+    def as_dict(self):
+        return {
+            "active": len(get_leases()),
+            "passes": self.passes,
+            "last_check": self.last_check,
+            "expired": self.expired,
+        }
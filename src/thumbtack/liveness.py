@@ -0,0 +1,153 @@
+import os
+import threading
+import time
+
+from .mountinfo import parse_mountinfo
+from .utils import get_mounted_volumes, remount_image, set_volume_statuses
+
+
+class MountProbe:
+    """Checks that mountpoints still answer, giving up on each after a timeout.
+
+    A mountpoint whose FUSE process died fails right away with ENOTCONN, but one whose process hangs blocks
+    the caller for as long as it hangs. Each check runs on its own daemon thread, and a mountpoint whose
+    previous check is still blocked is reported as hung without starting another one.
+    """
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._blocked = set()
+
+    def check(self, mountpoint):
+        """Return None if mountpoint answered within the timeout, otherwise why it did not."""
+        with self._lock:
+            if mountpoint in self._blocked:
+                return "still not answering"
+            self._blocked.add(mountpoint)
+
+        result = {}
+        done = threading.Event()
+
+        def stat():
+            try:
+                os.statvfs(mountpoint)
+            except OSError as e:
+                result["error"] = e.strerror or str(e)
+            finally:
+                with self._lock:
+                    self._blocked.discard(mountpoint)
+                done.set()
+
+        threading.Thread(target=stat, name="thumbtack-mount-probe", daemon=True).start()
+        if not done.wait(self.timeout):
+            return f"did not answer within {self.timeout}s"
+        return result.get("error")
+
+
+class MountLiveness:
+    """Notices mounts that vanished or went stale behind Thumbtack's back, in the background.
+
+    Every LIVENESS_INTERVAL seconds, the volume mountpoints recorded as Mounted, and the FUSE mounts of their
+    disks, are checked against one read of /proc/self/mountinfo and probed with a LIVENESS_PROBE_TIMEOUT.
+    Volumes that are gone or do not answer, or whose disk mount is, are marked Stale, and marked Mounted again if they recover. With REMOUNT_STALE, images with stale volumes
+    are remounted as jobs. :meth:`as_dict` reports the last check for the /status endpoint.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.probe = MountProbe(app.config["LIVENESS_PROBE_TIMEOUT"])
+        self.passes = 0
+        self.last_check = None
+        self.seconds = None
+        self.checked = 0
+        self.stale = []
+        self.remounts = {}
+
+    def start(self):
+        threading.Thread(target=self.run, name="thumbtack-mount-liveness", daemon=True).start()
+
+    def run(self):
+        with self.app.app_context():
+            while True:
+                time.sleep(self.app.config["LIVENESS_INTERVAL"])
+                try:
+                    self.check()
+                except Exception:
+                    self.app.logger.exception("Checking mounted volumes failed")
+
+    def check(self, mounts=None):
+        """Check every mounted volume once. Returns the stale volumes as dicts."""
+        start = time.perf_counter()
+        if mounts is None:
+            mounts = parse_mountinfo()
+        # An unreadable mount table says nothing about the mounts, so only the probes are trusted then
+        mounted = {mount.mountpoint for mount in mounts} if mounts else None
+
+        volumes = get_mounted_volumes()
+        stale = []
+        changes = []
+        disk_reasons = {}
+        for volume in volumes:
+            # A volume on a loop device keeps answering from its cached superblock when the FUSE process
+            # serving the image dies, so the FUSE mount of the disk is checked too
+            disk_mountpoint = volume["disk_mountpoint"]
+            if disk_mountpoint and disk_mountpoint not in disk_reasons:
+                reason = self._check_mountpoint(disk_mountpoint, mounted)
+                disk_reasons[disk_mountpoint] = f"disk mount {disk_mountpoint}: {reason}" if reason else None
+            reason = disk_reasons.get(disk_mountpoint) or self._check_mountpoint(volume["mountpoint"], mounted)
+
+            status = "Stale" if reason else "Mounted"
+            if status != volume["status"]:
+                changes.append((status, volume["disk_id"], volume["partition_index"], volume["mountpoint"]))
+                if reason:
+                    self.app.logger.warning(f"{volume['rel_path']} volume {volume['mountpoint']} is stale: {reason}")
+                else:
+                    self.app.logger.info(f"{volume['rel_path']} volume {volume['mountpoint']} answers again")
+            if reason:
+                stale.append(
+                    {
+                        "rel_path": volume["rel_path"],
+                        "index": volume["partition_index"],
+                        "mountpoint": volume["mountpoint"],
+                        "reason": reason,
+                    }
+                )
+        if changes:
+            set_volume_statuses(changes)
+
+        if self.app.config["REMOUNT_STALE"]:
+            for rel_path in dict.fromkeys(volume["rel_path"] for volume in stale):
+                self._remount(rel_path)
+
+        self.passes += 1
+        self.checked = len(volumes)
+        self.stale = stale
+        self.last_check = time.time()
+        self.seconds = time.perf_counter() - start
+        return stale
+
+    def _check_mountpoint(self, mountpoint, mounted):
+        """Why mountpoint is stale, or None if it is fine."""
+        # Resolving the mountpoint itself would stat it and hang along with it, so only its parent is resolved
+        resolved = os.path.join(os.path.realpath(os.path.dirname(mountpoint)), os.path.basename(mountpoint))
+        if mounted is not None and resolved not in mounted:
+            return "not in the mount table"
+        return self.probe.check(mountpoint)
+
+    def _remount(self, rel_path):
+        job = self.remounts.get(rel_path)
+        if job is not None and not job.done:
+            return
+        self.app.logger.info(f"Remounting {rel_path}, which has stale volumes")
+        self.remounts[rel_path] = self.app.jobs.submit("remount", rel_path, remount_image, rel_path)
+
+    def as_dict(self):
+        return {
+            "passes": self.passes,
+            "last_check": self.last_check,
+            "seconds": self.seconds,
+            "volumes_checked": self.checked,
+            "stale": self.stale,
+            "remounts": {rel_path: job.id for rel_path, job in self.remounts.items()},
+        }
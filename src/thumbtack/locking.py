@@ -0,0 +1,74 @@
+import threading
+
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+
+class ImageLocks:
+    """One lock per image path, so mounts and unmounts of different images can run at the same time.
+
+    Locks are created when an image is first locked and dropped again once nobody holds or waits for
+    them, so the number of locks follows the number of images being worked on, not the catalog size.
+    The locks are re-entrant, so a thread holding an image's lock can call other locked functions
+    for the same image.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # rel_path -> [lock, number of threads holding or waiting for it]
+        self._locks = {}
+
+    def __len__(self):
+        return len(self._locks)
+
+    @contextmanager
+    def lock(self, rel_path):
+        with self._lock:
+            entry = self._locks.setdefault(rel_path, [threading.RLock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._locks[rel_path]
+
+
+class InflightMounts:
+    """Mount attempts in progress, so that concurrent requests to mount the same image share one attempt.
+
+    The first request for a key becomes the leader: it runs the mount and reports the outcome with
+    :meth:`finish`. Requests that arrive in the meantime get the leader's future and wait on it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._futures = {}
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self._futures)
+
+    def join(self, key):
+        """Return (future, leader) for key, where leader is True if the caller has to run the attempt."""
+        with self._lock:
+            future = self._futures.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future, False
+            future = self._futures[key] = Future()
+            return future, True
+
+    def finish(self, key, result=None, exception=None):
+        """Complete the attempt for key, waking every request that waited on it."""
+        with self._lock:
+            future = self._futures.pop(key)
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    def as_dict(self):
+        return {"in_progress": len(self), "coalesced": self.coalesced}
@@ -0,0 +1,166 @@
+import json
+import threading
+import uuid
+
+from collections import namedtuple
+
+# Bump when the layout of the serialized state changes, and teach load_mount_state to read the old layout
+MOUNT_STATE_VERSION = 1
+
+
+class VolumeState:
+    """What Thumbtack reports about a mounted volume, without the imagemounter object behind it.
+
+    Has the same attribute names as :class:`imagemounter_mitre.volume.Volume` for the fields in
+    ``resources.volume_fields``, so either can be marshalled.
+    """
+
+    def __init__(self, index, size=0, offset=0, fstype=None, mountpoint=None, info=None):
+        self.index = index
+        self.size = size
+        self.offset = offset
+        self.fstype = fstype
+        self.mountpoint = mountpoint
+        self.info = info or {}
+
+    @classmethod
+    def from_volume(cls, volume):
+        filesystem = getattr(volume, "filesystem", None)
+        # Only plain values are kept; imagemounter also stores objects in info
+        info = {
+            key: value
+            for key, value in volume.info.items()
+            if value is None or isinstance(value, (str, int, float, bool))
+        }
+        return cls(
+            index=str(volume.index),
+            size=volume.size,
+            offset=volume.offset,
+            fstype=str(filesystem) if filesystem is not None else None,
+            mountpoint=volume.mountpoint,
+            info=info,
+        )
+
+    def to_dict(self):
+        return {
+            "index": self.index,
+            "size": self.size,
+            "offset": self.offset,
+            "fstype": self.fstype,
+            "mountpoint": self.mountpoint,
+            "info": self.info,
+        }
+
+
+class DiskState:
+    """What Thumbtack reports about a mounted disk, without the imagemounter object behind it.
+
+    Has the same attribute names as :class:`imagemounter_mitre.disk.Disk` for the fields in
+    ``resources.disk_fields``, so either can be marshalled.
+    """
+
+    def __init__(self, name, paths, mountpoint=None, volumes=(), device_paths=None, mount_id=None):
+        self._name = name
+        self.paths = list(paths)
+        self.mountpoint = mountpoint
+        self.volumes = list(volumes)
+        self._paths = device_paths or {}
+        # Tells two mounts of the same image apart, even when they used the same mountpoints and devices
+        self.mount_id = mount_id or uuid.uuid4().hex
+
+    @classmethod
+    def from_disk(cls, disk, volumes=None):
+        """Capture the state of disk.
+
+        Parameters
+        ----------
+        disk : imagemounter_mitre.disk.Disk
+            A disk that has been through ImageParser.init (or was set up by hand for a manual mount).
+        volumes : iterable of Volume, optional
+            The volumes to record. Defaults to the volumes of disk.
+        """
+        if volumes is None:
+            volumes = disk.volumes
+        return cls(
+            name=disk._name,
+            paths=disk.paths,
+            mountpoint=disk.mountpoint,
+            volumes=[VolumeState.from_volume(volume) for volume in volumes],
+            device_paths={key: str(value) for key, value in disk._paths.items()},
+        )
+
+    def to_dict(self):
+        return {
+            "version": MOUNT_STATE_VERSION,
+            "mount_id": self.mount_id,
+            "name": self._name,
+            "paths": self.paths,
+            "mountpoint": self.mountpoint,
+            "device_paths": self._paths,
+            "volumes": [volume.to_dict() for volume in self.volumes],
+        }
+
+
+def dump_mount_state(disk_state):
+    """Serialize a DiskState to the compact JSON stored in disk_images.mount_state."""
+    return json.dumps(disk_state.to_dict(), separators=(",", ":"))
+
+
+def load_mount_state(serialized):
+    """Rebuild a DiskState from dump_mount_state output.
+
+    Raises ValueError for state written by a newer version of Thumbtack.
+    """
+    state = json.loads(serialized)
+    if state.get("version") != MOUNT_STATE_VERSION:
+        raise ValueError(f"Unsupported mount state version: {state.get('version')}")
+    return DiskState(
+        name=state["name"],
+        paths=state["paths"],
+        mountpoint=state["mountpoint"],
+        volumes=[VolumeState(**volume) for volume in state["volumes"]],
+        device_paths=state["device_paths"],
+        mount_id=state["mount_id"],
+    )
+
+
+RegistryEntry = namedtuple("RegistryEntry", ["mount_state", "disk_state", "image_parser"])
+
+
+class MountRegistry:
+    """The live ImageParser and DiskState of every mounted image this process knows about, by disk_images.id.
+
+    The database stays the durable record, and the only one other worker processes see. Each entry
+    remembers the serialized mount_state it was created from and is only used while the database row
+    still holds the same state, so a mount or unmount done elsewhere is never answered from a stale entry.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, image_id, mount_state, disk_state, image_parser=None):
+        """Record the state of an image, and the ImageParser that mounted it if it was mounted here."""
+        with self._lock:
+            self._entries[image_id] = RegistryEntry(mount_state, disk_state, image_parser)
+
+    def discard(self, image_id):
+        with self._lock:
+            self._entries.pop(image_id, None)
+
+    def _get(self, image_id, mount_state):
+        entry = self._entries.get(image_id)
+        if entry is not None and entry.mount_state == mount_state:
+            return entry
+        return None
+
+    def get_state(self, image_id, mount_state):
+        entry = self._get(image_id, mount_state)
+        return entry.disk_state if entry else None
+
+    def get_parser(self, image_id, mount_state):
+        entry = self._get(image_id, mount_state)
+        return entry.image_parser if entry else None
@@ -0,0 +1,106 @@
+import os
+import threading
+
+# Leading bytes of the image formats Thumbtack sees most, to tell formats apart regardless of their extension
+FORMAT_MAGIC = [
+    (b"EVF\x09\x0d\x0a\xff\x00", "ewf"),
+    (b"EVF2\x0d\x0a\x81\x00", "ex01"),
+    (b"LVF\x09\x0d\x0a\xff\x00", "lvf"),
+    (b"vhdxfile", "vhdx"),
+    (b"QFI\xfb", "qcow"),
+    (b"KDMV", "vmdk"),
+    (b"COWD", "vmdk"),
+    (b"# Disk DescriptorFile", "vmdk"),
+    (b"<<< Oracle VM VirtualBox Disk Image >>>", "vdi"),
+    (b"conectix", "vhd"),  # dynamic VHDs; fixed ones only have it in the footer
+    (b"AFF10\r\n\x00", "aff"),
+]
+MAGIC_LENGTH = max(len(magic) for magic, _ in FORMAT_MAGIC)
+
+# The disk_mounter values tried, in order, for formats nothing is known about
+DEFAULT_MOUNTERS = ("auto", "qemu-nbd")
+
+
+def format_signature(path):
+    """Identify the format of the image at path as "<format>:<extension>", e.g. "vhdx:.vhdx" or "unknown:.dd"."""
+    extension = os.path.splitext(path)[1].lower()
+    try:
+        with open(path, "rb") as f:
+            head = f.read(MAGIC_LENGTH)
+    except OSError:
+        head = b""
+    for magic, name in FORMAT_MAGIC:
+        if head.startswith(magic):
+            return f"{name}:{extension}"
+    return f"unknown:{extension}"
+
+
+class MounterStrategies:
+    """Remembers which disk_mounter mounted each image format, so the next image of that format tries it first.
+
+    ``overrides`` maps a signature ("vhdx:.vhdx"), a format name ("vhdx") or an extension (".vhdx") to the
+    disk_mounter to try first, taking precedence over what was learned. The other mounters are still tried
+    when the preferred one finds no mountable volumes.
+
+    Nothing is learned for unrecognized formats ("unknown:.dd"): raw images share those signatures with
+    anything the magic bytes missed, so one image that needed qemu-nbd would send every later raw image to
+    qemu-nbd first and use up NBD devices. Overrides still apply to them.
+    """
+
+    def __init__(self, overrides=None, mounters=DEFAULT_MOUNTERS):
+        self._lock = threading.Lock()
+        self.overrides = dict(overrides or {})
+        self.mounters = tuple(mounters)
+        self.learned = {}
+        self.hits = 0
+        self.misses = 0
+        self.first_attempt_failures = 0
+
+    def _override(self, signature):
+        name, _, extension = signature.partition(":")
+        for key in (signature, name, extension):
+            if key in self.overrides:
+                return self.overrides[key]
+        return None
+
+    def order(self, signature):
+        """The disk_mounter values to try for an image with this signature, preferred one first."""
+        with self._lock:
+            preferred = self._override(signature) or self.learned.get(signature)
+            if preferred:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if not preferred:
+            return list(self.mounters)
+        return [preferred] + [mounter for mounter in self.mounters if mounter != preferred]
+
+    def record(self, signature, disk_mounter, attempts):
+        """Remember that disk_mounter mounted an image with this signature after the given number of attempts."""
+        with self._lock:
+            if not signature.startswith("unknown:"):
+                self.learned[signature] = disk_mounter
+            if attempts > 1:
+                self.first_attempt_failures += 1
+
+    def as_dict(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else None,
+            "first_attempt_failures": self.first_attempt_failures,
+            "learned": dict(self.learned),
+            "overrides": self.overrides,
+        }
+
+
+def mount_hints(analysis):
+    """ImageParser and init_volumes arguments that skip the volume detection the analysis already did."""
+    if not analysis or not analysis["readable"]:
+        return {}
+    if analysis["volume_system"]:
+        return {"vstypes": {"*": analysis["volume_system"]}, "single": False}
+    if analysis["volumes"]:
+        return {"single": True}
+    return {}
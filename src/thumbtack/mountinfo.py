@@ -0,0 +1,88 @@
+import os
+
+from collections import namedtuple
+
+
+MOUNTINFO_PATH = "/proc/self/mountinfo"
+
+# Filesystems whose changes can be made by other hosts, so local inotify watches never see them
+NETWORK_FILESYSTEMS = {
+    "9p",
+    "afs",
+    "ceph",
+    "cifs",
+    "fuse.sshfs",
+    "glusterfs",
+    "lustre",
+    "ncpfs",
+    "nfs",
+    "nfs4",
+    "smb3",
+    "smbfs",
+}
+
+MountInfo = namedtuple(
+    "MountInfo",
+    ["mount_id", "parent_id", "device", "root", "mountpoint", "options", "fstype", "source", "super_options"],
+)
+
+
+def _unescape(field):
+    # mountinfo escapes space, tab, newline and backslash as octal sequences (e.g. \040)
+    if "\\" not in field:
+        return field
+    return field.encode().decode("unicode_escape").encode("latin-1").decode()
+
+
+def parse_mountinfo(mountinfo_path=MOUNTINFO_PATH):
+    """Read the kernel mount table once and return a list of MountInfo entries.
+
+    See proc(5) for the format. Returns an empty list if the table cannot be read.
+    """
+    try:
+        with open(mountinfo_path, "r") as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return []
+
+    mounts = []
+    for line in lines:
+        fields = line.split(" ")
+        try:
+            separator = fields.index("-", 6)
+            mounts.append(
+                MountInfo(
+                    mount_id=int(fields[0]),
+                    parent_id=int(fields[1]),
+                    device=fields[2],
+                    root=_unescape(fields[3]),
+                    mountpoint=_unescape(fields[4]),
+                    options=fields[5],
+                    fstype=fields[separator + 1],
+                    source=_unescape(fields[separator + 2]),
+                    super_options=fields[separator + 3] if len(fields) > separator + 3 else "",
+                )
+            )
+        except (ValueError, IndexError):
+            continue
+    return mounts
+
+
+def find_mount(path, mounts=None):
+    """Return the MountInfo entry of the filesystem containing path (longest mountpoint prefix)."""
+    if mounts is None:
+        mounts = parse_mountinfo()
+
+    path = os.path.realpath(path)
+    best = None
+    for mount in mounts:
+        mountpoint = mount.mountpoint
+        if path == mountpoint or path.startswith(mountpoint.rstrip("/") + "/"):
+            if best is None or len(mountpoint) >= len(best.mountpoint):
+                best = mount
+    return best
+
+
+def is_network_filesystem(path, mounts=None):
+    mount = find_mount(path, mounts)
+    return mount is not None and mount.fstype in NETWORK_FILESYSTEMS
@@ -0,0 +1,174 @@
+import threading
+import time
+
+from collections import Counter, deque
+from contextlib import contextmanager
+
+from flask import current_app
+
+from .exceptions import MountBudgetExceededError
+from .utils import get_image_info, get_last_access, get_mounts_by_last_access, unmount_image
+
+# Evictions listed on /status
+EVICTION_HISTORY = 100
+
+# How often a mount waiting for room checks again, in case an image was unmounted without the reaper
+BUDGET_RECHECK_SECONDS = 1
+
+
+class MountReaper:
+    """Unmounts mounts that clients left behind, so they do not use up NBD devices, loop devices and FUSE processes.
+
+    Mounts not used for IDLE_MOUNT_TIMEOUT seconds are unmounted every REAPER_INTERVAL seconds. A mount
+    holds a :meth:`reserve` for its image until it finishes, and the reservations count towards MAX_MOUNTS
+    and MAX_NBD_DEVICES along with the mounted images (a mount in progress may need an NBD device). Making
+    room evicts the least recently used mounted images, and waits for mounts in progress if there are not
+    enough of those. Evictions go through unmount_image with force, so they drop every reference, and are
+    logged and counted by reason. Manual mounts are never evicted.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.evictions = Counter()
+        self.recent = deque(maxlen=EVICTION_HISTORY)
+        self.passes = 0
+        self.last_pass = None
+        self._lock = threading.Condition()
+        self._reserved = Counter()
+
+    @property
+    def enabled(self):
+        config = self.app.config
+        return any(config[key] for key in ("IDLE_MOUNT_TIMEOUT", "MAX_MOUNTS", "MAX_NBD_DEVICES"))
+
+    def start(self):
+        threading.Thread(target=self.run, name="thumbtack-mount-reaper", daemon=True).start()
+
+    def run(self):
+        with self.app.app_context():
+            while True:
+                time.sleep(self.app.config["REAPER_INTERVAL"])
+                try:
+                    self.reap()
+                except Exception:
+                    self.app.logger.exception("Reaping idle mounts failed")
+
+    def reap(self):
+        """Unmount idle mounts, then the least recently used ones while over budget. Returns the number evicted."""
+        with self._lock:
+            evicted = 0
+            timeout = self.app.config["IDLE_MOUNT_TIMEOUT"]
+            if timeout:
+                cutoff = time.time() - timeout
+                for image in get_mounts_by_last_access():
+                    if image["rel_path"] not in self._reserved and (image["last_access"] or 0) < cutoff:
+                        evicted += self._evict(image, "idle", cutoff)
+            evicted += self._make_room(None)[0]
+            self.passes += 1
+            self.last_pass = time.time()
+            self._lock.notify_all()
+        return evicted
+
+    @contextmanager
+    def reserve(self, rel_path):
+        """Hold room for a mount of rel_path within MAX_MOUNTS and MAX_NBD_DEVICES until the block exits.
+
+        Must not be entered while holding an image lock, as making room takes the locks of the images evicted.
+        Raises MountBudgetExceededError if no room was found within MOUNT_WAIT_TIMEOUT seconds.
+        """
+        if not (self.app.config["MAX_MOUNTS"] or self.app.config["MAX_NBD_DEVICES"]):
+            yield
+            return
+
+        deadline = time.monotonic() + self.app.config["MOUNT_WAIT_TIMEOUT"]
+        with self._lock:
+            while True:
+                fits = self._make_room(rel_path)[1]
+                remaining = deadline - time.monotonic()
+                if fits or remaining <= 0:
+                    break
+                self._lock.wait(min(remaining, BUDGET_RECHECK_SECONDS))
+            if not fits:
+                msg = f"No room within MAX_MOUNTS or MAX_NBD_DEVICES to mount {rel_path}: all mounts are in use"
+                self.app.logger.error(msg)
+                raise MountBudgetExceededError(msg)
+            self._reserved[rel_path] += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._reserved[rel_path] -= 1
+                if not self._reserved[rel_path]:
+                    del self._reserved[rel_path]
+                self._lock.notify_all()
+
+    def _make_room(self, rel_path):
+        """Evict the least recently used mounts to stay within budget with rel_path mounted (if not None).
+
+        Returns the number evicted and whether everything fits now. Mounts in progress count as using an NBD
+        device and cannot be evicted.
+        """
+        mounts = get_mounts_by_last_access()
+        in_use = {image["rel_path"]: bool(image["uses_nbd"]) for image in mounts}
+        in_use.update(dict.fromkeys(self._reserved, True))
+        if rel_path is not None and rel_path not in in_use:
+            in_use[rel_path] = True
+        evictable = [image for image in mounts if image["rel_path"] not in self._reserved and image["rel_path"] != rel_path]
+
+        evicted = 0
+        limits = [("max_mounts", self.app.config["MAX_MOUNTS"], lambda path: True)]
+        limits.append(("max_nbd_devices", self.app.config["MAX_NBD_DEVICES"], lambda path: in_use[path]))
+        for reason, limit, counts in limits:
+            if not limit:
+                continue
+            candidates = [image for image in evictable if counts(image["rel_path"])]
+            while sum(map(counts, in_use)) > limit and candidates:
+                image = candidates.pop(0)
+                evictable.remove(image)
+                if self._evict(image, reason):
+                    evicted += 1
+                    del in_use[image["rel_path"]]
+        fits = all(not limit or sum(map(counts, in_use)) <= limit for _, limit, counts in limits)
+        return evicted, fits
+
+    def _evict(self, image, reason, cutoff=None):
+        rel_path = image["rel_path"]
+        with current_app.mount_locks.lock(rel_path):
+            info = get_image_info(rel_path, with_state=False)
+            if info is None or info["status"] != "Mounted":
+                return 0
+            last_access = get_last_access(info["id"])
+            if cutoff is not None and last_access is not None and last_access >= cutoff:
+                # Used since it was picked
+                return 0
+            try:
+                unmount_image(rel_path, force=True)
+            except Exception:
+                self.app.logger.exception(f"Could not evict {rel_path}")
+                return 0
+
+        idle = time.time() - last_access if last_access else None
+        self.app.logger.warning(
+            f"Evicted {rel_path} ({reason}) with {info['ref_count']} references"
+            + (f", idle for {idle:.0f}s" if idle is not None else "")
+        )
+        self.evictions[reason] += 1
+        self.recent.append(
+            {"image_path": rel_path, "reason": reason, "ref_count": info["ref_count"], "idle": idle, "time": time.time()}
+        )
+        return 1
+
+    def as_dict(self):
+        config = self.app.config
+        with self._lock:
+            reserved = sorted(self._reserved)
+        return {
+            "idle_timeout": config["IDLE_MOUNT_TIMEOUT"],
+            "max_mounts": config["MAX_MOUNTS"],
+            "max_nbd_devices": config["MAX_NBD_DEVICES"],
+            "mounts_in_progress": reserved,
+            "passes": self.passes,
+            "last_pass": self.last_pass,
+            "evictions": dict(self.evictions),
+            "recent_evictions": list(self.recent),
+        }
@@ -0,0 +1,69 @@
+import threading
+import time
+
+from .scanning import ScanStats
+from .utils import reconcile_mounts
+
+
+class StartupReconciliation:
+    """Brings a database kept from a previous run back in line with the system, in the background.
+
+    Mount state is checked against /proc/self/mountinfo first, then the catalog is checked against
+    IMAGE_DIR with a scan that trusts the stored directory index. Requests are served from the kept
+    database while this runs, and :meth:`as_dict` reports progress for the /status endpoint.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.phase = "pending"
+        self.started = None
+        self.finished = None
+        self.error = None
+        self.mounts_checked = 0
+        self.mounts_reset = 0
+        self.scan_stats = None
+
+    @property
+    def done(self):
+        return self.phase in ("done", "failed")
+
+    def start(self):
+        threading.Thread(target=self.run, name="thumbtack-startup-reconciliation", daemon=True).start()
+
+    def run(self):
+        with self.app.app_context():
+            self.started = time.time()
+            try:
+                self.phase = "mounts"
+                self.mounts_checked, self.mounts_reset = reconcile_mounts()
+
+                self.phase = "images"
+                self.scan_stats = ScanStats(self.app.config["SCAN_WORKERS"])
+                self.app.catalog.scan(trust_index=True, stats=self.scan_stats)
+                self.phase = "done"
+            except Exception as e:
+                self.phase = "failed"
+                self.error = str(e)
+                self.app.logger.exception("Startup reconciliation failed")
+            finally:
+                self.finished = time.time()
+
+        self.app.logger.info(
+            f"Startup reconciliation {self.phase} in {self.finished - self.started:.2f}s: "
+            f"{self.mounts_reset} of {self.mounts_checked} mounted images reset, {self.scan_stats}"
+        )
+
+    def as_dict(self):
+        end = self.finished or time.time()
+        return {
+            "phase": self.phase,
+            "started": self.started,
+            "finished": self.finished,
+            "seconds": end - self.started if self.started else None,
+            "error": self.error,
+            "mounts_checked": self.mounts_checked,
+            "mounts_reset": self.mounts_reset,
+            "directories_scanned": self.scan_stats.directories if self.scan_stats else 0,
+            "files_scanned": self.scan_stats.files if self.scan_stats else 0,
+            "unchanged_directories": self.scan_stats.unchanged if self.scan_stats else 0,
+        }
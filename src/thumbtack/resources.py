@@ -1,8 +1,11 @@
 import imagemounter_mitre.exceptions
+import json
 import os
 
-from flask import current_app, request
-from flask_restful import Resource, marshal_with, abort, fields
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from flask import Response, current_app, request, url_for
+from flask_restful import Resource, marshal, marshal_with, abort, fields
+from werkzeug.http import http_date
 
 from .exceptions import (
     UnexpectedDiskError,
@@ -11,8 +14,23 @@ from .exceptions import (
     DuplicateMountAttemptError,
     EncryptedImageError,
     DuplicateVolumeGroupError,
+    MountWaitTimeoutError,
+    LeasedReferenceError,
+    MountBudgetExceededError,
+)
+from .utils import (
+    get_mount_info,
+    mount_image,
+    unmount_image,
+    get_images,
+    get_image_info,
+    add_mountpoint,
+    grant_lease,
+    renew_lease,
+    get_leases,
+    release_lease,
+    save_scan_settings,
 )
-from .utils import get_mount_info, get_supported_libraries, mount_image, unmount_image, get_images, add_mountpoint
 
 volume_fields = {
     "size": fields.Integer,
@@ -33,6 +51,101 @@ disk_fields = {
 disk_mount = {"disk_info": fields.Nested(disk_fields), "ref_count": fields.Integer}
 
 
+def mount_error_message(e, image_path):
+    """The message shown to users when mounting image_path raised e, or None for unexpected errors."""
+    if isinstance(e, imagemounter_mitre.exceptions.SubsystemError):
+        return f"Thumbtack was unable to mount {image_path} using the imagemounter Python library."
+    if isinstance(e, PermissionError):
+        return f"Thumbtack does not have mounting privileges for {image_path}. Are you running as root?"
+    if isinstance(e, UnexpectedDiskError):
+        return "Unexpected number of disks. Thumbtack can only handle disk images that contain one disk."
+    if isinstance(e, NoMountableVolumesError):
+        return f"No volumes in {image_path} were able to be mounted."
+    if isinstance(e, ImageNotInDatabaseError):
+        return f"Cannot mount {image_path}. Image is not in Thumbtack database."
+    if isinstance(e, EncryptedImageError):
+        return str(e) or "Unable to mount encrypted image."
+    if isinstance(e, NotADirectoryError):
+        return "Mount failed. Thumbtack server has no mount directory set."
+    if isinstance(e, DuplicateMountAttemptError):
+        return "Mount attempt is already in progress for this image. Please wait until the current mount attempt completes."
+    if isinstance(e, MountWaitTimeoutError):
+        return f"Timed out waiting for the mount attempt in progress for {image_path}."
+    if isinstance(e, LeasedReferenceError):
+        return str(e)
+    if isinstance(e, MountBudgetExceededError):
+        return f"Too many images are mounted to mount {image_path}. Try again once some are unmounted."
+    if isinstance(e, DuplicateVolumeGroupError):
+        return f"Unable to mount all volumes. Found duplicate volume group name: {str(e)}. Deactivate the volume group and remount the image."
+    return None
+
+
+def creds_for_key(key):
+    """Create the volume-key mapping for a decryption key. Need to find a better appraoch for this"""
+    if not key:
+        return None
+    return {i: key for i in range(0, 25)}
+
+
+def wants_async():
+    return request.args.get("async", "").lower() in ("1", "true", "yes")
+
+
+def lease_ttl():
+    """The ttl of the lease requested with ?lease=, or None if no lease was requested."""
+    lease = request.args.get("lease", "").lower()
+    if lease in ("", "0", "false", "no"):
+        return None
+    if lease in ("1", "true", "yes"):
+        return current_app.config["LEASE_TTL"]
+    try:
+        ttl = float(lease)
+    except ValueError:
+        ttl = 0
+    if ttl <= 0:
+        abort(400, message=f"Invalid lease: {lease}. Use a number of seconds or true.")
+    return ttl
+
+
+def mounted_response(mounted_disk, image_path, ttl):
+    """Marshal a mounted disk, with a lease on the reference just taken if ttl is set."""
+    response = marshal(mounted_disk, disk_fields)
+    if ttl:
+        response["lease"] = grant_lease(image_path, ttl)
+    return response
+
+
+def _mount_job(image_path, creds, ttl=None):
+    mounted_disk = mount_image(image_path, creds=creds)
+    if not mounted_disk or mounted_disk.mountpoint is None:
+        raise NoMountableVolumesError(image_path)
+    return mounted_response(mounted_disk, image_path, ttl)
+
+
+def _unmount_job(image_path):
+    unmounted = unmount_image(image_path)
+    image_info = get_image_info(image_path, with_state=False)
+    return {"unmounted": unmounted, "ref_count": image_info["ref_count"] if image_info else None}
+
+
+def submit_mount_job(image_path, creds=None, ttl=None):
+    """Queue a mount of image_path on the job pool. The job result is the mounted disk as returned by PUT /mounts."""
+    return current_app.jobs.submit(
+        "mount", image_path, _mount_job, image_path, creds, ttl,
+        describe_error=lambda e: mount_error_message(e, image_path),
+    )
+
+
+def submit_unmount_job(image_path):
+    """Queue an unmount of image_path on the job pool. The job result says whether the image was unmounted."""
+    return current_app.jobs.submit("unmount", image_path, _unmount_job, image_path)
+
+
+def job_accepted(job):
+    location = url_for(".job", job_id=job.id)
+    return {"job_id": job.id, "status_url": location}, 202, {"Location": location}
+
+
 class Mount(Resource):
     """A Mount object that allows you to mount and unmount images.
     """
@@ -42,7 +155,6 @@ class Mount(Resource):
         """
         current_app.logger.debug("Instantiating the Mount class")
 
-    @marshal_with(disk_fields)
     def put(self, image_path):
         """Mounts an image file.
 
@@ -51,45 +163,32 @@ class Mount(Resource):
         image_path : str
             Relative path to an image file to be mounted.
             This is relative to the Thumbtack server's IMAGE_DIR config variable.
+        async : str, optional
+            Query parameter. If true, the mount runs as a background job and ``202`` is returned with
+            the job id, to be polled at /jobs/<id>.
+        lease : str, optional
+            Query parameter. A number of seconds, or true for LEASE_TTL. The reference taken by the mount is
+            released after that long unless renewed with PUT /leases/<lease_id>.
         """
-        status = None
+        creds = creds_for_key(request.args.get("key"))
+        ttl = lease_ttl()
 
-        # Create volume-key mapping. Need to find a better appraoch for this
-        creds = {}
-        if len(request.args.getlist("key")) > 0:
-            for i in range(0, 25):
-                creds[i] = request.args.getlist("key")[0]
-        else:
-            creds = None
+        if wants_async():
+            job = submit_mount_job(image_path, creds, ttl)
+            return job_accepted(job)
 
         try:
-            current_app.mnt_mutex.acquire()
             mounted_disk = mount_image(image_path, creds=creds)
 
             if mounted_disk and mounted_disk.mountpoint is not None:
                 current_app.logger.info(f"Image mounted successfully: {image_path}")
-                current_app.mnt_mutex.release()
-                return mounted_disk
-
-        # TODO: refactor to not duplicate code in the mount_form in views.py
-        except imagemounter_mitre.exceptions.SubsystemError:
-            status = f"Thumbtack was unable to mount {image_path} using the imagemounter Python library."
-        except PermissionError:
-            status = f"Thumbtack does not have mounting privileges for {image_path}. Are you running as root?"
-        except UnexpectedDiskError:
-            status = "Unexpected number of disks. Thumbtack can only handle disk images that contain one disk."
-        except NoMountableVolumesError:
-            status = f"No volumes in {image_path} were able to be mounted."
-        except ImageNotInDatabaseError:
-            status = f"Cannot mount {image_path}. Image is not in Thumbtack database."
-        except EncryptedImageError:
-            status = f"Unable to mount encrypted image."
-        except DuplicateMountAttemptError:
-            status = "Mount attempt is already in progress for this image. Please wait until the current mount attempt completes."
-        except DuplicateVolumeGroupError as e:
-            status = f"Unable to mount all volumes. Found duplicate volume group name: {str(e)}. Deactivate the volume group and remount the image."
-
-        current_app.mnt_mutex.release()
+                return mounted_response(mounted_disk, image_path, ttl)
+            status = None
+        except Exception as e:
+            status = mount_error_message(e, image_path)
+            if status is None:
+                raise
+
         current_app.logger.error(status)
         abort(400, message=str(status))
 
@@ -122,29 +221,179 @@ class Mount(Resource):
         ----------
         image_path : str
             Relative path to an image file to unmount.
+        async : str, optional
+            Query parameter. If true, the unmount runs as a background job and ``202`` is returned with
+            the job id, to be polled at /jobs/<id>.
+        lease : str, optional
+            Query parameter. The id of the lease whose reference is released. References held by leases
+            cannot be released without it.
+        """
+        lease_id = request.args.get("lease")
+        if lease_id:
+            lease = get_leases(lease_id)
+            if lease is None or lease["image_path"] != image_path:
+                abort(404, message=f"Lease {lease_id} on {image_path} not found")
+            release_lease(lease_id)
+            return
+        if wants_async():
+            return job_accepted(submit_unmount_job(image_path))
+        try:
+            unmount_image(image_path)
+        except LeasedReferenceError as e:
+            abort(409, message=str(e))
+
+
+class Lease(Resource):
+    """Leases on mount references, which clients renew while they use the mounted image."""
+
+    def get(self, lease_id=None):
+        if lease_id is None:
+            return get_leases()
+        lease = get_leases(lease_id)
+        if lease is None:
+            abort(404, message=f"Lease {lease_id} not found")
+        return lease
+
+    def put(self, lease_id):
+        """Renew a lease that has not expired yet."""
+        lease = renew_lease(lease_id)
+        if lease is None:
+            abort(404, message=f"Lease {lease_id} not found or already expired")
+        return lease
+
+    def delete(self, lease_id):
+        """Release a lease and its reference, unmounting the image if it was the last one."""
+        if not release_lease(lease_id):
+            abort(404, message=f"Lease {lease_id} not found")
+
+
+class MountBatch(Resource):
+    """Mount or unmount many images in one request, streaming a result line per image as each one finishes."""
+
+    def post(self):
+        """Mounts a list of image files.
+
+        The JSON body has an ``images`` list, whose items are relative image paths or objects with an
+        ``image_path`` and an optional decryption ``key``, and an optional ``concurrency`` (capped at
+        BATCH_CONCURRENCY, which also bounds all batch requests together). The response is newline-delimited
+        JSON with one object per image.
         """
-        current_app.mnt_mutex.acquire()
-        unmount_image(image_path)
-        current_app.mnt_mutex.release()
+        return self._run("mount")
+
+    def delete(self):
+        """Unmounts a list of image files, given like for :meth:`post`."""
+        return self._run("unmount")
+
+    def _run(self, operation):
+        body = request.get_json(silent=True) or {}
+        items = body.get("images")
+        if not isinstance(items, list) or not items:
+            abort(400, message="Expected a JSON body with a non-empty list of images.")
+        items = [item if isinstance(item, dict) else {"image_path": item} for item in items]
+        if not all(isinstance(item.get("image_path"), str) for item in items):
+            abort(400, message="Every image needs an image_path.")
+
+        limit = current_app.config["BATCH_CONCURRENCY"]
+        try:
+            concurrency = max(1, min(int(body.get("concurrency", limit)), limit))
+        except (TypeError, ValueError):
+            abort(400, message="concurrency must be an integer.")
+
+        app = current_app._get_current_object()
+        current_app.logger.info(f"* Batch {operation} of {len(items)} images, {concurrency} at a time")
+        return Response(_stream_batch(app, operation, items, concurrency), mimetype="application/x-ndjson")
+
+
+def _batch_item(app, operation, item):
+    image_path = item["image_path"]
+    with app.batch_slots, app.app_context():
+        try:
+            if operation == "mount":
+                disk_info = _mount_job(image_path, creds_for_key(item.get("key")))
+                return {"image_path": image_path, "status": "mounted", "disk_info": disk_info}
+            return {"image_path": image_path, "status": "done", **_unmount_job(image_path)}
+        except Exception as e:
+            error = mount_error_message(e, image_path) or str(e)
+            app.logger.error(f"Batch {operation} of {image_path} failed: {error}")
+            return {"image_path": image_path, "status": "failed", "error": error}
+
+
+def _stream_batch(app, operation, items, concurrency):
+    pool = ThreadPoolExecutor(max_workers=min(concurrency, len(items)), thread_name_prefix="thumbtack-batch")
+    try:
+        futures = [pool.submit(_batch_item, app, operation, item) for item in items]
+        for future in as_completed(futures):
+            yield json.dumps(future.result()) + "\n"
+    finally:
+        # Images that have not started yet are skipped if the client goes away
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+class Jobs(Resource):
+    def get(self, job_id=None):
+        """Report the state, phase and timing of a mount or unmount job, or of all recent jobs."""
+        if job_id is None:
+            return [job.as_dict() for job in current_app.jobs.jobs()]
+        job = current_app.jobs.get(job_id)
+        if job is None:
+            abort(404, message=f"No job {job_id}")
+        return job.as_dict()
+
+
+def supported_libraries_response(libraries):
+    # The body stays the {tool: installed} map clients already parse; when it was probed goes in a header
+    return libraries, 200, {"Last-Modified": http_date(current_app.support_matrix.last_probed)}
 
 
 class SupportedLibraries(Resource):
     def get(self):
-        return get_supported_libraries()
+        """Report which tools imagemounter uses are installed, and when that was last checked."""
+        return supported_libraries_response(current_app.support_matrix.get())
+
+
+class SupportedLibrariesRefresh(Resource):
+    def post(self):
+        """Check the installed tools again, e.g. after installing one, instead of waiting for the cache to expire."""
+        return supported_libraries_response(current_app.support_matrix.refresh())
 
 class Images(Resource):
     def get(self):
-        images = get_images()
-        # Remove non-serializable parser for api call
+        images = get_images(with_analysis=True)
+        # Remove non-serializable mount state for api call
         for image in images:
-            if "parser" in image:
-                image.pop("parser")
+            if "mount_state" in image:
+                image.pop("mount_state")
         return images
 
+class Status(Resource):
+    def get(self):
+        """Report on the catalog, on mounts in progress and on the startup reconciliation of a kept database."""
+        catalog = current_app.catalog
+        last_scan = current_app.last_scan
+        reconciliation = current_app.reconciliation
+        return {
+            "catalog": {
+                "age": catalog.age(),
+                "scanning": catalog.running,
+                "last_scan": last_scan.as_dict() if last_scan and last_scan.seconds is not None else None,
+            },
+            "mounts": current_app.inflight_mounts.as_dict(),
+            "jobs": current_app.jobs.as_dict(),
+            "mounter_strategies": current_app.mounter_strategies.as_dict(),
+            "analysis": current_app.analyzer.as_dict(),
+            "liveness": current_app.liveness.as_dict(),
+            "reaper": current_app.reaper.as_dict(),
+            "leases": current_app.leases.as_dict(),
+            "startup_reconciliation": reconciliation.as_dict() if reconciliation else None,
+        }
+
 class ImageDir(Resource):
     def put(self):
         image_dir = request.args.getlist("image_dir")[0]
         current_app.config.update(IMAGE_DIR=image_dir)
+        # Drops the directory index built for the old IMAGE_DIR, and the unmounted images outside the new one
+        save_scan_settings()
+        current_app.catalog.schedule()
         return image_dir
     def get(self):
         return current_app.config["IMAGE_DIR"]
@@ -0,0 +1,266 @@
+import functools
+import os
+import re
+import time
+
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+# Auxiliary files that sit next to EWF segments:
+#   .EXX.txt, .EXX.adcf, .EXX.log and .EXX.packed_log files, plus any .txt, .log or .packed_log file
+EARLY_IGNORE_PATTERN = re.compile(
+    r"(?:\.[EL]X?\w\w\.adcf|\.txt|\.log|\.packed_log)$", flags=re.I
+)
+
+# Files that are always (raw) or conditionally (img) included, before the remaining ignore rules are applied
+INCLUDE_PATTERN = re.compile(r"(raw|img)$", flags=re.I)
+
+# Everything else that is part of an image but not the file that should be mounted:
+#   *.db (the sqlite DB could be in the image directory)
+#   *.E02, *.E03, ..., *.EAA, ..., *.FAA, ... but not *.E01 (or *.L01)
+#   *.002, *.003, ..., but not *.001
+#   *-sXXX.vmdk, but not *.vmdk
+#   *-1.vhd, *-2.vhd, ..., *-N.vhd, but not *-0.vhd
+LATE_IGNORE_PATTERN = re.compile(
+    r"""(?:
+        \.db
+        | \.(?![EL]X?01$)[EFGHIJKLMNOPQRSTUWXYZ]X?(?:\w\w|\d\d+)
+        | \.(?!001$)\d\d\d
+        | -s\w\w\w\.vmdk
+        | -(?!0\.vhd$)\d+\.vhd
+    )$""",
+    flags=re.I | re.X,
+)
+
+# A multipart EWF file is ignored when both of these exist next to the .img file
+EWF_COMPANION_EXTENSIONS = ("e01", "imf")
+
+
+class ImageClassifier:
+    """Precompiled form of the rules in :func:`thumbtack.utils.check_ignored`.
+
+    The rules are compiled once into three combined patterns that are evaluated in the
+    same order as the original checks. Directory listings needed for .img files are
+    taken from the caller when available instead of being listed again per file.
+
+    Parameters
+    ----------
+    path_contains : str, optional
+        Only include files whose full path contains this string.
+    """
+
+    def __init__(self, path_contains=None):
+        self.path_contains = path_contains
+
+    def is_ignored(self, full_path, dir_names=None):
+        """Return True if the file at full_path should not be tracked as a disk image.
+
+        Parameters
+        ----------
+        full_path : str
+            Full path of a file (not a directory).
+        dir_names : iterable of str, optional
+            Names of the entries in the file's directory. Listed from disk if needed and not given.
+        """
+        full_path = str(full_path)
+        verdict = self._classify(full_path)
+        if verdict is None:
+            if dir_names is None:
+                dir_names = os.listdir(os.path.dirname(full_path) or ".")
+            return self._has_ewf_companions(full_path, {name.lower() for name in dir_names})
+        return verdict
+
+    def included_files(self, root, filenames, listing=None):
+        """Yield (filename, full_path) for each file in one directory listing that is not ignored.
+
+        Parameters
+        ----------
+        root : str
+            Directory containing the files.
+        filenames : list of str
+            Names of the files to classify.
+        listing : iterable of str, optional
+            Names of all entries in root. Defaults to filenames.
+
+        The lowercased listing is built at most once per directory, and only if it contains .img files.
+        """
+        lowered = None
+        for filename in filenames:
+            full_path = filename if root == "." else os.path.join(root, filename)
+            verdict = self._classify(full_path)
+            if verdict is None:
+                if lowered is None:
+                    lowered = {name.lower() for name in (filenames if listing is None else listing)}
+                verdict = self._has_ewf_companions(full_path, lowered)
+            if not verdict:
+                yield filename, full_path
+
+    def _classify(self, full_path):
+        """Return True (ignored), False (included) or None when the directory listing decides."""
+        if EARLY_IGNORE_PATTERN.search(full_path):
+            return True
+
+        include = INCLUDE_PATTERN.search(full_path)
+        if include:
+            return False if include.group(1).lower() == "raw" else None
+
+        if LATE_IGNORE_PATTERN.search(full_path):
+            return True
+
+        # Ignore file paths not containing specified string if applicable
+        if self.path_contains is not None and self.path_contains not in full_path:
+            return True
+
+        return False
+
+    @staticmethod
+    def _has_ewf_companions(full_path, listing):
+        file_basename = os.path.basename(full_path).split(".")[0].lower()
+        return all(f"{file_basename}.{ext}" in listing for ext in EWF_COMPANION_EXTENSIONS)
+
+
+@functools.lru_cache(maxsize=8)
+def get_classifier(path_contains=None):
+    return ImageClassifier(path_contains)
+
+
+class ScanStats:
+    """Throughput of one walk of the image directory."""
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.directories = 0
+        self.files = 0
+        # Directories skipped because their mtime was unchanged, and directories whose entry count
+        # changed without a new mtime (only detectable on passes that list everything)
+        self.unchanged = 0
+        self.missed_changes = 0
+        self.started = time.time()
+        self.seconds = None
+        self._start = time.perf_counter()
+
+    def finish(self):
+        self.seconds = time.perf_counter() - self._start
+
+    @property
+    def directories_per_second(self):
+        return self.directories / self.seconds if self.seconds else 0.0
+
+    @property
+    def files_per_second(self):
+        return self.files / self.seconds if self.seconds else 0.0
+
+    def as_dict(self):
+        return {
+            "workers": self.workers,
+            "directories": self.directories,
+            "files": self.files,
+            "unchanged_directories": self.unchanged,
+            "missed_changes": self.missed_changes,
+            "started": self.started,
+            "seconds": self.seconds,
+            "directories_per_second": self.directories_per_second,
+            "files_per_second": self.files_per_second,
+        }
+
+    def __str__(self):
+        return (
+            f"{self.directories} directories ({self.unchanged} unchanged) and {self.files} files in {self.seconds:.2f}s "
+            f"({self.directories_per_second:.0f} dirs/s, {self.files_per_second:.0f} files/s, {self.workers} workers)"
+        )
+
+
+DirectoryListing = namedtuple(
+    "DirectoryListing", ["root", "filenames", "listing", "subdirs", "mtime_ns", "unchanged"]
+)
+
+# A stored directory mtime, its number of entries and the full paths of its subdirectories
+DirectoryIndexEntry = namedtuple("DirectoryIndexEntry", ["mtime_ns", "entry_count", "subdirs"])
+
+
+def _scan_directory(path, index=None, trust_index=False):
+    """List one directory with os.scandir, using the DirEntry type information instead of a stat per file.
+
+    If the directory mtime matches its entry in index and trust_index is set, the directory is not
+    listed at all and its subdirectories are taken from the index instead.
+
+    Like os.walk, symlinks to directories are not followed and unreadable directories are skipped.
+    """
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except OSError:
+        return DirectoryListing(path, [], [], [], None, False)
+
+    known = index.get(path) if index else None
+    if trust_index and known is not None and known.mtime_ns == mtime_ns:
+        return DirectoryListing(path, [], [], known.subdirs, mtime_ns, True)
+
+    filenames = []
+    subdirs = []
+    listing = []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                listing.append(entry.name)
+                try:
+                    if entry.is_dir():
+                        if not entry.is_symlink():
+                            subdirs.append(entry.name if path == "." else entry.path)
+                    elif entry.is_file():
+                        filenames.append(entry.name)
+                except OSError:
+                    continue
+    except OSError:
+        pass
+    return DirectoryListing(path, filenames, listing, subdirs, mtime_ns, False)
+
+
+def walk_image_dir(top, skip_subdirs=(), workers=1, stats=None, index=None, trust_index=False):
+    """Walk top, listing directories on a bounded pool of threads.
+
+    Parameters
+    ----------
+    top : str
+        Directory to walk.
+    skip_subdirs : iterable of str
+        Names of subdirectories that are not descended into, at any depth.
+    workers : int
+        Maximum number of directories listed concurrently.
+    stats : ScanStats, optional
+        Updated with the number of directories and files seen.
+    index : dict, optional
+        Maps directory paths to the DirectoryIndexEntry recorded by a previous walk.
+    trust_index : bool
+        Skip listing directories whose mtime matches index. When False, index is only used to
+        count directories that changed without a new mtime.
+
+    Yields
+    ------
+    DirectoryListing
+        One entry per directory, in completion order. filenames only holds regular files (or
+        symlinks to them) and listing holds the names of all entries; both are empty for
+        directories that were not listed because they are unchanged.
+    """
+    skip_subdirs = frozenset(skip_subdirs or ())
+    top = str(top)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="thumbtack-scan") as executor:
+        pending = {executor.submit(_scan_directory, top, index, trust_index)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                directory = future.result()
+                for subdir in directory.subdirs:
+                    if os.path.basename(subdir) not in skip_subdirs:
+                        pending.add(executor.submit(_scan_directory, subdir, index, trust_index))
+                if stats is not None:
+                    stats.directories += 1
+                    stats.files += len(directory.filenames)
+                    if directory.unchanged:
+                        stats.unchanged += 1
+                    elif index and directory.root in index:
+                        known = index[directory.root]
+                        if known.mtime_ns == directory.mtime_ns and known.entry_count != len(directory.listing):
+                            stats.missed_changes += 1
+                yield directory
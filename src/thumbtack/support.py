@@ -0,0 +1,59 @@
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from imagemounter_mitre import dependencies
+
+
+class SupportMatrix:
+    """Caches which of the tools imagemounter uses are installed, as reported by ``imount --check``.
+
+    The tools are checked in-process through imagemounter's own dependency list, several at a time, and the
+    result is kept for ``ttl`` seconds. Concurrent requests for an expired matrix wait for a single probe.
+    """
+
+    def __init__(self, ttl, workers):
+        self.ttl = ttl
+        self.workers = workers
+        self.libraries = None
+        self.last_probed = None
+        self.probe_seconds = None
+        self._lock = threading.Lock()
+
+    def _expired(self):
+        return self.last_probed is None or time.time() - self.last_probed >= self.ttl
+
+    def get(self):
+        """Return {tool: installed}, probing the system if the cached matrix has expired."""
+        if self._expired():
+            with self._lock:
+                if self._expired():
+                    self._probe()
+        return self.libraries
+
+    def refresh(self):
+        """Probe the system now, whether or not the cached matrix has expired."""
+        with self._lock:
+            self._probe()
+        return self.libraries
+
+    def refresh_in_background(self):
+        threading.Thread(target=self.refresh, name="thumbtack-support-probe", daemon=True).start()
+
+    def _probe(self):
+        deps = [dep for section in dependencies.ALL_SECTIONS for dep in section.deps]
+        start = time.perf_counter()
+        with ThreadPoolExecutor(self.workers, thread_name_prefix="thumbtack-support-probe") as pool:
+            available = list(pool.map(_is_available, deps))
+        self.probe_seconds = time.perf_counter() - start
+        self.libraries = {str(dep): is_available for dep, is_available in zip(deps, available)}
+        self.last_probed = time.time()
+
+
+def _is_available(dep):
+    try:
+        return bool(dep.is_available)
+    except Exception:
+        # e.g. a module named magic that is not python-magic, which imount --check reports as an error
+        return False
@@ -1,12 +1,18 @@
 import os
+import concurrent.futures
+import functools
 import json
 import pickle
 import re
 import sqlite3
 import subprocess
-import sys
+import threading
+import time
+import uuid
 
+from contextlib import contextmanager, nullcontext
 from pathlib import Path
+from types import MappingProxyType
 
 from flask import current_app, g
 
@@ -19,29 +25,38 @@ from .exceptions import (
     DuplicateMountAttemptError,
     EncryptedImageError,
     DuplicateVolumeGroupError,
+    MountWaitTimeoutError,
+    LeasedReferenceError,
 )
+from .jobs import set_phase
+from .mounter_strategy import format_signature, mount_hints
+from .mount_state import DiskState, dump_mount_state, load_mount_state
+from .mountinfo import find_mount, parse_mountinfo
+from .scanning import DirectoryIndexEntry, ScanStats, get_classifier, walk_image_dir
 
-def get_supported_libraries():
-    virtualenv_bin_directory = Path(sys.argv[0]).parent
-    imount_cmd = str(virtualenv_bin_directory / "imount")
-
-    run_args = [imount_cmd, "--check"]
-
-    current_app.logger.info(run_args)
-    output = subprocess.check_output(run_args).decode().split("\n")
-    outputjson = {}
-
-    for line in output:
-        line_split = line.split()
-        if len(line_split) > 0 and (
-            "MISSING" in line_split or "INSTALLED" in line_split
-        ):
-            if line_split[0] == "INSTALLED":
-                outputjson[str(line_split[1])] = True
-            else:
-                outputjson[str(line_split[1])] = False
+# An NBD device or one of its partitions, e.g. /dev/nbd3p1, capturing the device itself
+NBD_DEVICE = re.compile(r"^(/dev/nbd\d+)(p\d+)?$")
+
+# What follows the case name in a pretty mountpoint name: "-<index>-<label or fstype>[-<n>]"
+PRETTY_SUFFIX = re.compile(r"^(\d+(?:\.\d+)*)-.+$")
+
+# "Stale" marks volumes whose mountpoint vanished or stopped answering, see liveness.MountLiveness
+MOUNT_STATUS_CODES = ("Mounted", "Unable to mount", "Unmounted", "Manual mount", "Stale")
+
+# Bump when the layout of the stored image analysis changes, so older results are redone
+ANALYSIS_VERSION = 1
+
+# (status -> id, id -> status) for each database, see get_mount_codes
+_mount_codes = {}
 
-    return outputjson
+# Per-thread SQLite connections, see get_db. Bumping the generation makes threads reconnect.
+_thread_connections = threading.local()
+_connection_generation = 0
+
+
+def get_supported_libraries():
+    """Return {tool: installed} for the tools imagemounter uses, cached for SUPPORT_CACHE_TTL seconds."""
+    return current_app.support_matrix.get()
 
 
 def get_mount_info(image_path):
@@ -49,35 +64,128 @@ def get_mount_info(image_path):
     if not image_path:
         response = []
 
-        images = get_images(mounted=True)
+        images = get_images(mounted=True, with_state=True, with_volumes=False)
         for image_info in images:
-            rel_path = image_info["rel_path"]
-
-            ref_count = get_ref_count(rel_path)
-            parser = image_info["parser"]
-
-            response.append({"disk_info": parser.disks[0], "ref_count": ref_count})
+            response.append({"disk_info": image_info["mount_state"], "ref_count": image_info["ref_count"]})
         return response
 
     image_info = get_image_info(image_path)
 
     if not image_info:
         return None
-    parser = image_info["parser"]
 
-    disk_info = None
-    if not parser:
+    disk_info = image_info["mount_state"]
+    if not disk_info:
         return None
-    else:
-        disk_info = parser.disks[0]
 
-    ref_count = get_ref_count(image_path)
+    ref_count = image_info["ref_count"]
+    touch_mount(image_info["id"])
 
     response = {"disk_info": disk_info, "ref_count": ref_count}
 
     return response
 
 
+def touch_mount(image_id):
+    """Record that a mounted image was just used, for the idle mount reaper."""
+    sql = """INSERT INTO mount_access (disk_id, last_access) VALUES (?, ?)
+             ON CONFLICT(disk_id) DO UPDATE SET last_access = excluded.last_access"""
+    update_or_insert_db(sql, [image_id, time.time()])
+
+
+def get_last_access(image_id):
+    row = query_db("SELECT last_access FROM mount_access WHERE disk_id = ?", [image_id], one=True)
+    return row["last_access"] if row else None
+
+
+def get_mounts_by_last_access():
+    """List the images mounted by Thumbtack, least recently used first, and whether they hold an NBD device."""
+    sql = """SELECT d.id, d.rel_path, d.ref_count, a.last_access,
+                    json_extract(d.mount_state, '$.device_paths.nbd') IS NOT NULL AS uses_nbd
+             FROM disk_images d
+             JOIN mount_status_codes s ON s.id = d.mount_status_id
+             LEFT JOIN mount_access a ON a.disk_id = d.id
+             WHERE s.status = 'Mounted'
+             ORDER BY COALESCE(a.last_access, 0), d.id"""
+    return query_db(sql)
+
+
+def grant_lease(relative_image_path, ttl):
+    """Record a reference to a mounted image that is released unless renewed within ttl seconds.
+
+    Returns the lease as a dict, or None if the image is not in the database.
+    """
+    image_info = get_image_info(relative_image_path, with_state=False)
+    if image_info is None:
+        return None
+    lease_id = uuid.uuid4().hex
+    expires = time.time() + ttl
+    update_or_insert_db(
+        "INSERT INTO leases (id, disk_id, ttl, expires) VALUES (?, ?, ?, ?)", [lease_id, image_info["id"], ttl, expires]
+    )
+    return {"lease_id": lease_id, "image_path": relative_image_path, "ttl": ttl, "expires": expires}
+
+
+def renew_lease(lease_id):
+    """Push back the expiry of a lease that has not expired yet by its ttl. Returns the lease, or None."""
+    now = time.time()
+    with transaction() as db:
+        row = db.execute(
+            "UPDATE leases SET expires = ? + ttl WHERE id = ? AND expires > ? RETURNING disk_id, ttl, expires",
+            [now, lease_id, now],
+        ).fetchone()
+        if row is None:
+            return None
+        touch_mount(row["disk_id"])
+        image = db.execute("SELECT rel_path FROM disk_images WHERE id = ?", [row["disk_id"]]).fetchone()
+    return {"lease_id": lease_id, "image_path": image["rel_path"], "ttl": row["ttl"], "expires": row["expires"]}
+
+
+def get_leases(lease_id=None, expired_before=None):
+    """List leases with their image paths, soonest to expire first."""
+    sql = """SELECT l.id AS lease_id, d.rel_path AS image_path, l.ttl, l.expires
+             FROM leases l
+             JOIN disk_images d ON d.id = l.disk_id"""
+    if lease_id is not None:
+        row = query_db(sql + " WHERE l.id = ?", [lease_id], one=True)
+        return dict(row) if row else None
+    if expired_before is not None:
+        rows = query_db(sql + " WHERE l.expires <= ? ORDER BY l.expires", [expired_before])
+    else:
+        rows = query_db(sql + " ORDER BY l.expires")
+    return [dict(row) for row in rows]
+
+
+def count_leases(image_id):
+    return query_db("SELECT COUNT(*) AS leases FROM leases WHERE disk_id = ?", [image_id], one=True)["leases"]
+
+
+def _save_leases(image_id):
+    return [tuple(row) for row in query_db("SELECT id, disk_id, ttl, expires FROM leases WHERE disk_id = ?", [image_id])]
+
+
+def _restore_leases(leases):
+    with transaction() as db:
+        db.executemany("INSERT OR IGNORE INTO leases (id, disk_id, ttl, expires) VALUES (?, ?, ?, ?)", leases)
+
+
+def release_lease(lease_id):
+    """Drop a lease and the reference it holds, unmounting its image if that was the last reference.
+
+    Returns False if there is no such lease, e.g. because it was already released.
+    """
+    lease = get_leases(lease_id)
+    if lease is None:
+        return False
+    with current_app.mount_locks.lock(lease["image_path"]):
+        with transaction() as db:
+            released = db.execute("DELETE FROM leases WHERE id = ?", [lease_id]).rowcount
+        if not released:
+            return False
+        unmount_image(lease["image_path"])
+    return True
+
+
 def get_ref_count(rel_path):
     ref_count = 0
     result = query_db(
@@ -89,29 +197,98 @@ def get_ref_count(rel_path):
 
 
 def decrement_ref_count(rel_path):
-    sql = "UPDATE disk_images SET ref_count = ref_count - 1 WHERE rel_path = ?"
-    update_or_insert_db(sql, [rel_path])
-    new_ref_count = get_ref_count(rel_path)
+    new_ref_count = _change_ref_count(rel_path, -1)
     current_app.logger.info(
         f"* Decreased ref count for {rel_path}. Now: {new_ref_count}"
     )
+    return new_ref_count
 
 
 def increment_ref_count(rel_path):
-    sql = "UPDATE disk_images SET ref_count = ref_count + 1 WHERE rel_path = ?"
-    update_or_insert_db(sql, [rel_path])
-    new_ref_count = get_ref_count(rel_path)
+    new_ref_count = _change_ref_count(rel_path, 1)
     current_app.logger.info(
         f"* Increased ref count for {rel_path}. Now: {new_ref_count}"
     )
+    return new_ref_count
+
 
+def _change_ref_count(rel_path, delta):
+    """Atomically add delta to an image's ref count and return the new count (None for unknown images)."""
+    with transaction() as db:
+        row = db.execute(
+            "UPDATE disk_images SET ref_count = ref_count + ? WHERE rel_path = ? RETURNING ref_count", [delta, rel_path]
+        ).fetchone()
+    return row["ref_count"] if row else None
 
 
-def process_image_parser(image_parser, relative_image_path):
+def _claim_mount(rel_path):
+    """Set the ref count of an unreferenced image to 1 to show a mount attempt is in progress.
+
+    Returns False if the image already has references, i.e. another mount attempt got there first.
+    """
+    with transaction() as db:
+        row = db.execute(
+            "UPDATE disk_images SET ref_count = 1 WHERE rel_path = ? AND ref_count = 0 RETURNING id", [rel_path]
+        ).fetchone()
+    return row is not None
+
+
+def _abandon_mount(rel_path, image_parser):
+    """Undo a mount attempt that failed after _claim_mount: clean up what it mounted and drop the claim."""
+    if image_parser is not None:
+        try:
+            image_parser.clean(allow_lazy=True)
+        except Exception:
+            current_app.logger.exception(f"Could not clean up the failed mount of {rel_path}")
+    update_or_insert_db("UPDATE disk_images SET ref_count = 0 WHERE rel_path = ?", [rel_path])
+
+
+def image_lock(func):
+    """Hold the lock for an image, passed as the first argument, while func runs.
+
+    Mounts and unmounts of the same image are serialized; different images do not wait for each other.
+    """
+
+    @functools.wraps(func)
+    def wrapper(relative_image_path, *args, **kwargs):
+        with current_app.mount_locks.lock(relative_image_path):
+            return func(relative_image_path, *args, **kwargs)
+
+    return wrapper
+
+
+# Filesystems that imagemounter attaches to a loop device itself: it picks a free one with `losetup -f`, attaches
+# it with a second losetup call and detaches it again if that fails, so two of them mounted at once could pick,
+# and then detach, the same device. Other filesystems are mounted with `mount -o loop`, which claims one atomically
+LOOP_DEVICE_FSTYPES = ("lvm", "luks", "raid", "ufs", "vmfs")
+
+
+def needs_device_lock(image_parser, analysis):
+    """Whether mounting image_parser may claim a shared NBD or loop device, which all mounts compete for.
+
+    Disks attached with qemu-nbd claim an NBD device, and volumes in LOOP_DEVICE_FSTYPES a loop device. An image
+    whose volumes the analysis could not tell apart may hold any of those. Other mounts, such as EWF images with
+    NTFS or ext volumes attached through ewfmount, claim neither and run without the lock.
+    """
+    for disk in image_parser.disks:
+        if "qemu-nbd" in disk._get_mount_methods(disk.get_disk_type()):
+            return True
+    if not analysis or not analysis["volumes"]:
+        return True
+    return any(volume["fstype"] is None or volume["fstype"] in LOOP_DEVICE_FSTYPES for volume in analysis["volumes"])
+
+
+def process_image_parser(image_parser, relative_image_path, single=None, analysis=None):
+    device_lock = nullcontext()
+    if needs_device_lock(image_parser, analysis):
+        set_phase("waiting for device lock")
+        device_lock = current_app.nbd_mutex
     # Volumes won't be mounted unless this generator is iterated
     try:
-        for _ in image_parser.init():
-            pass
+        with device_lock:
+            set_phase("mounting volumes")
+            for _ in image_parser.init(single):
+                pass
     except Exception:
         current_app.logger.info(f"* Error mounting volume in {relative_image_path}")
         pass
@@ -182,6 +359,43 @@ def process_image_parser(image_parser, relative_image_path):
     return image_parser
 
 def mount_image(relative_image_path, creds=None):
+    """Mount an image, or take a reference to it if it is already mounted.
+
+    Concurrent requests for the same image (and credentials) share one mount attempt: later requests
+    wait up to MOUNT_WAIT_TIMEOUT seconds for it, get its exception if it failed, and take a reference
+    to the mounted image if it succeeded.
+    """
+    key = (relative_image_path, tuple(sorted(creds.items())) if creds else None)
+    inflight_mounts = current_app.inflight_mounts
+    future, leader = inflight_mounts.join(key)
+
+    if not leader:
+        current_app.logger.info(f"* Waiting for the mount in progress for {relative_image_path}")
+        set_phase("waiting for mount in progress")
+        timeout = current_app.config["MOUNT_WAIT_TIMEOUT"]
+        try:
+            future.result(timeout=timeout)
+        except concurrent.futures.TimeoutError:
+            msg = f"* Timed out after {timeout}s waiting for the mount in progress for {relative_image_path}"
+            current_app.logger.error(msg)
+            raise MountWaitTimeoutError(msg)
+        # Takes the reference, or mounts again if the image was unmounted since
+        with current_app.reaper.reserve(relative_image_path):
+            return _mount_image(relative_image_path, creds)
+
+    try:
+        # Holds room within MAX_MOUNTS and MAX_NBD_DEVICES until the mount is done, evicting idle mounts if needed
+        with current_app.reaper.reserve(relative_image_path):
+            result = _mount_image(relative_image_path, creds)
+    except BaseException as e:
+        inflight_mounts.finish(key, exception=e)
+        raise
+    inflight_mounts.finish(key, result=result)
+    return result
+
+
+@image_lock
+def _mount_image(relative_image_path, creds=None):
     mount_dir = current_app.config["MOUNT_DIR"]
     if not mount_dir:
         msg = "Mount directory is not properly set by thumbtack server"
@@ -190,7 +404,7 @@ def mount_image(relative_image_path, creds=None):
 
     full_image_path = f"{current_app.config['IMAGE_DIR']}/{relative_image_path}"
 
-    image_info = get_image_info(relative_image_path)
+    image_info = get_image_info(relative_image_path, with_state=False)
 
     if not image_info:
         raise ImageNotInDatabaseError
@@ -204,9 +418,11 @@ def mount_image(relative_image_path, creds=None):
     # Check if the image is currently mounted
     if image_info["status"] == "Mounted" or image_info["status"] == "Manual mount":
         increment_ref_count(relative_image_path)
+        touch_mount(image_info["id"])
         current_app.logger.info(f"* {relative_image_path} is already mounted")
-        return image_info["parser"].disks[0]
-    elif get_ref_count(relative_image_path) == 1:
+        return get_mount_state(image_info["id"])
+    # Set reference count to 1 to indicate we currently attempting to mount the image.
+    elif not _claim_mount(relative_image_path):
         msg = f"* Mount attempt in progress for {relative_image_path}"
         current_app.logger.info(f"{msg}")
         raise DuplicateMountAttemptError(msg)
@@ -214,102 +430,111 @@ def mount_image(relative_image_path, creds=None):
     # Mount it
     current_app.logger.info(f'* Mounting image_path "{relative_image_path}"')
 
-    # Set reference count to 1 to indicate we currently attempting to mount the image.
-    sql = """UPDATE disk_images
-                 SET ref_count = 1
-                 WHERE rel_path = ?
-          """
-    update_or_insert_db(sql, [relative_image_path])
-
-    no_mountable_volumes = False
-    duplicate_vg = None
+    image_parser = None
     try:
-        image_parser = imagemounter_mitre.ImageParser(
-            [full_image_path], pretty=True, mountdir=mount_dir, keys=creds
+        # Skip the volume detection the background analyzer already did
+        analysis = get_image_analysis(image_info["id"], full_image_path)
+        hints = mount_hints(analysis)
+
+        # Try the mounter that worked for this format before first, instead of failing with the default every time
+        strategies = current_app.mounter_strategies
+        signature = analysis["signature"] if analysis else format_signature(full_image_path)
+        mounters = strategies.order(signature)
+        duplicate_vg = None
+        for attempt, disk_mounter in enumerate(mounters, 1):
+            image_parser = None
+            if attempt > 1:
+                set_phase(f"retrying with {disk_mounter}")
+            try:
+                image_parser = imagemounter_mitre.ImageParser(
+                    [full_image_path], pretty=True, mountdir=mount_dir, disk_mounter=disk_mounter, keys=creds,
+                    vstypes=hints.get("vstypes"),
+                )
+                image_parser = process_image_parser(
+                    image_parser, relative_image_path, single=hints.get("single"), analysis=analysis
+                )
+            except DuplicateVolumeGroupError as e:
+                duplicate_vg = e
+
+            except NoMountableVolumesError as e:
+                current_app.logger.error(f"fstypes: {image_parser.fstypes}.")
+                if attempt < len(mounters):
+                    current_app.logger.error(
+                        f"* No mountable volumes in image {relative_image_path} with {disk_mounter}. "
+                        f"Attempting to mount with {mounters[attempt]}"
+                    )
+                    continue
+                msg = f"* No mountable volumes in image {relative_image_path}"
+
+                for v in image_parser.disks[0].volumes:
+                    if "LUKS encrypted file" in str(v):
+                        if not creds:
+                            raise EncryptedImageError(
+                                "Encrypted LUKS volume detected. Try mounting with a decryption key."
+                            )
+                        else:
+                            raise EncryptedImageError(
+                                "Encrypted LUKS volume detected. Incorrect decryption key provided."
+                            )
+                raise NoMountableVolumesError(msg)
+
+            strategies.record(signature, disk_mounter, attempt)
+            current_app.logger.info(
+                f"* Mounted {relative_image_path} ({signature}) with {disk_mounter}, attempt {attempt}"
+            )
+            break
+
+        mount_codes = get_mount_codes()
+        disk_mount_status_id = (
+            mount_codes["Mounted"]
+            if image_parser.disks[0].mountpoint
+            else mount_codes["Unable to mount"]
         )
-        image_parser = process_image_parser(image_parser, relative_image_path)
-    except DuplicateVolumeGroupError as e:
-        duplicate_vg = e
-
-    except NoMountableVolumesError as e:
-        current_app.logger.error(f"fstypes: {image_parser.fstypes}.")
-        no_mountable_volumes = True
-        current_app.logger.error(f"* No mountable volumes in image {relative_image_path}. Attempting to mount with qemu-nbd")
-    if no_mountable_volumes:
-        try:
-            image_parser = imagemounter_mitre.ImageParser(
-                [full_image_path], pretty=True, mountdir=mount_dir, disk_mounter='qemu-nbd', keys=creds
+        # The pickled parser is only read back to tear the mount down, everything else reads mount_state
+        img_parser_pickle = pickle.dumps(image_parser)
+        disk_state = DiskState.from_disk(image_parser.disks[0])
+        mount_state = dump_mount_state(disk_state)
+
+        # log our success
+        current_app.logger.info(f"* Disk Mounted: {image_parser.disks[0].mountpoint}")
+
+        disk_image_id = image_info["id"]
+        volume_rows = []
+        for volume in image_parser.disks[0].volumes:
+            v_mountpoint = volume.mountpoint if volume.mountpoint else None
+            # these mount codes come from the init_db() function
+            mount_status_id = (
+                mount_codes["Mounted"] if v_mountpoint else mount_codes["Unable to mount"]
             )
-            image_parser = process_image_parser(image_parser, relative_image_path)
-        except NoMountableVolumesError as e:
-            current_app.logger.error(f"fstypes: {image_parser.fstypes}.")
-            no_mountable_volumes = True
-            msg = f"* No mountable volumes in image {relative_image_path}"
+            current_app.logger.info(f"  * Volume description: {volume.get_description()}")
+            current_app.logger.info(f"  * Volume mountpoint: {v_mountpoint}")
+            volume_rows.append((disk_image_id, mount_status_id, volume.index, v_mountpoint))
 
-            # Set ref count to 0 to indicate the mount attempt failed and is no longer in progress
+        # The disk and all of its volumes are recorded in one commit
+        set_phase("recording mount")
+        with transaction() as db:
             sql = """UPDATE disk_images
-                         SET ref_count = 0
+                         SET ref_count = 1, mountpoint = ?, mount_status_id = ?, parser = ?, mount_state = ?
                          WHERE rel_path = ?
                   """
-            update_or_insert_db(sql, [relative_image_path])
-
-            for v in image_parser.disks[0].volumes:
-                if "LUKS encrypted file" in str(v):
-                    if not creds:
-                        raise EncryptedImageError("Encrypted LUKS volume detected. Try mounting with a decryption key.")
-                    else:
-                        raise EncryptedImageError("Encrypted LUKS volume detected. Incorrect decryption key provided.")
-            raise NoMountableVolumesError(msg)
-
-    mount_codes = get_mount_codes()
-    disk_mount_status_id = (
-        mount_codes["Mounted"]
-        if image_parser.disks[0].mountpoint
-        else mount_codes["Unable to mount"]
-    )
-    img_parser_pickle = pickle.dumps(image_parser)
-
-    # log our success
-    current_app.logger.info(f"* Disk Mounted: {image_parser.disks[0].mountpoint}")
-    sql = """UPDATE disk_images
-                 SET ref_count = 1, mountpoint = ?, mount_status_id = ?, parser = ?
-                 WHERE rel_path = ?
-          """
-    update_or_insert_db(
-        sql,
-        [
-            image_parser.disks[0].mountpoint,
-            disk_mount_status_id,
-            sqlite3.Binary(img_parser_pickle),
-            relative_image_path,
-        ],
-    )
-
-    disk_image_id = image_info["id"]
-    for volume in image_parser.disks[0].volumes:
-        v_mountpoint = volume.mountpoint if volume.mountpoint else None
-        # these mount codes come from the init_db() function
-        mount_status_id = (
-            mount_codes["Mounted"] if v_mountpoint else mount_codes["Unable to mount"]
-        )
-        v_index = volume.index
-
-        current_app.logger.info(f"  * Volume description: {volume.get_description()}")
-        current_app.logger.info(f"  * Volume mountpoint: {v_mountpoint}")
-        sql = "SELECT * FROM volumes WHERE disk_id = ? AND partition_index = ?"
-        row = query_db(sql, [disk_image_id, v_index], one=True)
-
-        if row:
-            # UPDATE
-            sql = "UPDATE volumes SET mountpoint = ?, mount_status_id = ? WHERE disk_id = ? AND partition_index = ?"
-            update_or_insert_db(
-                sql, [v_mountpoint, mount_status_id, disk_image_id, v_index]
-            )
-        else:
-            sql = "INSERT INTO volumes (disk_id, mount_status_id, partition_index, mountpoint) VALUES (?, ?, ?, ?)"
-            update_or_insert_db(
-                sql, [disk_image_id, mount_status_id, v_index, v_mountpoint]
+            db.execute(
+                sql,
+                [
+                    image_parser.disks[0].mountpoint,
+                    disk_mount_status_id,
+                    sqlite3.Binary(img_parser_pickle),
+                    mount_state,
+                    relative_image_path,
+                ],
             )
+            upsert_volumes(db, volume_rows)
+            touch_mount(disk_image_id)
+    except Exception:
+        # Anything failing before the mount is recorded would leave the claim behind, and every later mount
+        # of the image would fail with DuplicateMountAttemptError
+        _abandon_mount(relative_image_path, image_parser)
+        raise
+    current_app.mount_registry.add(disk_image_id, mount_state, disk_state, image_parser)
 
     if e := duplicate_vg:
         current_app.logger.info(str(e))
@@ -317,9 +542,10 @@ def mount_image(relative_image_path, creds=None):
 
     return image_parser.disks[0]
 
+@image_lock
 def add_mountpoint(relative_image_path, mountpoint_path):
     # Get image information and mount codes
-    image_info = get_image_info(relative_image_path)
+    image_info = get_image_info(relative_image_path, with_state=False)
     mount_codes = get_mount_codes()
     disk_mount_status_id = (mount_codes["Manual mount"])
 
@@ -328,7 +554,7 @@ def add_mountpoint(relative_image_path, mountpoint_path):
 
     # Update disk_images table
     sql = """UPDATE disk_images
-                 SET ref_count = 1, mountpoint = ?, mount_status_id = ?, parser = ?
+                 SET ref_count = 1, mountpoint = ?, mount_status_id = ?, parser = ?, mount_state = ?
                  WHERE rel_path = ?
           """
 
@@ -351,44 +577,84 @@ def add_mountpoint(relative_image_path, mountpoint_path):
     #image_parser.disks.append(disk)
 
     img_parser_pickle = pickle.dumps(image_parser)
+    disk_state = DiskState.from_disk(disk, volumes=[volume])
+    mount_state = dump_mount_state(disk_state)
 
-    update_or_insert_db(
-        sql,
-        [
-            mountpoint_path,
-            disk_mount_status_id,
-            sqlite3.Binary(img_parser_pickle),
-            relative_image_path,
-        ],
-    )
-
-    # Update volumes
     disk_image_id = image_info["id"]
-    mount_status_id = (mount_codes["Manual mount"])
-    v_index = 0
-    sql = "INSERT INTO volumes (disk_id, mount_status_id, partition_index, mountpoint) VALUES (?, ?, ?, ?)"
-    update_or_insert_db(sql, [disk_image_id, mount_status_id, v_index, mountpoint_path])
+    with transaction() as db:
+        db.execute(
+            sql,
+            [
+                mountpoint_path,
+                disk_mount_status_id,
+                sqlite3.Binary(img_parser_pickle),
+                mount_state,
+                relative_image_path,
+            ],
+        )
+
+        # Update volumes
+        mount_status_id = (mount_codes["Manual mount"])
+        v_index = 0
+        upsert_volumes(db, [(disk_image_id, mount_status_id, v_index, mountpoint_path)])
+    current_app.mount_registry.add(disk_image_id, mount_state, disk_state, image_parser)
     return mountpoint_path
 
 
+def upsert_volumes(db, volume_rows):
+    """Insert or update (disk_id, mount_status_id, partition_index, mountpoint) rows in one statement."""
+    sql = """INSERT INTO volumes (disk_id, mount_status_id, partition_index, mountpoint) VALUES (?, ?, ?, ?)
+             ON CONFLICT(disk_id, partition_index)
+             DO UPDATE SET mount_status_id = excluded.mount_status_id, mountpoint = excluded.mountpoint
+          """
+    db.executemany(sql, volume_rows)
+
+
+@image_lock
 def unmount_image(relative_image_path, force=False):
-    image_info = get_image_info(relative_image_path)
-    mount_codes = get_mount_codes()
+    image_info = get_image_info(relative_image_path, with_state=False)
     ref_count = image_info["ref_count"]
 
-    if ref_count == 1 or force:
-        current_app.logger.info(f"* Unmounting {relative_image_path}")
-        if image_info["status"] == "Mounted":
-            image_parser = image_info["parser"]
+    # Leased references are only released through their lease, so that the lease does not later drop
+    # a reference that belongs to someone else
+    if not force and ref_count > 0 and count_leases(image_info["id"]) >= ref_count:
+        raise LeasedReferenceError(
+            f"Every reference to {relative_image_path} is held by a lease. Release it with DELETE /leases/<lease_id>."
+        )
+
+    if ref_count > 1 and not force:
+        if decrement_ref_count(relative_image_path) > 0:
+            return False
+        # The other references were released in the meantime, so this was the last one
+    # ref_count should only ever be 0 or greater, but anything less than 1 means it is not mounted
+    elif ref_count < 1 and not force:
+        current_app.logger.info(f"Image path {relative_image_path} is not mounted")
+        return True
+
+    current_app.logger.info(f"* Unmounting {relative_image_path}")
+    set_phase("unmounting")
+    if image_info["status"] == "Mounted":
+        image_parser = get_image_parser(image_info["id"])
+
+        image_parser.clean(allow_lazy=True)
+        current_app.logger.info(f"* Unmounted {relative_image_path} successfully")
+
+    mark_unmounted(image_info)
+    return True
 
-            image_parser.clean(allow_lazy=True)
-            current_app.logger.info(f"* Unmounted {relative_image_path} successfully")
 
+def mark_unmounted(image_info):
+    """Reset the database state of an image (and its volumes) to Unmounted."""
+    current_app.mount_registry.discard(image_info["id"])
+    mount_codes = get_mount_codes()
+    with transaction():
         sql = """UPDATE disk_images
-                     SET ref_count = 0, mountpoint = NULL, mount_status_id = ?, parser = NULL
-                     WHERE rel_path = ?
+                     SET ref_count = 0, mountpoint = NULL, mount_status_id = ?, parser = NULL, mount_state = NULL
+                     WHERE id = ?
                  """
-        update_or_insert_db(sql, [mount_codes["Unmounted"], relative_image_path])
+        update_or_insert_db(sql, [mount_codes["Unmounted"], image_info["id"]])
+        # Leases hold references to the mount that no longer exists
+        update_or_insert_db("DELETE FROM leases WHERE disk_id = ?", [image_info["id"]])
 
         if image_info["status"] == "Mounted":
             sql = """UPDATE volumes
@@ -401,19 +667,256 @@ def unmount_image(relative_image_path, force=False):
                      WHERE disk_id = ?
                  """
             update_or_insert_db(sql, [image_info["id"]])
-        return True
-    # ref_count should only ever be 0 or greater, but anything less than 1 means it is not mounted
-    elif ref_count < 1:
-        current_app.logger.info(f"Image path {relative_image_path} is not mounted")
-        return True
-    elif ref_count > 1:
-        decrement_ref_count(relative_image_path)
-        return False
+
+        # Only kept while mounted after IMAGE_DIR moved away from it (see save_scan_settings)
+        prefix = str(Path(current_app.config["IMAGE_DIR"])).rstrip("/") + "/"
+        if not image_info["full_path"].startswith(prefix):
+            update_or_insert_db("DELETE FROM disk_images WHERE id = ?", [image_info["id"]])
+
+
+def reconcile_mounts(mounts=None):
+    """Reset images whose mountpoints are no longer mounted, e.g. after a reboot or a manual umount.
+
+    Parameters
+    ----------
+    mounts : list of MountInfo, optional
+        The kernel mount table. Read from /proc/self/mountinfo if not given.
+
+    Returns
+    -------
+    tuple of int
+        The number of mounted images checked and the number that were reset.
+    """
+    if mounts is None:
+        mounts = parse_mountinfo()
+    if not mounts:
+        current_app.logger.warning("Could not read the mount table, keeping the stored mount state")
+        return 0, 0
+
+    mounted = {mount.mountpoint for mount in mounts}
+    images = get_images(mounted=True)
+    reset = 0
+    for image in images:
+        paths = [image["disk_mountpoint"]] + [volume["mountpoint"] for volume in image["volume_info"]]
+        paths = [os.path.realpath(path) for path in paths if path]
+        if any(path in mounted for path in paths):
+            continue
+        # Manual mountpoints are managed by the user and need not be mountpoints at all
+        if image["status"] == "Manual mount" and any(os.path.isdir(path) for path in paths):
+            continue
+
+        current_app.logger.info(f"{image['rel_path']} is no longer mounted, resetting its mount state")
+        mark_unmounted(image)
+        reset += 1
+    return len(images), reset
+
+
+def adopt_mounts(mounts=None):
+    """Register the mounts a previous run left under MOUNT_DIR as mounts of the images they came from.
+
+    imagemounter names volume mountpoints "<case name>-<index>-<label or fstype>", the case name being the image
+    file name without its extension. Mounts whose name matches exactly one image in the catalog are recorded as
+    Mounted with ref_count 1, along with the FUSE mount or NBD device behind them, so unmounting them later tears
+    them down like any other mount.
+
+    Parameters
+    ----------
+    mounts : list of MountInfo, optional
+        The kernel mount table. Read from /proc/self/mountinfo if not given.
+
+    Returns
+    -------
+    dict
+        How many images and volumes were adopted, and how many mounts matched no image or more than one.
+    """
+    mount_dir = os.path.realpath(current_app.config["MOUNT_DIR"])
+    if mounts is None:
+        mounts = parse_mountinfo()
+
+    by_case_name = {}
+    for image in get_images(with_state=False, with_volumes=False):
+        if image["status"] == "Unmounted":
+            by_case_name.setdefault(pretty_case_name(image["full_path"]), []).append(image)
+
+    adopted = {}
+    unmatched = ambiguous = 0
+    for mount in mounts:
+        if os.path.dirname(mount.mountpoint) != mount_dir:
+            continue
+        images, index = _match_pretty_mountpoint(os.path.basename(mount.mountpoint), by_case_name)
+        if not images:
+            unmatched += 1
+        elif len(images) > 1:
+            current_app.logger.warning(f"Not adopting {mount.mountpoint}: it could belong to {len(images)} images")
+            ambiguous += 1
+        else:
+            adopted.setdefault(images[0]["id"], (images[0], []))[1].append((index, mount))
+
+    for image, volume_mounts in adopted.values():
+        _register_adopted_mount(image, volume_mounts, mounts)
+        current_app.logger.info(f"Adopted {len(volume_mounts)} mounted volumes of {image['rel_path']}")
+
+    summary = {
+        "images": len(adopted),
+        "volumes": sum(len(volume_mounts) for _, volume_mounts in adopted.values()),
+        "unmatched": unmatched,
+        "ambiguous": ambiguous,
+    }
+    current_app.logger.info(
+        f"Adopted {summary['volumes']} mounts of {summary['images']} images under {mount_dir}, "
+        f"{unmatched} mounts matched no image and {ambiguous} more than one"
+    )
+    return summary
+
+
+def pretty_case_name(image_path):
+    """The case name imagemounter puts in pretty mountpoint names: the file name without its last extension."""
+    filename = os.path.basename(image_path)
+    return ".".join(filename.split(".")[:-1]) or filename
+
+
+def _match_pretty_mountpoint(name, by_case_name):
+    """Return (images, volume index) for a pretty mountpoint name, trying the longest case name first."""
+    position = len(name)
+    while (position := name.rfind("-", 0, position)) > 0:
+        images = by_case_name.get(name[:position])
+        match = PRETTY_SUFFIX.match(name[position + 1:])
+        if images and match:
+            return images, match.group(1)
+    return None, None
+
+
+def loop_backing_file(device):
+    """Return the file behind a loop device such as /dev/loop3, or None."""
+    try:
+        with open(f"/sys/block/{os.path.basename(device)}/loop/backing_file") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def _fuse_mountpoint(source, mounts):
+    """Return the FUSE mount (e.g. of ewfmount or xmount) holding the file behind a loop device, or None."""
+    backing_file = loop_backing_file(source)
+    mount = find_mount(backing_file, mounts) if backing_file else None
+    return mount.mountpoint if mount is not None and mount.fstype.startswith("fuse") else None
+
+
+def _register_adopted_mount(image, volume_mounts, mounts):
+    # Built by hand like in add_mountpoint, with what clean() needs to tear the mount down. The volumes are never
+    # detected again, so naming a volume detector saves imagemounter from looking for an installed one
+    image_parser = imagemounter_mitre.ImageParser(
+        [image["full_path"]], pretty=True, mountdir=current_app.config["MOUNT_DIR"], volume_detector="mmls"
+    )
+    disk = image_parser.disks[0]
+    volumes = []
+    for index, mount in sorted(volume_mounts, key=lambda item: [int(part) for part in item[0].split(".")]):
+        volume = imagemounter_mitre.volume.Volume(disk, index=index, volume_detector="mmls")
+        filesystem = imagemounter_mitre.filesystems.UnknownFileSystem(volume)
+        filesystem.type = mount.fstype
+        filesystem.mountpoint = mount.mountpoint
+        volume.filesystem = filesystem
+        volumes.append(volume)
+
+        nbd = NBD_DEVICE.match(mount.source)
+        if nbd:
+            disk._paths["nbd"] = nbd.group(1)
+        elif not disk.mountpoint and mount.source.startswith("/dev/loop"):
+            disk.mountpoint = _fuse_mountpoint(mount.source, mounts) or ""
+    disk.volumes = volumes
+
+    mount_codes = get_mount_codes()
+    disk_state = DiskState.from_disk(disk)
+    mount_state = dump_mount_state(disk_state)
+    with transaction() as db:
+        sql = """UPDATE disk_images
+                     SET ref_count = 1, mountpoint = ?, mount_status_id = ?, parser = ?, mount_state = ?
+                     WHERE id = ?
+              """
+        db.execute(
+            sql,
+            [disk.mountpoint or None, mount_codes["Mounted"], sqlite3.Binary(pickle.dumps(image_parser)), mount_state, image["id"]],
+        )
+        upsert_volumes(
+            db, [(image["id"], mount_codes["Mounted"], volume.index, volume.mountpoint) for volume in volumes]
+        )
+    current_app.mount_registry.add(image["id"], mount_state, disk_state, image_parser)
+
+
+def get_mounted_volumes():
+    """List the volumes of images mounted by Thumbtack (not manual mounts) that have a mountpoint.
+
+    disk_mountpoint is where the FUSE tool behind the image (ewfmount, xmount, ...) mounted it, if it needed one.
+    """
+    sql = """SELECT d.id AS disk_id, d.rel_path, d.mountpoint AS disk_mountpoint, v.partition_index, v.mountpoint,
+                    vs.status
+             FROM volumes v
+             JOIN disk_images d ON d.id = v.disk_id
+             JOIN mount_status_codes s ON s.id = d.mount_status_id
+             JOIN mount_status_codes vs ON vs.id = v.mount_status_id
+             WHERE s.status = 'Mounted' AND vs.status IN ('Mounted', 'Stale') AND v.mountpoint IS NOT NULL
+             ORDER BY d.id, v.partition_index"""
+    return query_db(sql)
+
+
+def set_volume_statuses(changes):
+    """Apply (status, disk_id, partition_index, mountpoint) changes in one transaction.
+
+    A row is only changed while it still has that mountpoint and is Mounted or Stale, so a volume that
+    was unmounted or remounted in the meantime keeps its new state.
+    """
+    mount_codes = get_mount_codes()
+    sql = """UPDATE volumes SET mount_status_id = ?
+             WHERE disk_id = ? AND partition_index = ? AND mountpoint = ? AND mount_status_id IN (?, ?)"""
+    with transaction() as db:
+        db.executemany(
+            sql,
+            [
+                (mount_codes[status], disk_id, index, mountpoint, mount_codes["Mounted"], mount_codes["Stale"])
+                for status, disk_id, index, mountpoint in changes
+            ],
+        )
+
+
+def remount_image(relative_image_path):
+    """Tear down the mount of an image and mount it again, keeping its references.
+
+    Used for stale mounts, e.g. after the FUSE process behind them died. The image lock is held
+    throughout, so nobody sees the image unmounted in between. Images that needed credentials to
+    mount cannot be remounted this way, as credentials are not stored.
+
+    Returns
+    -------
+    bool
+        False if the image was no longer mounted, so there was nothing to remount.
+    """
+    # The image does not count towards MAX_MOUNTS while it is unmounted, so its room is held throughout
+    with current_app.reaper.reserve(relative_image_path), current_app.mount_locks.lock(relative_image_path):
+        image_info = get_image_info(relative_image_path, with_state=False)
+        if image_info is None or image_info["status"] != "Mounted":
+            return False
+        ref_count = image_info["ref_count"]
+        # Unmounting drops the leases, which still hold their references once the image is mounted again
+        leases = _save_leases(image_info["id"])
+        current_app.logger.info(f"* Remounting {relative_image_path} with {ref_count} references")
+        try:
+            unmount_image(relative_image_path, force=True)
+        except Exception as e:
+            # Whatever is left of the old mount is unusable anyway
+            current_app.logger.warning(f"Could not cleanly unmount {relative_image_path}: {e}")
+            mark_unmounted(image_info)
+
+        _mount_image(relative_image_path)
+        if ref_count > 1:
+            _change_ref_count(relative_image_path, ref_count - 1)
+        if leases:
+            _restore_leases(leases)
+    return True
 
 
 def unmount_all(force=False):
     current_app.logger.info("Unmounting all mounted images")
-    images = get_images(mounted=True)
+    images = get_images(mounted=True, with_volumes=False)
 
     for image in images:
         msg = f"{image['rel_path']} is being forcefully unmounted with {image['ref_count']:d} outstanding references."
@@ -422,102 +925,223 @@ def unmount_all(force=False):
 
 
 def get_mount_codes():
-    mount_codes = {}
-    rows = query_db("SELECT * FROM mount_status_codes")
-    for row in rows:
-        mount_codes[row["status"]] = row["id"]
-    return mount_codes
+    """Map each mount status to its id. The codes are fixed by init_db, so they are read once per database."""
+    return _load_mount_codes()[0]
 
 
 def get_mount_status_by_id(mount_status_id):
-    status = None
-    result = query_db(
-        "SELECT status FROM mount_status_codes WHERE id = ?",
-        [mount_status_id],
-        one=True,
-    )
-    if result:
-        status = result["status"]
-    return status
+    return _load_mount_codes()[1].get(mount_status_id)
+
 
+def _load_mount_codes():
+    database = current_app.config["DATABASE"]
+    codes = _mount_codes.get(database)
+    if codes is None:
+        rows = query_db("SELECT id, status FROM mount_status_codes")
+        codes = (
+            MappingProxyType({row["status"]: row["id"] for row in rows}),
+            MappingProxyType({row["id"]: row["status"] for row in rows}),
+        )
+        _mount_codes[database] = codes
+    return codes
 
-def get_image_info(relative_image_path):
 
-    disk_image = query_db(
-        "SELECT * FROM disk_images WHERE rel_path = ?", [relative_image_path], one=True
-    )
+def get_image_info(relative_image_path, with_state=True):
+    images = _query_images("d.rel_path = ?", [relative_image_path], with_state=with_state)
+    return images[0] if images else None
 
-    if not disk_image:
+
+def get_images(mounted=False, with_state=False, with_volumes=True, with_analysis=False):
+    """List the disk images in the database with a single query.
+
+    Parameters
+    ----------
+    mounted : bool
+        Only list images with outstanding references.
+    with_state : bool
+        Include the DiskState of mounted images as mount_state.
+    with_volumes : bool
+        Include volume_info for mounted images.
+    with_analysis : bool
+        Include the background analysis of each image (None if not analyzed yet) as analysis.
+    """
+    where = "d.ref_count > 0" if mounted else None
+    return _query_images(where, with_state=with_state, with_volumes=with_volumes, with_analysis=with_analysis)
+
+
+def get_image_parser(image_id):
+    """Return the ImageParser that mounted an image. Only needed to tear the mount down.
+
+    This is the live object if the image was mounted by this process, and unpickled otherwise.
+    """
+    row = query_db("SELECT parser, mount_state FROM disk_images WHERE id = ?", [image_id], one=True)
+    if not row or not (row["parser"] or row["mount_state"]):
         return None
+    image_parser = current_app.mount_registry.get_parser(image_id, row["mount_state"])
+    if image_parser is None and row["parser"]:
+        image_parser = pickle.loads(row["parser"])
+    return image_parser
 
-    id_ = disk_image["id"]
-    rel_path = disk_image["rel_path"]
-    full_path = disk_image["full_path"]
-    filename = disk_image["filename"]
 
-    status = get_mount_status_by_id(disk_image["mount_status_id"])
+def get_mount_state(image_id):
+    row = query_db(
+        "SELECT mount_state, parser IS NOT NULL AS has_parser FROM disk_images WHERE id = ?", [image_id], one=True
+    )
+    return _decode_mount_state(image_id, row["mount_state"], row["has_parser"]) if row else None
 
-    disk_mountpoint = disk_image["mountpoint"]
 
-    volume_info = []
-    if status == "Mounted" or status == "Manual mount":
-        for volume in query_db(
-            "SELECT * FROM volumes WHERE disk_id = ? ORDER BY partition_index",
-            [disk_image["id"]],
-        ):
-            idx = volume["partition_index"]
+def _decode_mount_state(image_id, mount_state, has_parser):
+    # Legacy entries are registered under mount_state None, which an unmounted row has too
+    if not mount_state and not has_parser:
+        return None
+    registry = current_app.mount_registry
+    disk_state = registry.get_state(image_id, mount_state)
+    if disk_state is not None:
+        return disk_state
+
+    image_parser = None
+    if mount_state:
+        disk_state = load_mount_state(mount_state)
+    else:
+        # Mounted by a version of Thumbtack that only stored the pickled parser
+        image_parser = get_image_parser(image_id)
+        disk_state = DiskState.from_disk(image_parser.disks[0])
+    registry.add(image_id, mount_state, disk_state, image_parser)
+    return disk_state
+
+
+def _query_images(where=None, args=(), with_state=False, with_volumes=True, with_analysis=False):
+    """Build image_info dicts from one JOIN of disk_images, their status and (for mounted images) volumes."""
+    columns = [
+        "d.id", "d.rel_path", "d.full_path", "d.filename", "d.mountpoint AS disk_mountpoint", "d.ref_count",
+        "s.status",
+    ]
+    joins = ["LEFT JOIN mount_status_codes s ON s.id = d.mount_status_id"]
+    if with_state:
+        columns += ["d.mount_state", "d.parser IS NOT NULL AS has_parser"]
+    if with_analysis:
+        columns += ["a.analysis", "a.file_size", "a.file_mtime"]
+        joins += ["LEFT JOIN image_analysis a ON a.disk_id = d.id"]
+    if with_volumes:
+        columns += ["v.partition_index", "v.mountpoint AS volume_mountpoint", "vs.status AS volume_status"]
+        joins += [
+            "LEFT JOIN volumes v ON v.disk_id = d.id AND s.status IN ('Mounted', 'Manual mount')",
+            "LEFT JOIN mount_status_codes vs ON vs.id = v.mount_status_id",
+        ]
+
+    sql = f"SELECT {', '.join(columns)} FROM disk_images d {' '.join(joins)}"
+    if where:
+        sql += f" WHERE {where}"
+    sql += " ORDER BY d.id" + (", v.partition_index" if with_volumes else "")
 
+    images = []
+    image_info = None
+    for row in query_db(sql, args):
+        if image_info is None or image_info["id"] != row["id"]:
+            mount_state = None
+            if with_state:
+                mount_state = _decode_mount_state(row["id"], row["mount_state"], row["has_parser"])
+
+            image_info = {
+                "id": row["id"],
+                "rel_path": row["rel_path"],
+                "full_path": row["full_path"],
+                "filename": row["filename"],
+                "status": row["status"],
+                "disk_mountpoint": row["disk_mountpoint"],
+                "volume_info": [],
+                "ref_count": row["ref_count"],
+                "mount_state": mount_state,
+            }
+            if with_analysis:
+                image_info["analysis"] = _current_analysis(row["full_path"], row)
+            images.append(image_info)
+
+        if with_volumes and row["partition_index"] is not None:
             # uid is utilized by index.html as an HTML id, so no invalid characters accepted here
             sanitized_rel_file = (
-                rel_path.replace("/", "_").replace(":", "-").replace(".", "-")
+                row["rel_path"].replace("/", "_").replace(":", "-").replace(".", "-")
             )
-            uid = f"{sanitized_rel_file}_{volume['partition_index']}"
+            uid = f"{sanitized_rel_file}_{row['partition_index']}"
 
-            volume_info.append(
+            image_info["volume_info"].append(
                 {
-                    "index": idx,
-                    "mountpoint": volume["mountpoint"],
+                    "index": row["partition_index"],
+                    "mountpoint": row["volume_mountpoint"],
                     "uid": uid,
-                    "status": get_mount_status_by_id(volume["mount_status_id"]),
+                    "status": row["volume_status"],
                 }
             )
 
-    ref_count = disk_image["ref_count"]
-
-    parser = None
-    if disk_image["parser"]:
-        parser_bytes = disk_image["parser"]
-        parser = pickle.loads(parser_bytes)
-
-    image_info = {
-        "id": id_,
-        "rel_path": rel_path,
-        "full_path": full_path,
-        "filename": filename,
-        "status": status,
-        "disk_mountpoint": disk_mountpoint,
-        "volume_info": volume_info,
-        "ref_count": ref_count,
-        "parser": parser,
-    }
-    return image_info
+    return images
 
 
-def get_images(mounted=False):
-    images = []
+def get_images_to_analyze(retry_before, full_paths=(), outdated=True):
+    """List the images to analyze, oldest first.
 
-    if mounted:
-        sql = "SELECT * FROM disk_images WHERE ref_count > 0"
-    else:
-        sql = "SELECT * FROM disk_images"
+    Parameters
+    ----------
+    retry_before : float
+        Failed analyses made before this time are outdated.
+    full_paths : iterable of str
+        Images to list whatever their analysis, e.g. new or changed files. They are listed with needs_analysis
+        false if their analysis is current as far as the database knows, as only a stat of the file tells whether
+        it changed since (see analysis_is_current).
+    outdated : bool
+        Also list every image whose analysis is missing, outdated or failed before retry_before.
+    """
+    sql = """SELECT * FROM (
+                 SELECT d.id, d.full_path, a.file_size, a.file_mtime,
+                        a.disk_id IS NULL
+                        OR COALESCE(json_extract(a.analysis, '$.version'), 0) != ?
+                        OR (json_extract(a.analysis, '$.error') IS NOT NULL AND a.analyzed < ?) AS needs_analysis
+                 FROM disk_images d
+                 LEFT JOIN image_analysis a ON a.disk_id = d.id
+             )
+             WHERE full_path IN (SELECT value FROM json_each(?))"""
+    if outdated:
+        sql += " OR needs_analysis"
+    sql += " ORDER BY id"
+    return query_db(sql, [ANALYSIS_VERSION, retry_before, json.dumps(sorted(full_paths))])
+
+
+def save_image_analysis(image_id, stat, analysis):
+    """Store the analysis of an image, with the os.stat result of the file it was made from."""
+    sql = """INSERT OR REPLACE INTO image_analysis (disk_id, file_size, file_mtime, analyzed, analysis)
+             VALUES (?, ?, ?, ?, ?)"""
+    update_or_insert_db(sql, [image_id, stat.st_size, stat.st_mtime, time.time(), json.dumps(analysis)])
+
+
+def analysis_is_current(full_path, file_size, file_mtime, stat=None):
+    """Whether an analysis made from a file of file_size and file_mtime still describes the file at full_path."""
+    if stat is None:
+        try:
+            stat = os.stat(full_path)
+        except OSError:
+            return False
+    return (stat.st_size, stat.st_mtime) == (file_size, file_mtime)
 
-    for disk_image in query_db(sql):
-        # current_app.logger.info(f"(id: {disk_image['id']}) {disk_image['rel_path']}")
-        rel_path = disk_image["rel_path"]
 
-        images.append(get_image_info(rel_path))
+def _current_analysis(full_path, row):
+    """The analysis in row (with file_size, file_mtime and analysis), or None if it is outdated or missing."""
+    if not row or not row["analysis"]:
+        return None
+    analysis = json.loads(row["analysis"])
+    if analysis.get("version") != ANALYSIS_VERSION:
+        return None
+    if not analysis_is_current(full_path, row["file_size"], row["file_mtime"]):
+        # Scans only notice new files, so changed ones are queued for analysis when their analysis is read
+        current_app.analyzer.notify([full_path])
+        return None
+    return analysis
 
-    return images
+
+def get_image_analysis(image_id, full_path):
+    """Return the stored analysis of an image, or None if there is none, it is outdated or the file changed since."""
+    row = query_db(
+        "SELECT file_size, file_mtime, analysis FROM image_analysis WHERE disk_id = ?", [image_id], one=True
+    )
+    return _current_analysis(full_path, row)
 
 
 def insert_image(full_path):
@@ -532,33 +1156,22 @@ def insert_image(full_path):
     )
     if not disk_image:
         current_app.logger.debug(f"Inserting disk image into DB: {full_path}")
-        sql = "INSERT INTO disk_images (full_path, rel_path, filename, mount_status_id) VALUES (?, ?, ?, ?)"
+        sql = "INSERT OR IGNORE INTO disk_images (full_path, rel_path, filename, mount_status_id) VALUES (?, ?, ?, ?)"
         update_or_insert_db(sql, [full_path_str, rel_path_str, filename, mount_status])
     # else:
     #     current_app.logger.debug(f"({disk_image['id']}) already in DB: {full_path}")
 
 
-def insert_images():
-    skip_subdirs = None
-    try:
-        skip_subdirs = list(current_app.config["SKIP_SUBDIRECTORY"])
-    except (KeyError, TypeError):
-        pass
-
-    for root, dirs, files in os.walk(current_app.config["IMAGE_DIR"]):
-        if skip_subdirs:
-            dirs[:] = [d for d in dirs if d not in skip_subdirs]
-
-        for filename in files:
-
-            full_path = Path(root, filename)
-
-            if check_ignored(full_path):
-                remove_image(full_path)
-                continue
+def insert_images(top=None):
+    """Bring the images below top (IMAGE_DIR by default) in line with the files there.
 
-            if not filename.startswith(".") and full_path.is_file():
-                insert_image(full_path)
+    As before the catalog was reconciled in bulk, files that are now ignored (PATH_CONTAINS, SKIP_SUBDIRECTORY,
+    dotfiles) are removed along with files that are gone. Returns the full paths of the images added.
+    """
+    found = set(iter_image_files(top))
+    stored = get_image_paths(top)
+    reconcile_images(found, stored)
+    return found - stored
 
 
 def remove_image(full_path):
@@ -573,141 +1186,592 @@ def remove_image(full_path):
         update_or_insert_db(sql, [full_path_str])
 
 
+def refresh_image(full_path):
+    """Bring the database entry for a single file in line with what is on disk."""
+    full_path = Path(full_path)
+
+    if full_path.name.startswith(".") or not full_path.is_file() or check_ignored(full_path):
+        remove_image(full_path)
+    else:
+        insert_image(full_path)
+
+
+def remove_images_under(directory):
+    """Remove every disk image below directory from the database."""
+    prefix = str(directory).rstrip("/") + "/"
+    current_app.logger.debug(f"Removing disk images under {prefix} from DB")
+    sql = "DELETE FROM disk_images WHERE substr(full_path, 1, ?) = ?"
+    update_or_insert_db(sql, [len(prefix), prefix])
+
+
 def remove_images():
-    images_in_db = get_images()
-    full_path_filenames = []
+    found = set(iter_image_files())
+    reconcile_images(found, get_image_paths(), insert=False)
 
+
+# More efficent than calling insert_images then remove_images which will scan all files twice _and_ hit disk
+def monitor_image_dir(trust_index=True, stats=None):
+    """Bring the catalog in line with IMAGE_DIR. Returns the full paths of the images added."""
+    use_index = current_app.config["DIRECTORY_INDEX"]
+    trust_index = use_index and trust_index
+    index = load_directory_index() if use_index else None
+
+    directories = []
+    found = set(iter_image_files(index=index, trust_index=trust_index, directories=directories, stats=stats))
+    stored = get_image_paths()
+
+    # Images in directories that were not listed because they are unchanged are still on disk
+    unchanged = {directory.root for directory in directories if directory.unchanged}
+    if unchanged:
+        found.update(path for path in stored if (os.path.dirname(path) or ".") in unchanged)
+
+    reconcile_images(found, stored)
+
+    if use_index:
+        save_directory_index(index, directories)
+    return found - stored
+
+
+def iter_image_files(top=None, index=None, trust_index=False, directories=None, stats=None):
+    """Walk top (IMAGE_DIR by default) and yield the full path of every file that belongs in the database.
+
+    Parameters
+    ----------
+    top : str, optional
+        Directory to walk. Defaults to IMAGE_DIR.
+    index : dict, optional
+        Directory index from load_directory_index, see walk_image_dir.
+    trust_index : bool
+        Do not list directories whose mtime matches index. Their files are not yielded.
+    directories : list, optional
+        Receives the DirectoryListing of every directory walked.
+    stats : ScanStats, optional
+        Updated as the walk progresses, so other threads can report on it.
+    """
     skip_subdirs = None
     try:
         skip_subdirs = list(current_app.config["SKIP_SUBDIRECTORY"])
     except (KeyError, TypeError):
         pass
 
-    for root, dirs, files in os.walk(current_app.config["IMAGE_DIR"]):
-        if skip_subdirs:
-            dirs[:] = [d for d in dirs if d not in skip_subdirs]
+    if top is None:
+        top = current_app.config["IMAGE_DIR"]
+
+    classifier = get_image_classifier()
+    if stats is None:
+        stats = ScanStats(current_app.config["SCAN_WORKERS"])
+
+    # Build paths the same way Path(root, filename) does without creating a Path per file
+    for directory in walk_image_dir(str(Path(top)), skip_subdirs, stats.workers, stats, index, trust_index):
+        if directories is not None:
+            directories.append(directory)
+        for filename, full_path_str in classifier.included_files(directory.root, directory.filenames, directory.listing):
+            if not filename.startswith("."):
+                yield full_path_str
+
+    stats.finish()
+    current_app.last_scan = stats
+    if stats.missed_changes:
+        current_app.logger.warning(
+            f"{stats.missed_changes} directories changed without a new mtime since the last full scan"
+        )
+    current_app.logger.info(f"Scanned {top}: {stats}")
 
-        for filename in files:
-            full_path = Path(root, filename)
-            full_path_filenames.append(full_path)
 
-    # If image in DB is not on disk, remove it from DB
-    [
-        remove_image(image["full_path"])
-        for image in images_in_db
-        if Path(image["full_path"]) not in full_path_filenames
-    ]
+def load_directory_index():
+    index = {}
+    rows = query_db("SELECT path, parent, mtime_ns, entry_count FROM directories")
+    for row in rows:
+        index[row["path"]] = DirectoryIndexEntry(row["mtime_ns"], row["entry_count"], [])
+    for row in rows:
+        parent = index.get(row["parent"])
+        if parent is not None and row["path"] != row["parent"]:
+            parent.subdirs.append(row["path"])
+    return index
+
+
+def save_directory_index(index, directories):
+    """Record the mtime and entry count of every directory that was listed, and forget the ones that are gone."""
+    # Coarse timestamps (e.g. NFS, FAT) can hide a change made in the same tick as the listing,
+    # so recently modified directories are stored with an mtime that never matches.
+    settled_ns = time.time_ns() - current_app.config["DIRECTORY_INDEX_SETTLE_SECONDS"] * 1_000_000_000
+
+    rows = []
+    seen = set()
+    for directory in directories:
+        seen.add(directory.root)
+        if directory.unchanged or directory.mtime_ns is None:
+            continue
+        mtime_ns = directory.mtime_ns if directory.mtime_ns < settled_ns else -1
+        rows.append((directory.root, os.path.dirname(directory.root), mtime_ns, len(directory.listing)))
+
+    db = get_db()
+    with db:
+        db.executemany(
+            """INSERT INTO directories (path, parent, mtime_ns, entry_count) VALUES (?, ?, ?, ?)
+               ON CONFLICT(path) DO UPDATE SET mtime_ns = excluded.mtime_ns, entry_count = excluded.entry_count""",
+            rows,
+        )
+        db.executemany("DELETE FROM directories WHERE path = ?", [(path,) for path in index.keys() - seen])
 
 
-# More efficent than calling insert_images then remove_images which will scan all files twice _and_ hit disk
-def monitor_image_dir():
-    full_path_filenames = []
+def get_image_paths(top=None):
+    """The full paths of the images in the database below top (IMAGE_DIR by default).
 
-    skip_subdirs = None
-    try:
-        skip_subdirs = list(current_app.config["SKIP_SUBDIRECTORY"])
-    except (KeyError, TypeError):
-        pass
+    Images outside IMAGE_DIR, kept because they were mounted when it moved, are never listed, so that
+    reconciling the catalog with IMAGE_DIR leaves them alone.
+    """
+    if top is None:
+        top = current_app.config["IMAGE_DIR"]
+    prefix = str(Path(top)).rstrip("/") + "/"
+    rows = query_db("SELECT full_path FROM disk_images WHERE substr(full_path, 1, ?) = ?", [len(prefix), prefix])
+    return {row["full_path"] for row in rows}
+
+
+def reconcile_images(found, stored, insert=True, remove=True):
+    """Apply the difference between the image paths found on disk and those stored in the database.
+
+    All inserts and deletes are applied with executemany in a single transaction.
+
+    Parameters
+    ----------
+    found : set of str
+        Full paths of the disk images currently on disk.
+    stored : set of str
+        Full paths of the disk images currently in the database.
+    insert : bool
+        Insert images that are on disk but not in the database.
+    remove : bool
+        Remove images that are in the database but no longer on disk.
+
+    Returns
+    -------
+    tuple
+        Number of inserted and removed images.
+    """
+    to_insert = sorted(found - stored) if insert else []
+    to_remove = sorted(stored - found) if remove else []
+
+    if not to_insert and not to_remove:
+        return 0, 0
 
-    for root, dirs, files in os.walk(current_app.config["IMAGE_DIR"]):
-        if skip_subdirs:
-            dirs[:] = [d for d in dirs if d not in skip_subdirs]
+    image_dir = current_app.config["IMAGE_DIR"]
+    mount_status = get_mount_codes()["Unmounted"]
+    rows = [
+        (full_path, str(Path(full_path).relative_to(image_dir)), os.path.basename(full_path), mount_status)
+        for full_path in to_insert
+    ]
 
-        for filename in files:
+    db = get_db()
+    with db:
+        db.executemany(
+            "INSERT OR IGNORE INTO disk_images (full_path, rel_path, filename, mount_status_id) VALUES (?, ?, ?, ?)",
+            rows,
+        )
+        db.executemany(
+            "DELETE FROM disk_images WHERE full_path = ?", [(full_path,) for full_path in to_remove]
+        )
 
-            full_path = Path(root, filename)
-            full_path_filenames.append(full_path)
+    current_app.logger.debug(f"Inserted {len(to_insert)} and removed {len(to_remove)} disk images")
+    return len(to_insert), len(to_remove)
 
-            if check_ignored(full_path):
-                remove_image(full_path)
-                continue
 
-            if not filename.startswith(".") and full_path.is_file():
-                insert_image(full_path)
+def startup_remove_dirs(mounts=None):
+    """Unmount what a previous run left mounted under MOUNT_DIR, detach its NBD devices and remove the empty directories.
 
-    images_in_db = get_images()
-    # If image in DB is not on disk, remove it from DB
-    [
-        remove_image(image["full_path"])
-        for image in images_in_db
-        if Path(image["full_path"]) not in full_path_filenames
+    Only real mounts, as listed in the kernel mount table, are unmounted. Nested mounts (volumes inside a disk,
+    logical volumes inside a volume) go before the mounts containing them, with the mounts at each depth
+    unmounted CLEANUP_WORKERS at a time.
+
+    Parameters
+    ----------
+    mounts : list of MountInfo, optional
+        The kernel mount table. Read from /proc/self/mountinfo if not given.
+
+    Returns
+    -------
+    dict
+        How many mounts were found, unmounted or failed to unmount, how many NBD devices were detached, how many
+        directories were removed, and how long it took.
+    """
+    start = time.perf_counter()
+    mount_dir = os.path.realpath(current_app.config["MOUNT_DIR"])
+    if mounts is None:
+        mounts = parse_mountinfo()
+    # Mounts in the database were adopted at startup (see adopt_mounts) and are left alone
+    tracked = {
+        row["mountpoint"]
+        for row in query_db(
+            "SELECT mountpoint FROM volumes WHERE mountpoint IS NOT NULL "
+            "UNION SELECT mountpoint FROM disk_images WHERE mountpoint IS NOT NULL"
+        )
+    }
+    leftover = [
+        mount for mount in mounts
+        if mount.mountpoint.startswith(mount_dir.rstrip("/") + "/") and mount.mountpoint not in tracked
     ]
 
-def startup_remove_dirs():
-    for item in os.listdir(current_app.config["MOUNT_DIR"]):
-        path = Path(current_app.config["MOUNT_DIR"], item)
-        current_app.logger.info(path)
-        try:
-            current_app.logger.info(f"Unmounting: {path}")
-            subprocess.run(["umount", path])
-        except Exception as e:
-            current_app.logger.error(e)
+    by_depth = {}
+    for mount in leftover:
+        by_depth.setdefault(mount.mountpoint.count("/"), []).append(mount)
+
+    failed = set()
+    workers = current_app.config["CLEANUP_WORKERS"]
+    with concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix="thumbtack-cleanup") as pool:
+        for depth in sorted(by_depth, reverse=True):
+            level = by_depth[depth]
+            commands = [["umount", mount.mountpoint] for mount in level]
+            for mount, error in zip(level, pool.map(_run_cleanup_command, commands)):
+                if error:
+                    current_app.logger.error(f"Could not unmount {mount.mountpoint}: {error}")
+                    failed.add(mount.mountpoint)
+                else:
+                    current_app.logger.info(f"Unmounted: {mount.mountpoint}")
+
+        # Detach the NBD devices behind the mounts, unless one of their mounts is still there
+        nbd_devices = {}
+        for mount in leftover:
+            match = NBD_DEVICE.match(mount.source)
+            if match:
+                nbd_devices.setdefault(match.group(1), set()).add(mount.mountpoint)
+        detachable = sorted(device for device, mountpoints in nbd_devices.items() if not mountpoints & failed)
+        commands = [["qemu-nbd", "-d", device] for device in detachable]
+        detached = 0
+        for device, error in zip(detachable, pool.map(_run_cleanup_command, commands)):
+            if error:
+                current_app.logger.error(f"Could not detach {device}: {error}")
+            else:
+                current_app.logger.info(f"Detached: {device}")
+                detached += 1
+
+    removed = _remove_empty_dirs(mount_dir, failed | tracked)
+    summary = {
+        "mounts": len(leftover),
+        "unmounted": sum(1 for mount in leftover if mount.mountpoint not in failed),
+        "failed": len(failed),
+        "nbd_detached": detached,
+        "directories_removed": removed,
+        "seconds": time.perf_counter() - start,
+    }
+    current_app.logger.info(
+        f"Cleaned up {mount_dir} in {summary['seconds']:.2f}s: {summary['unmounted']} of {summary['mounts']} mounts "
+        f"unmounted, {detached} NBD devices detached, {removed} directories removed"
+    )
+    return summary
 
-        if os.path.isdir(path):
-            current_app.logger.info(path)
-            try:
-                current_app.logger.info(f"Removing: {path}")
-                os.rmdir(path)
-            except Exception as e:
-                current_app.logger.error(e)
+
+def _run_cleanup_command(args):
+    """Run a cleanup command from a worker thread, returning None on success or its error output."""
+    result = subprocess.run(args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if result.returncode:
+        return result.stderr.decode(errors="replace").strip() or f"exit status {result.returncode}"
+    return None
+
+
+def _remove_empty_dirs(mount_dir, keep):
+    """Remove the empty directories under mount_dir, deepest first, without descending into the mountpoints in keep."""
+    directories = []
+    for root, dirs, _ in os.walk(mount_dir):
+        dirs[:] = [name for name in dirs if os.path.join(root, name) not in keep]
+        directories.extend(os.path.join(root, name) for name in dirs)
+
+    removed = 0
+    for path in reversed(directories):
+        try:
+            os.rmdir(path)
+            removed += 1
+        except OSError:
+            # Not empty, e.g. because something in it is still mounted
+            pass
+    return removed
 
 
 def get_db():
     db = getattr(g, "_database", None)
     if db is None:
-        database_file = current_app.config["DATABASE"]
-        db = g._database = sqlite3.connect(database_file)
+        db = g._database = _get_thread_connection(current_app.config["DATABASE"])
+    return db
+
+
+def _get_thread_connection(database_file):
+    """Return this thread's connection to database_file, opening it on first use.
+
+    Connections are reused across app contexts on the same thread rather than opened per request.
+    """
+    connections = getattr(_thread_connections, "connections", None)
+    if connections is None:
+        connections = _thread_connections.connections = {}
+
+    generation, db = connections.get(database_file, (None, None))
+    if db is not None and generation != _connection_generation:
+        db.close()
+        db = None
+    if db is None:
+        db = sqlite3.connect(database_file)
         db.row_factory = sqlite3.Row
+        for pragma, value in current_app.config.get("SQLITE_PRAGMAS", {}).items():
+            db.execute(f"PRAGMA {pragma} = {value}")
+        connections[database_file] = (_connection_generation, db)
     return db
 
 
+def close_db_connections():
+    """Close this thread's connections and make every other thread reconnect on its next get_db().
+
+    Must be called before the database file is removed or replaced.
+    """
+    global _connection_generation
+    _connection_generation += 1
+    connections = getattr(_thread_connections, "connections", {})
+    for _, db in connections.values():
+        db.close()
+    connections.clear()
+
+
 def init_db():
     with current_app.app_context():
-        db = get_db()
-
-        sql = """
-        CREATE TABLE mount_status_codes (
-            id INTEGER PRIMARY KEY,
-            status TEXT NOT NULL
-            )"""
-        db.cursor().execute(sql)
-        db.commit()
+        create_schema()
+        save_scan_settings()
+        insert_images()
 
-        sql = """
-        CREATE TABLE disk_images (
-            id INTEGER PRIMARY KEY,
-            mount_status_id INTEGER NOT NULL,
-            full_path TEXT NOT NULL,
-            rel_path TEXT NOT NULL,
-            filename TEXT NOT NULL,
-            mountpoint TEXT,
-            ref_count INTEGER DEFAULT 0,
-            parser BLOB,
-            FOREIGN KEY(mount_status_id) REFERENCES mount_status_codes(id)
-            )"""
-        db.cursor().execute(sql)
-        db.commit()
 
-        sql = """
-        CREATE TABLE volumes (
-            id INTEGER PRIMARY KEY,
-            disk_id INTEGER NOT NULL,
-            mount_status_id INTEGER NOT NULL,
-            partition_index INTEGER,
-            mountpoint TEXT,
-            FOREIGN KEY(disk_id) REFERENCES disk_images(id),
-            FOREIGN KEY(mount_status_id) REFERENCES mount_status_codes(id)
-            )"""
-        db.cursor().execute(sql)
+def create_schema():
+    """Create any missing tables, indexes and status codes. Safe to run against an existing database."""
+    db = get_db()
+
+    sql = """
+    CREATE TABLE IF NOT EXISTS mount_status_codes (
+        id INTEGER PRIMARY KEY,
+        status TEXT NOT NULL
+        )"""
+    db.cursor().execute(sql)
+    db.commit()
+
+    sql = """
+    CREATE TABLE IF NOT EXISTS disk_images (
+        id INTEGER PRIMARY KEY,
+        mount_status_id INTEGER NOT NULL,
+        full_path TEXT NOT NULL,
+        rel_path TEXT NOT NULL,
+        filename TEXT NOT NULL,
+        mountpoint TEXT,
+        ref_count INTEGER DEFAULT 0,
+        parser BLOB,
+        mount_state TEXT,
+        FOREIGN KEY(mount_status_id) REFERENCES mount_status_codes(id)
+        )"""
+    db.cursor().execute(sql)
+    db.commit()
+
+    # Columns added since the first kept databases were created
+    columns = {row["name"] for row in db.execute("PRAGMA table_info(disk_images)")}
+    if "mount_state" not in columns:
+        db.execute("ALTER TABLE disk_images ADD COLUMN mount_state TEXT")
         db.commit()
 
-        # insert status codes
-        sql = "INSERT INTO mount_status_codes (status) VALUES (?)"
-        status_codes = ["Mounted", "Unable to mount", "Unmounted", "Manual mount"]
-        for code in status_codes:
-            update_or_insert_db(sql, [code])
+    sql = """
+    CREATE TABLE IF NOT EXISTS volumes (
+        id INTEGER PRIMARY KEY,
+        disk_id INTEGER NOT NULL,
+        mount_status_id INTEGER NOT NULL,
+        partition_index INTEGER,
+        mountpoint TEXT,
+        FOREIGN KEY(disk_id) REFERENCES disk_images(id),
+        FOREIGN KEY(mount_status_id) REFERENCES mount_status_codes(id)
+        )"""
+    db.cursor().execute(sql)
+    db.commit()
+
+    indexes = {row["name"] for row in db.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    if not {"mount_status_codes_status", "disk_images_full_path", "volumes_disk_partition"} <= indexes:
+        # Kept databases from before the unique indexes may hold duplicates that would fail to index
+        _remove_duplicate_rows(db)
+
+    for sql in [
+        "CREATE UNIQUE INDEX IF NOT EXISTS mount_status_codes_status ON mount_status_codes (status)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS disk_images_full_path ON disk_images (full_path)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS disk_images_rel_path ON disk_images (rel_path)",
+        # Partial index for get_images(mounted=True), which only wants the few images with references
+        "CREATE INDEX IF NOT EXISTS disk_images_referenced ON disk_images (id) WHERE ref_count > 0",
+        "CREATE UNIQUE INDEX IF NOT EXISTS volumes_disk_partition ON volumes (disk_id, partition_index)",
+    ]:
+        db.execute(sql)
+    db.commit()
+
+    sql = """
+    CREATE TRIGGER IF NOT EXISTS volumes_cleanup AFTER DELETE ON disk_images
+    BEGIN
+        DELETE FROM volumes WHERE disk_id = OLD.id;
+    END"""
+    db.cursor().execute(sql)
+    # Volumes of images deleted before the trigger existed, whose ids a new image could be given
+    db.execute("DELETE FROM volumes WHERE disk_id NOT IN (SELECT id FROM disk_images)")
+    db.commit()
+
+    sql = """
+    CREATE TABLE IF NOT EXISTS directories (
+        id INTEGER PRIMARY KEY,
+        path TEXT NOT NULL UNIQUE,
+        parent TEXT,
+        mtime_ns INTEGER NOT NULL,
+        entry_count INTEGER NOT NULL
+        )"""
+    db.cursor().execute(sql)
+    db.commit()
+
+    sql = """
+    CREATE TABLE IF NOT EXISTS settings (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL
+        )"""
+    db.cursor().execute(sql)
+    db.commit()
+
+    # What the background analyzer found out about an image without mounting it, as JSON. file_size and
+    # file_mtime tell whether the image changed since
+    sql = """
+    CREATE TABLE IF NOT EXISTS image_analysis (
+        disk_id INTEGER PRIMARY KEY,
+        file_size INTEGER NOT NULL,
+        file_mtime REAL NOT NULL,
+        analyzed REAL NOT NULL,
+        analysis TEXT NOT NULL
+        )"""
+    db.cursor().execute(sql)
+    sql = """
+    CREATE TRIGGER IF NOT EXISTS image_analysis_cleanup AFTER DELETE ON disk_images
+    BEGIN
+        DELETE FROM image_analysis WHERE disk_id = OLD.id;
+    END"""
+    db.cursor().execute(sql)
+    db.commit()
+
+    # When each image was last mounted, referenced or looked up, for the idle mount reaper
+    sql = """
+    CREATE TABLE IF NOT EXISTS mount_access (
+        disk_id INTEGER PRIMARY KEY,
+        last_access REAL NOT NULL
+        )"""
+    db.cursor().execute(sql)
+    sql = """
+    CREATE TRIGGER IF NOT EXISTS mount_access_cleanup AFTER DELETE ON disk_images
+    BEGIN
+        DELETE FROM mount_access WHERE disk_id = OLD.id;
+    END"""
+    db.cursor().execute(sql)
+    db.commit()
+
+    # References to mounted images that are released unless renewed before they expire, see grant_lease
+    sql = """
+    CREATE TABLE IF NOT EXISTS leases (
+        id TEXT PRIMARY KEY,
+        disk_id INTEGER NOT NULL,
+        ttl REAL NOT NULL,
+        expires REAL NOT NULL
+        )"""
+    db.cursor().execute(sql)
+    db.cursor().execute("CREATE INDEX IF NOT EXISTS leases_expires ON leases (expires)")
+    sql = """
+    CREATE TRIGGER IF NOT EXISTS leases_cleanup AFTER DELETE ON disk_images
+    BEGIN
+        DELETE FROM leases WHERE disk_id = OLD.id;
+    END"""
+    db.cursor().execute(sql)
+    db.commit()
+
+    # insert status codes
+    sql = "INSERT OR IGNORE INTO mount_status_codes (status) VALUES (?)"
+    db.executemany(sql, [(code,) for code in MOUNT_STATUS_CODES])
+    db.commit()
+    _mount_codes.pop(current_app.config["DATABASE"], None)
+
+
+def _remove_duplicate_rows(db):
+    """Remove the rows that the unique indexes of create_schema do not allow, keeping one of each.
+
+    Duplicate status codes are merged into the first one. Of images with the same full_path or rel_path,
+    the one with the most references is kept, and of volumes with the same disk and index, the newest.
+    """
+    with db:
+        duplicates = db.execute(
+            """SELECT c.id, MIN(f.id) AS first_id FROM mount_status_codes c
+               JOIN mount_status_codes f ON f.status = c.status
+               GROUP BY c.id HAVING c.id != MIN(f.id)"""
+        ).fetchall()
+        for row in duplicates:
+            for table in ("disk_images", "volumes"):
+                db.execute(f"UPDATE {table} SET mount_status_id = ? WHERE mount_status_id = ?", [row["first_id"], row["id"]])
+            db.execute("DELETE FROM mount_status_codes WHERE id = ?", [row["id"]])
+
+        for column in ("full_path", "rel_path"):
+            db.execute(
+                f"""DELETE FROM disk_images WHERE id NOT IN (
+                        SELECT id FROM (
+                            SELECT id, ROW_NUMBER() OVER (PARTITION BY {column} ORDER BY ref_count DESC, id) AS n
+                            FROM disk_images
+                        ) WHERE n = 1
+                    )"""
+            )
+        db.execute("DELETE FROM volumes WHERE disk_id NOT IN (SELECT id FROM disk_images)")
+        db.execute(
+            """DELETE FROM volumes WHERE id NOT IN (
+                   SELECT MAX(id) FROM volumes GROUP BY disk_id, partition_index
+               )"""
+        )
+
 
-        insert_images()
+def save_scan_settings():
+    """Record the settings that decide which files are in the catalog.
+
+    If they differ from the ones a kept database was built with, the directory index is cleared
+    so the next scan lists every directory again. When IMAGE_DIR moved, rel_path is recomputed for the
+    images in the new IMAGE_DIR and the images outside it are dropped, except mounted ones: those are
+    never unmounted from under their users, and stay in the database with their full_path as rel_path
+    until they are unmounted (see mark_unmounted).
+
+    Returns
+    -------
+    bool
+        True if the database was built with different settings.
+    """
+    image_dir = str(Path(current_app.config["IMAGE_DIR"]))
+    settings = {
+        "IMAGE_DIR": image_dir,
+        "PATH_CONTAINS": current_app.config.get("PATH_CONTAINS"),
+        "SKIP_SUBDIRECTORY": sorted(current_app.config.get("SKIP_SUBDIRECTORY") or []),
+    }
+    row = query_db("SELECT value FROM settings WHERE key = 'scan_settings'", one=True)
+    stored = json.loads(row["value"]) if row else None
+    if stored == settings:
+        return False
+
+    moved = stored and stored["IMAGE_DIR"] != image_dir
+    prefix = image_dir.rstrip("/") + "/"
+    mount_codes = get_mount_codes()
+    mounted = [mount_codes["Mounted"], mount_codes["Manual mount"]]
+
+    db = get_db()
+    with db:
+        db.execute(
+            "INSERT INTO settings (key, value) VALUES ('scan_settings', ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            [json.dumps(settings)],
+        )
+        db.execute("DELETE FROM directories")
+        if moved:
+            db.execute(
+                """DELETE FROM disk_images
+                   WHERE substr(full_path, 1, ?) != ? AND ref_count = 0 AND mount_status_id NOT IN (?, ?)""",
+                [len(prefix), prefix, *mounted],
+            )
+            db.execute(
+                """UPDATE disk_images
+                   SET rel_path = CASE WHEN substr(full_path, 1, ?) = ? THEN substr(full_path, ?) ELSE full_path END""",
+                [len(prefix), prefix, len(prefix) + 1],
+            )
+    if stored:
+        current_app.logger.info("Scan settings changed since the database was built, relisting every directory")
+    return stored is not None
 
 
 def query_db(query, args=(), one=False):
@@ -718,94 +1782,56 @@ def query_db(query, args=(), one=False):
 
 
 def update_or_insert_db(sql, args=()):
-    get_db().execute(sql, args)
-    get_db().commit()
+    """Execute a write, committing it unless it is part of a transaction()."""
+    db = get_db()
+    db.execute(sql, args)
+    if not getattr(g, "_transaction_depth", 0):
+        db.commit()
+
+
+@contextmanager
+def transaction():
+    """Group writes into one unit of work that is committed once, or rolled back if anything raises.
+
+    Nested transactions join the outermost one. Yields the connection.
+    """
+    db = get_db()
+    depth = getattr(g, "_transaction_depth", 0)
+    if depth == 0 and not db.in_transaction:
+        # Take the write lock up front so the unit of work cannot fail halfway on a busy database
+        db.execute("BEGIN IMMEDIATE")
+    g._transaction_depth = depth + 1
+    try:
+        yield db
+    except BaseException:
+        if depth == 0:
+            db.rollback()
+        raise
+    else:
+        if depth == 0:
+            db.commit()
+    finally:
+        g._transaction_depth = depth
 
 
-# @current_app.teardown_appcontext
 def close_connection(exception):
+    # The connection stays open for the next app context on this thread, so don't leave a transaction behind
     db = getattr(g, "_database", None)
-    if db is not None:
-        db.close()
+    if db is not None and db.in_transaction:
+        db.rollback()
 
 
-def check_ignored(full_path):
+def check_ignored(full_path, dir_names=None):
     full_path_str = str(full_path)
 
     if os.path.isdir(full_path_str):
         return True
 
-    # Ignore .EXX.txt files
-    # Ignore .EXX.adcf files
-    # Ignore .EXX.log and .EXX.packed_log files
-    if re.match(r".*\.[EL]X?\w\w\.(txt|adcf|(packed_)?log)$", full_path_str, flags=re.I):
-        return True
-
-    # Ignore files: .txt, .packed_log, .log
-    exclude = [".txt", ".log", ".packed_log"]
-    for ign in exclude:
-        if full_path_str.lower().endswith(ign):
-            return True
-
-    # Include .raw files
-    if (
-        re.match(r".*raw$", full_path_str, flags=re.I)
-    ):
-        return False
-
-    # Include .img files
-    if (
-        re.match(r".*img$", full_path_str, flags=re.I)
-    ):
-        file_basename = os.path.basename(full_path_str).split('.')[0].lower()
-
-        check_files = [f'{file_basename}.{ext}'.lower() for ext in ['e01', 'imf']]
-        image_files = [file.lower() for file in os.listdir(os.path.dirname(full_path_str))]
-
-        # Return true if both .e01 and .imf files exist to ignore a multipart ewf file.
-        return all(file in image_files for file in check_files)
-
-
-    # Ignore *.db since the sqlite DB could be in this directory
-    if re.match(r".*\.db$", full_path_str, flags=re.I):
-        return True
-
-    # Ignore *.E02, *.E03, ..., *.EAA, *.EAB, ..., *.FAA, ..., *.GAA, ..., *.HAA, ... but not *.E01
-    if (
-        not full_path_str.lower().endswith("log")
-        and (re.match(r".*\.[EFGHIJKLMNOPQRSTUWXYZ]X?\w\w$", full_path_str, flags=re.I) or re.match(r".*\.[EFGHIJKLMNOPQRSTUWXYZ]X?\d\d+$", full_path_str, flags=re.I))
-        and not re.match(r".*\.[EL]X?01$", full_path_str, flags=re.I)
-    ):
-        return True
-
-    # Ignore *.002, *.003, ..., but not *.001
-    if re.match(r".*\.\d\d\d$", full_path_str) and not re.match(
-        r".*\.001$", full_path_str
-    ):
-        return True
-
-    # Ignore *-sXXX.vmdk, but not *.vmdk
-    if re.match(r".*\-s\w\w\w\.vmdk$", full_path_str, flags=re.I):
-        return True
-
-    # Ignore  *-1.vhd, *-2.vhd, ...,  *-N.vhd, but not *-0.vhd
-    if re.match(r".*\-\d+\.vhd$", full_path_str, flags=re.I) and not re.match(
-        r".*\-0\.vhd$", full_path_str, flags=re.I
-    ):
-        return True
+    return get_image_classifier().is_ignored(full_path_str, dir_names)
 
-    # Ignore file not matching path_contains if specified
-    path_contains = None
-    try:
-        path_contains = current_app.config["PATH_CONTAINS"]
-    except KeyError:
-        pass
-
-    # Ignore file paths not containing specified string if applicable
-    if path_contains is not None and path_contains not in full_path_str:
-        return True
 
-    return False
+def get_image_classifier():
+    return get_classifier(current_app.config.get("PATH_CONTAINS"))
 
 def create_key(method, key):
     if method is None or key is None:
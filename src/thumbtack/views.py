@@ -1,19 +1,25 @@
-import imagemounter_mitre.exceptions
-
-from flask import Blueprint, current_app, redirect, render_template, request
+from flask import Blueprint, current_app, redirect, render_template, request, url_for
 from flask_restful import Api
 
 import os
 
-from .exceptions import UnexpectedDiskError, NoMountableVolumesError, DuplicateMountAttemptError, EncryptedImageError, DuplicateVolumeGroupError
-from .resources import Mount, SupportedLibraries, Images, ImageDir, ManualMount
+from .resources import (
+    Mount,
+    MountBatch,
+    SupportedLibraries,
+    SupportedLibrariesRefresh,
+    Images,
+    ImageDir,
+    Lease,
+    ManualMount,
+    Status,
+    Jobs,
+    submit_mount_job,
+    submit_unmount_job,
+)
 from .utils import (
     get_supported_libraries,
     get_images,
-    mount_image,
-    unmount_image,
-    get_ref_count,
-    monitor_image_dir,
     add_mountpoint,
     create_key
 )
@@ -22,10 +28,15 @@ main = Blueprint("thumbtack", __name__)
 
 api = Api(main)
 api.add_resource(Mount, "/mounts/<path:image_path>", "/mounts/")
+api.add_resource(MountBatch, "/mounts/batch", endpoint="mount_batch")
 api.add_resource(SupportedLibraries, "/supported", endpoint="supported")
+api.add_resource(SupportedLibrariesRefresh, "/supported/refresh", endpoint="supported_refresh")
 api.add_resource(Images, "/images", endpoint="images")
 api.add_resource(ImageDir, "/image_dir")
 api.add_resource(ManualMount, "/add_mountpoint", endpoint="add_mountpoint")
+api.add_resource(Status, "/status", endpoint="status")
+api.add_resource(Jobs, "/jobs/<job_id>", "/jobs/", endpoint="job")
+api.add_resource(Lease, "/leases/<lease_id>", "/leases/", endpoint="lease")
 
 
 @main.route("/", methods=["GET"])
@@ -44,9 +55,12 @@ def index():
             unsupported_mount_types.append(mount_type)
 
     current_app.logger.debug("-------------- Getting images!!! --------------")
-    # On refresh, update DB to match what's on disk
-    monitor_image_dir()
-    images = get_images()
+    # Serve the catalog as of the last completed scan and refresh it in the background when asked to or stale
+    catalog = current_app.catalog
+    catalog_age = catalog.age()
+    if "refresh" in request.args or catalog_age is None or catalog_age > current_app.config["CATALOG_MAX_AGE"]:
+        catalog.schedule()
+    images = get_images(with_analysis=True)
     current_app.logger.debug("-------------- Got images!!! --------------")
 
     return render_template(
@@ -55,6 +69,8 @@ def index():
         unsupported_mount_types=unsupported_mount_types,
         image_dir=image_dir,
         images=images,
+        catalog_age=catalog_age,
+        catalog_scanning=catalog.running,
     )
 
 
@@ -63,8 +79,6 @@ def mount_form():
     rel_path = request.form["img_to_mount"]
     operation = request.form["operation"]
 
-    status = None
-
     if operation == "mount":
         decryption_method = request.form["decryption method"]
         key = request.form["key"]
@@ -77,48 +91,29 @@ def mount_form():
         else:
             creds = None
 
-        mounted_disk = None
-        duplicate_vg = False
-        try:
-            mounted_disk = mount_image(rel_path, creds)
-        except imagemounter_mitre.exceptions.SubsystemError:
-            current_app.logger.error("imagemounter was unable to mount: {}", rel_path)
-            status = f"Thumbtack was unable to mount {rel_path} using the imagemounter Python library."
-        except PermissionError:
-            current_app.logger.error(
-                "Permission error! Are you running with root privileges?"
-            )
-            status = f"Thumbtack does not have mounting privileges for {rel_path}. Are you running as root?"
-        except UnexpectedDiskError:
-            status = "Unexpected number of disks. Thumbtack can only handle disk images that contain one disk."
-        except NoMountableVolumesError:
-            status = f"No volumes in {rel_path} were able to be mounted."
-        except EncryptedImageError as e:
-            status = e
-        except NotADirectoryError:
-            status = "Mount failed. Thumbtack server has no mount directory set."
-        except DuplicateMountAttemptError:
-            status = "Mount attempt is already in progress for this image. Please wait until the current mount attempt completes."
-        except DuplicateVolumeGroupError as e:
-            status = f"Unable to mount all volumes. Found duplicate volume group name: {str(e)}. Deactivate the volume group and remount the image."
-            duplicate_vg = True
-        if mounted_disk and mounted_disk.mountpoint is not None:
-            if duplicate_vg:
-                status = ' '.join(["Mounted Successfully.", status])
-            status = "Mounted successfully"
+        job = submit_mount_job(rel_path, creds)
 
     elif operation == "unmount":
-
-        if unmount_image(rel_path):
-            status = "Unmounted successfully"
-        else:
-            ref_count = get_ref_count(rel_path)
-            status = f"{rel_path} is still mounted. Reference count is: {ref_count}"
+        job = submit_unmount_job(rel_path)
 
     else:
         current_app.logger.error("Unknown operation! How did you even get here!?")
         return redirect("/")
 
+    # Quick operations are reported on this page, long ones carry on in the background on the job pool
+    if not job.wait(current_app.config["FORM_JOB_WAIT"]):
+        status = f"The {operation} of {rel_path} is still running in the background."
+        return render_template("form_complete.html", status=status, job_url=url_for(".job", job_id=job.id))
+
+    if job.state == "failed":
+        status = job.error
+    elif operation == "mount":
+        status = "Mounted successfully"
+    elif job.result["unmounted"]:
+        status = "Unmounted successfully"
+    else:
+        status = f"{rel_path} is still mounted. Reference count is: {job.result['ref_count']}"
+
     if not status:
         status = "Unable to complete operation"
 
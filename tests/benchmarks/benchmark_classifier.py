@@ -0,0 +1,62 @@
+"""Microbenchmark of the legacy check_ignored rules against ImageClassifier.
+
+Run from the repository root:
+
+    python -m tests.benchmarks.benchmark_classifier [--dirs 200] [--files 100]
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from thumbtack.scanning import ImageClassifier
+from tests.unit.test_classifier import legacy_check_ignored
+
+EXTENSIONS = ["E01", "E02", "E03", "E01.txt", "dd", "001", "002", "img", "imf", "vmdk", "raw", "log"]
+
+
+def build_tree(top, num_dirs, num_files):
+    for d in range(num_dirs):
+        directory = os.path.join(top, f"case{d:05d}")
+        os.makedirs(directory)
+        for f in range(num_files):
+            open(os.path.join(directory, f"image{f // len(EXTENSIONS)}.{EXTENSIONS[f % len(EXTENSIONS)]}"), "w").close()
+
+
+def run_legacy(top):
+    ignored = 0
+    for root, _, files in os.walk(top):
+        for filename in files:
+            ignored += legacy_check_ignored(os.path.join(root, filename))
+    return ignored
+
+
+def run_classifier(top):
+    classifier = ImageClassifier()
+    included = 0
+    total = 0
+    for root, dirs, files in os.walk(top):
+        total += len(files)
+        included += sum(1 for _ in classifier.included_files(root, files, files + dirs))
+    return total - included
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dirs", type=int, default=200)
+    parser.add_argument("--files", type=int, default=100)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as top:
+        build_tree(top, args.dirs, args.files)
+        total = args.dirs * args.files
+
+        for name, func in [("legacy check_ignored", run_legacy), ("ImageClassifier", run_classifier)]:
+            start = time.perf_counter()
+            ignored = func(top)
+            elapsed = time.perf_counter() - start
+            print(f"{name:<22} {elapsed:8.3f}s  {total / elapsed:12,.0f} files/s  ({ignored} of {total} ignored)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""Compare catalog lookups and writes with and without the SQLite tuning in get_db and init_db.
+
+"legacy" drops the indexes, uses the default rollback journal and opens a new connection for
+every app context, as get_db did before connections were reused.
+
+Run from the repository root:
+
+    python -m tests.benchmarks.benchmark_database [--rows 10000 100000 1000000] [--lookups 200]
+"""
+import argparse
+import logging
+import os
+import random
+import tempfile
+import time
+
+from pathlib import Path
+
+from thumbtack import create_app
+from thumbtack.utils import close_db_connections, get_db, get_image_info, get_images, get_mount_codes, insert_image
+
+INDEXES = [
+    "mount_status_codes_status",
+    "disk_images_full_path",
+    "disk_images_rel_path",
+    "disk_images_referenced",
+    "volumes_disk_partition",
+]
+
+
+def populate(app, rows):
+    with app.app_context():
+        db = get_db()
+        codes = get_mount_codes()
+        image_dir = app.config["IMAGE_DIR"]
+        with db:
+            db.executemany(
+                "INSERT INTO disk_images (full_path, rel_path, filename, mount_status_id) VALUES (?, ?, ?, ?)",
+                (
+                    (f"{image_dir}/case{i // 100:05d}/image{i:07d}.E01", f"case{i // 100:05d}/image{i:07d}.E01",
+                     f"image{i:07d}.E01", codes["Unmounted"])
+                    for i in range(rows)
+                ),
+            )
+            db.execute(
+                "UPDATE disk_images SET mount_status_id = ?, ref_count = 1 WHERE id % ? = 0",
+                [codes["Manual mount"], max(1, rows // 10)],
+            )
+
+
+def make_legacy(app):
+    with app.app_context():
+        db = get_db()
+        for index in INDEXES:
+            db.execute(f"DROP INDEX {index}")
+        db.commit()
+        db.execute("PRAGMA journal_mode = DELETE")
+    close_db_connections()
+    app.config["SQLITE_PRAGMAS"] = {}
+    # Mimic a connection per app context, closing it after the other teardown functions have run
+    app.teardown_appcontext_funcs.insert(0, lambda exception: close_db_connections())
+
+
+def timed(app, calls, func):
+    start = time.perf_counter()
+    for i in range(calls):
+        with app.app_context():
+            func(i)
+    return (time.perf_counter() - start) / calls * 1000
+
+
+def run(top, rows, mode, lookups):
+    image_dir = Path(top) / "images"
+    image_dir.mkdir()
+    app = create_app(image_dir=str(image_dir), database=os.path.join(top, "thumbtack.db"))
+    app.logger.setLevel(logging.WARNING)
+    if mode == "legacy":
+        make_legacy(app)
+
+    populate(app, rows)
+    rel_paths = [f"case{i // 100:05d}/image{i:07d}.E01" for i in random.sample(range(rows), lookups)]
+
+    results = {
+        "get_image_info": timed(app, lookups, lambda i: get_image_info(rel_paths[i], with_parser=False)),
+        "insert_image": timed(app, lookups, lambda i: insert_image(image_dir / "new" / f"new{i:07d}.E01")),
+        "get_images(mounted)": timed(app, 20, lambda i: get_images(mounted=True, with_volumes=False)),
+    }
+    close_db_connections()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--lookups", type=int, default=200)
+    args = parser.parse_args()
+
+    print(f"{'rows':>9} {'mode':<7} {'operation':<20} {'ms/call':>9}")
+    for rows in args.rows:
+        for mode in ["legacy", "tuned"]:
+            with tempfile.TemporaryDirectory() as top:
+                for operation, ms in run(top, rows, mode, args.lookups).items():
+                    print(f"{rows:>9} {mode:<7} {operation:<20} {ms:9.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+"""Compare the pickled ImageParser blobs with the structured mount state stored for each mounted image.
+
+Run from the repository root:
+
+    python -m tests.benchmarks.benchmark_mount_state [--repeat 2000]
+"""
+import argparse
+import pickle
+import time
+
+from thumbtack.mount_state import DiskState, dump_mount_state, load_mount_state
+from tests.conftest import make_mounted_parser
+
+LAYOUTS = [
+    # (partitions, LVM logical volumes)
+    (1, 0),
+    (4, 0),
+    (2, 16),
+    (2, 64),
+]
+
+
+def time_per_call(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat * 1_000_000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=2000)
+    args = parser.parse_args()
+
+    print(f"{'volumes':>14} {'pickle bytes':>13} {'state bytes':>12} {'unpickle us':>12} {'load state us':>14}")
+    for partitions, logical_volumes in LAYOUTS:
+        image_parser = make_mounted_parser("/images/case.E01", partitions, logical_volumes)
+        blob = pickle.dumps(image_parser)
+        state = dump_mount_state(DiskState.from_disk(image_parser.disks[0]))
+
+        unpickle = time_per_call(lambda: pickle.loads(blob), args.repeat)
+        load = time_per_call(lambda: load_mount_state(state), args.repeat)
+        volumes = f"{partitions} + {logical_volumes} LVM"
+        print(f"{volumes:>14} {len(blob):>13,} {len(state):>12,} {unpickle:>12.1f} {load:>14.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""Count the SQL statements issued per request and per catalog update.
+
+Every sqlite3 connection opened by the app gets a trace callback, so the counts include
+lookups done inside helpers (such as mount status codes) as well as the main queries.
+
+Run from the repository root:
+
+    python -m tests.benchmarks.benchmark_queries [--images 500] [--repeat 20]
+"""
+import argparse
+import logging
+import os
+import sqlite3
+import tempfile
+
+from pathlib import Path
+
+from thumbtack import create_app
+from thumbtack.utils import monitor_image_dir, refresh_image, unmount_image
+
+statements = []
+
+
+def traced_connect(connect):
+    def wrapper(*args, **kwargs):
+        connection = connect(*args, **kwargs)
+        connection.set_trace_callback(statements.append)
+        return connection
+
+    return wrapper
+
+
+def count_statements(func, repeat):
+    func()
+    del statements[:]
+    for _ in range(repeat):
+        func()
+    return len(statements) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--images", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    sqlite3.connect = traced_connect(sqlite3.connect)
+
+    with tempfile.TemporaryDirectory() as top:
+        image_dir = Path(top) / "images"
+        image_dir.mkdir()
+        for i in range(args.images):
+            (image_dir / f"image{i:05d}.E01").touch()
+
+        app = create_app(image_dir=str(image_dir), database=os.path.join(top, "thumbtack.db"))
+        app.config["MOUNT_DIR"] = os.path.join(top, "mnt")
+        app.logger.setLevel(logging.WARNING)
+        client = app.test_client()
+
+        with app.app_context():
+            monitor_image_dir()
+            app.catalog.mark_current()
+
+            new_image = image_dir / "new.E01"
+
+            def refresh_new_image():
+                new_image.touch()
+                refresh_image(new_image)
+                new_image.unlink()
+                refresh_image(new_image)
+
+            benchmarks = [
+                ("GET /images", lambda: client.get("/images")),
+                ("GET /mounts/", lambda: client.get("/mounts/")),
+                ("DELETE /mounts/<unmounted image>", lambda: client.delete("/mounts/image00001.E01")),
+                ("unmount_image <unmounted image>", lambda: unmount_image("image00002.E01")),
+                ("refresh_image (create + delete)", refresh_new_image),
+            ]
+
+            print(f"{args.images} images, statements per call averaged over {args.repeat} calls")
+            for name, func in benchmarks:
+                print(f"{name:<36} {count_statements(func, args.repeat):8.1f}")
+
+
+if __name__ == "__main__":
+    main()
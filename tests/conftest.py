@@ -1,9 +1,14 @@
 import json
 import os
+import threading
+import time
 
+from types import SimpleNamespace
+
+import imagemounter_mitre
 import pytest
 
-from thumbtack import create_app
+from thumbtack import config, create_app, utils
 
 
 @pytest.fixture(scope='module')
@@ -33,3 +38,113 @@ def expected_test_results():
         disk_images = json.load(f)
 
     return disk_images
+
+
+def make_mounted_parser(image_path, num_volumes=3, lvm_volumes=0):
+    """Build an ImageParser that looks like it mounted image_path, without running any mount tools."""
+    parser = imagemounter_mitre.ImageParser(
+        [str(image_path)], pretty=True, mountdir="/mnt/thumbtack", volume_detector="parted"
+    )
+    disk = parser.disks[0]
+    disk.mountpoint = "/tmp/image_mounter_test"
+    disk._paths["nbd"] = "/dev/nbd0"
+    for i in range(num_volumes):
+        volume = disk.volumes._make_subvolume(index=str(i), size=1048576 * (i + 1), offset=2048 * i, fstype="ext")
+        volume.info.update(label=f"volume{i}", fsdescription="Linux (0x83)", statfstype="Ext4", lastmountpoint="/")
+        volume.filesystem.mountpoint = f"/mnt/thumbtack/case-{i}-volume{i}"
+
+    first_volume = disk.volumes.volumes[0]
+    for j in range(lvm_volumes):
+        lv = first_volume.volumes._make_subvolume(index=f"0.{j}", size=4096, offset=0, fstype="xfs")
+        lv.info.update(label=f"lv{j}", fsdescription="LVM logical volume")
+        lv.filesystem.mountpoint = f"/mnt/thumbtack/case-0.{j}-lv{j}"
+        # process_image_parser renumbers mounted LVM volumes and lists them after the partitions
+        lv.index = str(num_volumes + j)
+        disk.volumes.volumes.append(lv)
+    return parser
+
+
+# How long the fake mounter takes to mount the volumes of an image, and to attach its disk
+MOUNT_SECONDS = 0.3
+ATTACH_SECONDS = 0.01
+IMAGES = [f"case{i}.E01" for i in range(4)]
+
+
+class FakeMounter:
+    """Stands in for the imagemounter steps that process_image_parser runs, recording how they overlapped."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.attaching = 0
+        self.max_attaching = 0
+        self.mounting = 0
+        self.max_mounting = 0
+        self.mounts = 0
+
+    def attach(self, disk):
+        with self._lock:
+            self.attaching += 1
+            self.max_attaching = max(self.max_attaching, self.attaching)
+        time.sleep(ATTACH_SECONDS)
+        with self._lock:
+            self.attaching -= 1
+        return True
+
+    def init_volumes(self, disk):
+        with self._lock:
+            self.mounts += 1
+            self.mounting += 1
+            self.max_mounting = max(self.max_mounting, self.mounting)
+        time.sleep(MOUNT_SECONDS)
+        with self._lock:
+            self.mounting -= 1
+        yield from ()
+
+
+def save_analysis(rel_path, fstypes=("ntfs",)):
+    """Store an analysis of an EWF image that found volumes with the given filesystems."""
+    image = utils.get_image_info(rel_path, with_state=False)
+    volumes = [
+        {"index": i, "offset": 2048 * i, "size": 1048576, "description": "", "fstype": fstype}
+        for i, fstype in enumerate(fstypes)
+    ]
+    analysis = {
+        "version": utils.ANALYSIS_VERSION,
+        "signature": "ewf:.e01",
+        "segments": [image["filename"]],
+        "readable": True,
+        "volume_system": "dos",
+        "volumes": volumes,
+    }
+    utils.save_image_analysis(image["id"], os.stat(image["full_path"]), analysis)
+
+
+def fake_image_parser(paths, disk_mounter="auto", **kwargs):
+    parser = make_mounted_parser(paths[0], 2)
+    parser.disks[0].disk_mounter = disk_mounter
+    return parser
+
+
+@pytest.fixture()
+def fake_mounter(tmp_path, monkeypatch):
+    # The background thread is not started, so the analyses below are the ones mounts use
+    monkeypatch.setattr(config, "ANALYZE_IMAGES", False)
+    image_dir = tmp_path / "images"
+    image_dir.mkdir()
+    for filename in IMAGES:
+        (image_dir / filename).touch()
+    app = create_app(image_dir=str(image_dir), database=str(tmp_path / "thumbtack.db"))
+    app.config["MOUNT_DIR"] = str(tmp_path / "mnt")
+    with app.app_context():
+        for filename in IMAGES:
+            save_analysis(filename)
+
+    mounter = FakeMounter()
+    monkeypatch.setattr(utils, "imagemounter_mitre", SimpleNamespace(ImageParser=fake_image_parser))
+    monkeypatch.setattr(imagemounter_mitre.disk.Disk, "mount", lambda disk: mounter.attach(disk))
+    monkeypatch.setattr(
+        imagemounter_mitre.disk.Disk, "init_volumes", lambda disk, *args, **kwargs: mounter.init_volumes(disk)
+    )
+    monkeypatch.setattr(imagemounter_mitre.volume_system.VolumeSystem, "preload_volume_data", lambda self: None)
+    monkeypatch.setattr(imagemounter_mitre.ImageParser, "clean", lambda self, **kwargs: True)
+    return app, mounter
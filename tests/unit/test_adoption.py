@@ -0,0 +1,83 @@
+from types import SimpleNamespace
+
+import imagemounter_mitre
+import pytest
+
+from thumbtack import create_app, utils
+from thumbtack.mountinfo import MountInfo
+
+
+def mount(mount_id, mountpoint, source, fstype):
+    return MountInfo(mount_id, 1, "0:0", "/", str(mountpoint), "ro", fstype, source, "ro")
+
+
+@pytest.fixture()
+def adoption_app(tmp_path, monkeypatch):
+    image_dir = tmp_path / "images"
+    for image in ["case0.E01", "case1.E01", "my-disk-2.dd", "a/shared.dd", "b/shared.dd"]:
+        (image_dir / image).parent.mkdir(parents=True, exist_ok=True)
+        (image_dir / image).write_bytes(bytes(512))
+    mount_dir = tmp_path / "mnt"
+    mount_dir.mkdir()
+
+    app = create_app(image_dir=str(image_dir), database=str(tmp_path / "thumbtack.db"))
+    app.config["MOUNT_DIR"] = str(mount_dir)
+    # case0.E01 was mounted by ewfmount, whose raw image the loop devices read
+    backing_files = {"/dev/loop3": "/tmp/image_mounter_x1/ewf1", "/dev/loop4": "/tmp/image_mounter_x1/ewf1"}
+    monkeypatch.setattr(utils, "loop_backing_file", backing_files.get)
+    with app.app_context():
+        yield app, mount_dir
+
+
+def test_adopt_mounts(adoption_app, monkeypatch):
+    """
+    GIVEN volumes left mounted under MOUNT_DIR by a previous run, from an EWF image over FUSE and a raw image
+        over NBD, plus mounts matching no image and mounts matching two images with the same name
+    WHEN the mounts are adopted at startup
+    THEN the two images are registered as mounted with their volumes, the others are skipped,
+        the cleanup at startup leaves the adopted mounts alone, and unmounting an adopted image tears it down
+    """
+    app, mount_dir = adoption_app
+    mounts = [
+        mount(20, "/", "/dev/sda1", "ext4"),
+        mount(21, "/tmp/image_mounter_x1", "ewfmount", "fuse.ewfmount"),
+        mount(22, mount_dir / "case0-1-ntfs", "/dev/loop3", "ntfs3"),
+        mount(23, mount_dir / "case0-2-Data", "/dev/loop4", "vfat"),
+        mount(24, mount_dir / "my-disk-2-0-ext", "/dev/nbd2p1", "ext4"),
+        mount(25, mount_dir / "shared-1-ntfs", "/dev/loop5", "ntfs3"),
+        mount(26, mount_dir / "gone-1-ntfs", "/dev/loop6", "ntfs3"),
+    ]
+
+    summary = utils.adopt_mounts(mounts)
+    assert summary == {"images": 2, "volumes": 3, "unmatched": 1, "ambiguous": 1}
+
+    mounted = {info["disk_info"].paths[0]: info for info in utils.get_mount_info(None)}
+    case0 = mounted[app.config["IMAGE_DIR"] + "/case0.E01"]["disk_info"]
+    assert case0.mountpoint == "/tmp/image_mounter_x1"
+    assert [(v.index, v.fstype, v.mountpoint) for v in case0.volumes] == [
+        ("1", "ntfs3", str(mount_dir / "case0-1-ntfs")),
+        ("2", "vfat", str(mount_dir / "case0-2-Data")),
+    ]
+    assert utils.get_image_info("my-disk-2.dd")["ref_count"] == 1
+    assert utils.get_image_info("case1.E01")["status"] == "Unmounted"
+
+    commands = []
+    monkeypatch.setattr(
+        utils.subprocess, "run", lambda args, **kwargs: commands.append(args) or SimpleNamespace(returncode=0)
+    )
+    utils.startup_remove_dirs(mounts)
+    assert sorted(args[1] for args in commands) == [str(mount_dir / "gone-1-ntfs"), str(mount_dir / "shared-1-ntfs")]
+
+    commands.clear()
+    monkeypatch.setattr(imagemounter_mitre._util, "clean_unmount", lambda cmd, path, **kwargs: commands.append(cmd + [path]))
+    monkeypatch.setattr(imagemounter_mitre._util, "check_call_", lambda cmd, *args, **kwargs: commands.append(cmd))
+    utils.unmount_image("case0.E01")
+    utils.unmount_image("my-disk-2.dd")
+    assert commands == [
+        ["umount", str(mount_dir / "case0-2-Data")],
+        ["umount", str(mount_dir / "case0-1-ntfs")],
+        ["fusermount", "-u", "/tmp/image_mounter_x1"],
+        ["umount", str(mount_dir / "my-disk-2-0-ext")],
+        ["qemu-nbd", "-d", "/dev/nbd2"],
+    ]
+    assert utils.get_mount_info(None) == []
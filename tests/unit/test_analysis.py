@@ -0,0 +1,199 @@
+import os
+
+from types import SimpleNamespace
+
+import imagemounter_mitre
+import pytest
+
+from thumbtack import analysis, config, create_app, utils
+from thumbtack.analysis import analyze_image
+from tests.conftest import make_mounted_parser
+
+MIB = 1048576
+
+
+def mbr_entry(partition_type, start_sector, sectors):
+    return bytes(4) + bytes([partition_type]) + bytes(3) + start_sector.to_bytes(4, "little") + sectors.to_bytes(4, "little")
+
+
+def write_mbr_image(path, size=8 * MIB):
+    """A DOS partitioned image with an ext filesystem at sector 2048 and NTFS at sector 8192."""
+    image = bytearray(size)
+    image[446:462] = mbr_entry(0x83, 2048, 6144)
+    image[462:478] = mbr_entry(0x07, 8192, 8192)
+    image[510:512] = b"\x55\xaa"
+    image[2048 * 512 + 1080:2048 * 512 + 1082] = b"\x53\xef"
+    image[8192 * 512 + 3:8192 * 512 + 11] = b"NTFS    "
+    path.write_bytes(bytes(image))
+
+
+def write_gpt_image(path, size=4 * MIB):
+    """A GPT partitioned image with one FAT32 partition named "EFI system" from sector 2048 to 6143."""
+    image = bytearray(size)
+    image[446:462] = mbr_entry(0xEE, 1, size // 512 - 1)
+    image[510:512] = b"\x55\xaa"
+    header = b"EFI PART" + bytes(64) + (2).to_bytes(8, "little") + (4).to_bytes(4, "little") + (128).to_bytes(4, "little")
+    image[512:512 + len(header)] = header
+    entry = bytes(range(1, 17)) + bytes(16) + (2048).to_bytes(8, "little") + (6143).to_bytes(8, "little") + bytes(8)
+    entry += "EFI system".encode("utf-16-le")
+    image[1024:1024 + len(entry)] = entry
+    image[2048 * 512 + 82:2048 * 512 + 87] = b"FAT32"
+    path.write_bytes(bytes(image))
+
+
+def test_analyze_partitioned_images(tmp_path):
+    """
+    GIVEN raw images with a DOS partition table (split in two segments) and with a GPT partition table
+    WHEN they are analyzed
+    THEN the volume system, segments and the offset, size and filesystem of every partition are found
+    """
+    write_mbr_image(tmp_path / "whole.dd")
+    data = (tmp_path / "whole.dd").read_bytes()
+    (tmp_path / "split.001").write_bytes(data[:3 * MIB])
+    (tmp_path / "split.002").write_bytes(data[3 * MIB:])
+    write_gpt_image(tmp_path / "gpt.img")
+
+    split = analyze_image(str(tmp_path / "split.001"))
+    assert split["segments"] == ["split.001", "split.002"]
+    assert split["size"] == 8 * MIB
+    assert split["volume_system"] == "dos"
+    assert [(v["offset"], v["size"], v["fstype"]) for v in split["volumes"]] == [
+        (2048 * 512, 3 * MIB, "ext"),
+        (8192 * 512, 4 * MIB, "ntfs"),
+    ]
+    assert analyze_image(str(tmp_path / "whole.dd"))["volumes"] == split["volumes"]
+
+    gpt = analyze_image(str(tmp_path / "gpt.img"))
+    assert gpt["volume_system"] == "gpt"
+    assert gpt["volumes"] == [
+        {"index": 0, "offset": 2048 * 512, "size": 2 * MIB, "description": "EFI system", "fstype": "fat"}
+    ]
+
+
+def test_analyze_unpartitioned_and_unreadable_images(tmp_path):
+    """
+    GIVEN an image holding a single filesystem, an empty raw image and a VHDX image
+    WHEN they are analyzed
+    THEN the filesystem is reported as a single volume, the empty image has no volumes,
+        and the VHDX image only has its signature since it cannot be read without mounting it
+    """
+    (tmp_path / "fs.img").write_bytes(b"XFSB" + bytes(MIB))
+    (tmp_path / "empty.dd").write_bytes(bytes(MIB))
+    (tmp_path / "disk.vhdx").write_bytes(b"vhdxfile" + bytes(1024))
+
+    single = analyze_image(str(tmp_path / "fs.img"))
+    assert single["volume_system"] is None
+    assert [(v["offset"], v["fstype"]) for v in single["volumes"]] == [(0, "xfs")]
+    assert analyze_image(str(tmp_path / "empty.dd"))["volumes"] == []
+    vhdx = analyze_image(str(tmp_path / "disk.vhdx"))
+    assert (vhdx["signature"], vhdx["readable"], vhdx["volumes"]) == ("vhdx:.vhdx", False, [])
+
+
+@pytest.fixture()
+def analyzed_app(tmp_path, monkeypatch):
+    # The background thread is not started, so the test decides when images are analyzed
+    monkeypatch.setattr(config, "ANALYZE_IMAGES", False)
+    image_dir = tmp_path / "images"
+    image_dir.mkdir()
+    write_mbr_image(image_dir / "case.dd")
+    (image_dir / "fs.img").write_bytes(b"XFSB" + bytes(MIB))
+    app = create_app(image_dir=str(image_dir), database=str(tmp_path / "thumbtack.db"))
+    app.config["MOUNT_DIR"] = str(tmp_path / "mnt")
+    with app.app_context():
+        yield app, image_dir
+
+
+def test_analysis_is_stored_and_used_to_mount(analyzed_app, monkeypatch):
+    """
+    GIVEN images found by the catalog scan
+    WHEN the background analyzer has run
+    THEN their volumes are listed by /images and the index page before they are mounted, mount_image tells
+        imagemounter which volume system to use, and a changed image is not mounted with its old analysis
+    """
+    app, image_dir = analyzed_app
+    assert app.analyzer.analyze_pending() == 2
+    assert app.analyzer.analyze_pending() == 0
+
+    images = {image["rel_path"]: image for image in app.test_client().get("/images").get_json()}
+    assert [volume["fstype"] for volume in images["case.dd"]["analysis"]["volumes"]] == ["ext", "ntfs"]
+    assert "Detected volumes (dos)" in app.test_client().get("/").get_data(as_text=True)
+
+    calls = []
+    fake_imagemounter = SimpleNamespace(
+        ImageParser=lambda paths, **kwargs: calls.append(kwargs) or make_mounted_parser(paths[0], 1)
+    )
+    monkeypatch.setattr(utils, "imagemounter_mitre", fake_imagemounter)
+
+    def process_image_parser(image_parser, relative_image_path, single=None, **kwargs):
+        calls[-1]["single"] = single
+        return image_parser
+
+    monkeypatch.setattr(utils, "process_image_parser", process_image_parser)
+    monkeypatch.setattr(imagemounter_mitre.ImageParser, "clean", lambda self, **kwargs: True)
+
+    utils.mount_image("case.dd")
+    utils.mount_image("fs.img")
+    assert [(call["vstypes"], call["single"]) for call in calls] == [({"*": "dos"}, False), (None, True)]
+
+    utils.unmount_image("case.dd")
+    stat = os.stat(image_dir / "case.dd")
+    os.utime(image_dir / "case.dd", (stat.st_atime, stat.st_mtime + 10))
+    utils.mount_image("case.dd")
+    assert (calls[-1]["vstypes"], calls[-1]["single"]) == (None, None)
+
+
+def test_outdated_analyses_are_redone(analyzed_app, monkeypatch):
+    """
+    GIVEN analyzed images
+    WHEN an image file changes, an analysis was made by an older version, or an analysis failed
+    THEN /images stops listing the outdated analysis, and the analyzer redoes it (a changed file once its
+        analysis was read, a failed one only once ANALYSIS_RETRY_INTERVAL has passed)
+    """
+    app, image_dir = analyzed_app
+    client = app.test_client()
+    assert app.analyzer.analyze_pending() == 2
+
+    (image_dir / "fs.img").write_bytes(bytes(MIB))
+    images = {image["rel_path"]: image for image in client.get("/images").get_json()}
+    assert images["fs.img"]["analysis"] is None
+    assert images["case.dd"]["analysis"] is not None
+    assert app.analyzer.analyze_pending() == 1
+    images = {image["rel_path"]: image for image in client.get("/images").get_json()}
+    assert images["fs.img"]["analysis"]["volumes"] == []
+
+    monkeypatch.setattr(utils, "ANALYSIS_VERSION", utils.ANALYSIS_VERSION + 1)
+    monkeypatch.setattr(analysis, "ANALYSIS_VERSION", utils.ANALYSIS_VERSION)
+    assert app.analyzer.analyze_pending() == 2
+
+    def fail(path):
+        raise OSError("unreadable")
+
+    monkeypatch.setattr(analysis, "analyze_image", fail)
+    (image_dir / "fs.img").write_bytes(b"XFSB" + bytes(MIB))
+    assert app.analyzer.analyze_pending() == 0
+    assert utils.get_image_analysis(images["fs.img"]["id"], str(image_dir / "fs.img")) is None
+    assert app.analyzer.analyze_pending() == 1
+    assert app.analyzer.analyze_pending() == 0
+    app.config["ANALYSIS_RETRY_INTERVAL"] = 0
+    assert app.analyzer.analyze_pending() == 1
+    assert app.analyzer.failed == 2
+
+
+def test_only_new_and_outdated_images_are_looked_at(analyzed_app, monkeypatch):
+    """
+    GIVEN analyzed images
+    WHEN the analyzer runs again, and a scan finds a new image
+    THEN images with a current analysis are not even stat'ed, and the scan has only the new image analyzed
+    """
+    app, image_dir = analyzed_app
+    assert app.analyzer.analyze_pending() == 2
+
+    stats = []
+    monkeypatch.setattr(app.analyzer, "_analyze", lambda image: stats.append(image["full_path"]) or (None, None))
+    assert app.analyzer.analyze_pending() == 0
+    assert stats == []
+
+    write_mbr_image(image_dir / "new.dd")
+    app.catalog.scan()
+    app.analyzer.analyze_pending(outdated=False)
+    assert stats == [str(image_dir / "new.dd")]
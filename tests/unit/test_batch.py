@@ -0,0 +1,78 @@
+import json
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from tests.conftest import IMAGES
+
+
+def read_stream(response):
+    assert response.mimetype == "application/x-ndjson"
+    return [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+
+def test_batch_mount_and_unmount(fake_mounter):
+    """
+    GIVEN a Thumbtack Flask application client
+    WHEN a list of images, one of them unknown, is mounted and then unmounted with /mounts/batch
+    THEN a result is streamed for every image, no more than the requested number of mounts run at once,
+        and the unknown image fails without affecting the others
+    """
+    app, mounter = fake_mounter
+    client = app.test_client()
+    images = IMAGES + ["missing.E01"]
+
+    # Images can be given as paths or as objects with an image_path and an optional key
+    body = {"images": images[:2] + [{"image_path": image} for image in images[2:]], "concurrency": 2}
+    response = client.post("/mounts/batch", json=body)
+
+    results = {result["image_path"]: result for result in read_stream(response)}
+    assert set(results) == set(images)
+    assert [results[image]["status"] for image in IMAGES] == ["mounted"] * len(IMAGES)
+    assert results[IMAGES[0]]["disk_info"] == client.get(f"/mounts/{IMAGES[0]}").get_json()["disk_info"]
+    assert results["missing.E01"] == {
+        "image_path": "missing.E01",
+        "status": "failed",
+        "error": "Cannot mount missing.E01. Image is not in Thumbtack database.",
+    }
+    assert mounter.max_mounting == 2
+
+    results = read_stream(client.delete("/mounts/batch", json={"images": IMAGES}))
+    assert sorted(result["image_path"] for result in results) == sorted(IMAGES)
+    assert all(result["unmounted"] and result["ref_count"] == 0 for result in results)
+    assert client.get("/mounts/").get_json() == []
+
+
+def test_batch_rejects_bad_requests(fake_mounter):
+    """
+    GIVEN a Thumbtack Flask application client
+    WHEN /mounts/batch is called without a list of images or with an invalid concurrency
+    THEN it returns 400
+    """
+    app, _ = fake_mounter
+    client = app.test_client()
+
+    assert client.post("/mounts/batch").status_code == 400
+    assert client.post("/mounts/batch", json={"images": []}).status_code == 400
+    assert client.post("/mounts/batch", json={"images": [{"key": "secret"}]}).status_code == 400
+    assert client.delete("/mounts/batch", json={"images": IMAGES, "concurrency": "all"}).status_code == 400
+
+
+def test_batch_concurrency_is_shared_by_requests(fake_mounter):
+    """
+    GIVEN a Thumbtack Flask application with a BATCH_CONCURRENCY of 2
+    WHEN two batch requests, each allowed to mount 2 images at a time, run at the same time
+    THEN all their images are mounted, but no more than 2 at once across both requests
+    """
+    app, mounter = fake_mounter
+    app.config["BATCH_CONCURRENCY"] = 2
+    app.batch_slots = threading.BoundedSemaphore(2)
+
+    def mount_batch(images):
+        return read_stream(app.test_client().post("/mounts/batch", json={"images": images, "concurrency": 2}))
+
+    with ThreadPoolExecutor(2) as pool:
+        results = list(pool.map(mount_batch, [IMAGES[:2], IMAGES[2:]]))
+
+    assert [result["status"] for batch in results for result in batch] == ["mounted"] * len(IMAGES)
+    assert mounter.max_mounting == 2
@@ -0,0 +1,191 @@
+import threading
+import time
+
+import pytest
+
+from thumbtack import create_app, utils
+
+
+def wait_for_scan(app, passes, timeout=10):
+    """Wait until the catalog has been scanned more than passes times."""
+    deadline = time.time() + timeout
+    while app.catalog.passes <= passes:
+        assert time.time() < deadline, "catalog scan did not finish"
+        time.sleep(0.01)
+
+
+@pytest.fixture()
+def catalog_app(tmp_path):
+    image_dir = tmp_path / "images"
+    for image in ["a/one.E01", "a/two.dd", "b/three.E01"]:
+        (image_dir / image).parent.mkdir(parents=True, exist_ok=True)
+        (image_dir / image).touch()
+    app = create_app(image_dir=str(image_dir), database=str(tmp_path / "thumbtack.db"))
+    with app.app_context():
+        yield app, image_dir
+
+
+def test_image_dir_change_relists_the_catalog(catalog_app):
+    """
+    GIVEN a catalog with a directory index built for IMAGE_DIR
+    WHEN IMAGE_DIR is changed to one of its subdirectories through PUT /image_dir
+    THEN the directory index is cleared, the images outside the new IMAGE_DIR are dropped, and the catalog is
+        rescanned with paths relative to the new IMAGE_DIR
+    """
+    app, image_dir = catalog_app
+    app.catalog.scan()
+    assert utils.query_db("SELECT COUNT(*) AS n FROM directories", one=True)["n"] > 0
+
+    client = app.test_client()
+    assert client.put(f"/image_dir?image_dir={image_dir / 'a'}").status_code == 200
+    wait_for_scan(app, 1)
+
+    assert sorted(image["rel_path"] for image in utils.get_images()) == ["one.E01", "two.dd"]
+    assert [row["path"] for row in utils.query_db("SELECT path FROM directories")] == [str(image_dir / "a")]
+
+
+def test_scans_count_passes(catalog_app, monkeypatch):
+    """
+    GIVEN DIRECTORY_INDEX_VERIFY_INTERVAL of 2
+    WHEN the catalog is scanned three times
+    THEN the first and third scans list every directory, and the second trusts the directory index
+    """
+    app, _ = catalog_app
+    app.config["DIRECTORY_INDEX_VERIFY_INTERVAL"] = 2
+    trusted = []
+    monitor_image_dir = utils.monitor_image_dir
+    monkeypatch.setattr(
+        "thumbtack.directory_monitoring.monitor_image_dir",
+        lambda trust_index=True, **kwargs: trusted.append(trust_index) or monitor_image_dir(trust_index, **kwargs),
+    )
+
+    for _ in range(3):
+        app.catalog.scan()
+    assert trusted == [False, True, False]
+    assert app.catalog.passes == 3
+
+
+def test_iter_image_files(catalog_app):
+    """
+    GIVEN an image directory with images, dotfiles, ignored files and a skipped subdirectory
+    WHEN its files are listed, in whole or below a subdirectory
+    THEN only the images outside the skipped subdirectory are listed
+    """
+    app, image_dir = catalog_app
+    (image_dir / "a" / ".partial.dd").touch()
+    (image_dir / "a" / "notes.txt").touch()
+    (image_dir / "skip").mkdir()
+    (image_dir / "skip" / "four.E01").touch()
+    app.config["SKIP_SUBDIRECTORY"] = ["skip"]
+
+    assert sorted(utils.iter_image_files()) == [
+        str(image_dir / "a" / "one.E01"),
+        str(image_dir / "a" / "two.dd"),
+        str(image_dir / "b" / "three.E01"),
+    ]
+    assert sorted(utils.iter_image_files(str(image_dir / "b"))) == [str(image_dir / "b" / "three.E01")]
+
+
+def test_reconcile_images(catalog_app):
+    """
+    GIVEN a catalog of three images
+    WHEN it is reconciled with a set of found files, with and without removal
+    THEN new files are inserted with paths relative to IMAGE_DIR, missing ones are removed only when asked,
+        and get_image_paths lists the result, in whole or below a directory
+    """
+    app, image_dir = catalog_app
+    stored = utils.get_image_paths()
+    assert len(stored) == 3
+    added = str(image_dir / "b" / "added.dd")
+    found = stored - {str(image_dir / "a" / "two.dd")} | {added}
+
+    assert utils.reconcile_images(found, stored, remove=False) == (1, 0)
+    assert utils.get_image_info("b/added.dd")["filename"] == "added.dd"
+    assert utils.reconcile_images(found, utils.get_image_paths()) == (0, 1)
+    assert utils.reconcile_images(found, utils.get_image_paths()) == (0, 0)
+
+    assert utils.get_image_paths() == found
+    assert utils.get_image_paths(image_dir / "b") == {str(image_dir / "b" / "three.E01"), added}
+
+
+def test_insert_images_drops_ignored_images(catalog_app):
+    """
+    GIVEN a catalog of three images in two directories
+    WHEN PATH_CONTAINS is set so that one of them is ignored, and the images below its directory are inserted again
+    THEN the ignored image is removed, and images outside that directory are left alone
+    """
+    app, image_dir = catalog_app
+    app.config["PATH_CONTAINS"] = "one"
+
+    utils.insert_images(str(image_dir / "a"))
+    assert sorted(image["rel_path"] for image in utils.get_images()) == ["a/one.E01", "b/three.E01"]
+
+
+def test_concurrent_schedules_coalesce(catalog_app, monkeypatch):
+    """
+    GIVEN a catalog scanned two minutes ago and a background scan that has not finished yet
+    WHEN the catalog is scheduled again from several threads
+    THEN no other scan starts, and the age is reported from when the scan finished
+    """
+    app, _ = catalog_app
+    started, release = threading.Event(), threading.Event()
+    scans = []
+    monitor_image_dir = utils.monitor_image_dir
+
+    def slow_monitor_image_dir(**kwargs):
+        scans.append(kwargs)
+        started.set()
+        release.wait(10)
+        monitor_image_dir(**kwargs)
+
+    monkeypatch.setattr("thumbtack.directory_monitoring.monitor_image_dir", slow_monitor_image_dir)
+    app.catalog.completed -= 120
+
+    assert app.catalog.schedule()
+    assert started.wait(10)
+    threads = [threading.Thread(target=app.catalog.schedule) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert app.catalog.running
+    assert app.catalog.age() >= 120
+
+    release.set()
+    wait_for_scan(app, 0)
+    assert len(scans) == 1
+    assert app.catalog.passes == 1
+    assert 0 <= app.catalog.age() < 5
+
+
+def test_index_refreshes_stale_catalog(catalog_app, monkeypatch):
+    """
+    GIVEN the index page
+    WHEN it is loaded before any scan (as while a kept database is reconciled), right after one, with ?refresh, and once the catalog is older than
+        CATALOG_MAX_AGE
+    THEN a background scan is scheduled except right after a scan, and the page shows the age of the image list
+    """
+    app, _ = catalog_app
+    app.config["CATALOG_MAX_AGE"] = 60
+    scheduled = []
+    monkeypatch.setattr(app.catalog, "schedule", lambda: scheduled.append(True))
+    client = app.test_client()
+
+    app.catalog.completed = None
+    page = client.get("/").get_data(as_text=True)
+    assert "The image directory has not been scanned yet." in page
+    assert len(scheduled) == 1
+
+    app.catalog.scan()
+    page = client.get("/").get_data(as_text=True)
+    assert "Image list as of 0 seconds ago." in page
+    assert "one.E01" in page
+    assert len(scheduled) == 1
+
+    client.get("/?refresh=1")
+    assert len(scheduled) == 2
+
+    app.catalog.completed -= 120
+    page = client.get("/").get_data(as_text=True)
+    assert "Image list as of 120 seconds ago." in page
+    assert len(scheduled) == 3
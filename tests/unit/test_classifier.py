@@ -0,0 +1,188 @@
+import itertools
+import os
+import re
+
+import pytest
+
+from thumbtack.scanning import ImageClassifier
+
+
+def legacy_check_ignored(full_path, path_contains=None):
+    """Reference copy of check_ignored as it was before the rules were compiled into ImageClassifier."""
+    full_path_str = str(full_path)
+
+    if os.path.isdir(full_path_str):
+        return True
+
+    if re.match(r".*\.[EL]X?\w\w\.(txt|adcf|(packed_)?log)$", full_path_str, flags=re.I):
+        return True
+
+    exclude = [".txt", ".log", ".packed_log"]
+    for ign in exclude:
+        if full_path_str.lower().endswith(ign):
+            return True
+
+    if re.match(r".*raw$", full_path_str, flags=re.I):
+        return False
+
+    if re.match(r".*img$", full_path_str, flags=re.I):
+        file_basename = os.path.basename(full_path_str).split('.')[0].lower()
+
+        check_files = [f'{file_basename}.{ext}'.lower() for ext in ['e01', 'imf']]
+        image_files = [file.lower() for file in os.listdir(os.path.dirname(full_path_str))]
+
+        return all(file in image_files for file in check_files)
+
+    if re.match(r".*\.db$", full_path_str, flags=re.I):
+        return True
+
+    if (
+        not full_path_str.lower().endswith("log")
+        and (re.match(r".*\.[EFGHIJKLMNOPQRSTUWXYZ]X?\w\w$", full_path_str, flags=re.I) or re.match(r".*\.[EFGHIJKLMNOPQRSTUWXYZ]X?\d\d+$", full_path_str, flags=re.I))
+        and not re.match(r".*\.[EL]X?01$", full_path_str, flags=re.I)
+    ):
+        return True
+
+    if re.match(r".*\.\d\d\d$", full_path_str) and not re.match(
+        r".*\.001$", full_path_str
+    ):
+        return True
+
+    if re.match(r".*\-s\w\w\w\.vmdk$", full_path_str, flags=re.I):
+        return True
+
+    if re.match(r".*\-\d+\.vhd$", full_path_str, flags=re.I) and not re.match(
+        r".*\-0\.vhd$", full_path_str, flags=re.I
+    ):
+        return True
+
+    if path_contains is not None and path_contains not in full_path_str:
+        return True
+
+    return False
+
+
+CLASSIFICATION_CORPUS = [
+    # (filename, ignored)
+    ("disk.E01", False),
+    ("disk.e01", False),
+    ("disk.E02", True),
+    ("disk.E99", True),
+    ("disk.EAA", True),
+    ("disk.FAA", True),
+    ("disk.ZZZ", True),
+    ("disk.Ex01", False),
+    ("disk.Ex02", True),
+    ("disk.L01", False),
+    ("disk.L02", True),
+    ("disk.E100", True),
+    ("disk.E01.txt", True),
+    ("disk.E01.adcf", True),
+    ("disk.E01.log", True),
+    ("disk.E01.packed_log", True),
+    ("notes.txt", True),
+    ("NOTES.TXT", True),
+    ("acquisition.log", True),
+    ("acquisition.packed_log", True),
+    ("other.adcf", False),
+    ("disk.raw", False),
+    ("disk.RAW", False),
+    ("diskraw", False),
+    ("disk.E02.raw", False),
+    ("database.db", True),
+    ("database.DB", True),
+    ("disk.dd", False),
+    ("disk.001", False),
+    ("disk.002", True),
+    ("disk.999", True),
+    ("disk.0001", False),
+    ("disk.vmdk", False),
+    ("disk-s001.vmdk", True),
+    ("disk-flat.vmdk", False),
+    ("disk.vhd", False),
+    ("disk-0.vhd", False),
+    ("disk-1.vhd", True),
+    ("disk-10.vhd", True),
+    ("disk-1-0.vhd", False),
+    ("disk.vhdx", False),
+    ("disk.qcow2", False),
+    ("disk.iso", True),
+    ("disk.jpg", True),
+    ("disk.json", False),
+    ("disk.aff", False),
+    ("disk.vdi", False),
+    ("disk", False),
+]
+
+
+@pytest.mark.parametrize("filename,ignored", CLASSIFICATION_CORPUS)
+def test_classifier_corpus(tmp_path, filename, ignored):
+    """
+    GIVEN a file name from the classification corpus
+    WHEN it is classified by the legacy check_ignored rules and by ImageClassifier
+    THEN both agree with each other and with the expected result
+    """
+    full_path = tmp_path / filename
+    full_path.touch()
+
+    classifier = ImageClassifier()
+    assert legacy_check_ignored(full_path) == ignored
+    assert classifier.is_ignored(full_path) == ignored
+    assert classifier.is_ignored(full_path, os.listdir(tmp_path)) == ignored
+
+
+@pytest.mark.parametrize(
+    "siblings,ignored",
+    [
+        ([], False),
+        (["disk.E01"], False),
+        (["disk.imf"], False),
+        (["disk.E01", "disk.imf"], True),
+        (["DISK.e01", "Disk.IMF"], True),
+        (["other.E01", "other.imf"], False),
+    ],
+)
+def test_classifier_img_siblings(tmp_path, siblings, ignored):
+    """
+    GIVEN an .img file with a set of sibling files
+    WHEN it is classified with and without a directory listing supplied by the caller
+    THEN it is only ignored when both the .E01 and .imf parts of a multipart EWF set exist
+    """
+    full_path = tmp_path / "disk.img"
+    full_path.touch()
+    for sibling in siblings:
+        (tmp_path / sibling).touch()
+
+    classifier = ImageClassifier()
+    assert legacy_check_ignored(full_path) == ignored
+    assert classifier.is_ignored(full_path) == ignored
+
+    listing = os.listdir(tmp_path)
+    included = [name for name, _ in classifier.included_files(str(tmp_path), listing)]
+    assert ("disk.img" not in included) == ignored
+
+
+def test_classifier_matches_legacy_rules(tmp_path):
+    """
+    GIVEN every combination of a set of stems, extensions and PATH_CONTAINS values
+    WHEN each file is classified by the legacy check_ignored rules and by ImageClassifier
+    THEN the results are identical
+    """
+    stems = ["disk", "DISK", "case-s001", "image-0", "image-7", "a.b", "img", "raw"]
+    extensions = [
+        "", ".E01", ".e05", ".Ex01", ".EX10", ".L01", ".Lx02", ".E01.txt", ".L03.log", ".E04.adcf", ".txt",
+        ".log", ".packed_log", ".raw", ".img", ".db", ".dd", ".001", ".010", ".1234", ".vmdk", ".vhd",
+        ".vhdx", ".aff", ".ad1", ".iso", ".s01", ".V01", ".xml", ".csv", ".E1",
+    ]
+    for stem, extension in itertools.product(stems, extensions):
+        (tmp_path / f"{stem}{extension}").touch()
+
+    listing = os.listdir(tmp_path)
+    for path_contains in [None, "case", "image"]:
+        classifier = ImageClassifier(path_contains)
+        included = {full_path for _, full_path in classifier.included_files(str(tmp_path), listing)}
+        for name in listing:
+            full_path = str(tmp_path / name)
+            expected = legacy_check_ignored(full_path, path_contains)
+            assert classifier.is_ignored(full_path) == expected, name
+            assert (full_path not in included) == expected, name
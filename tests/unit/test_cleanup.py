@@ -0,0 +1,89 @@
+import os
+import threading
+import time
+
+from types import SimpleNamespace
+
+import pytest
+
+from thumbtack import create_app, utils
+from thumbtack.mountinfo import MountInfo
+
+UMOUNT_SECONDS = 0.1
+
+
+def mount(mount_id, mountpoint, source, fstype="ext4"):
+    return MountInfo(mount_id, 1, "0:0", "/", mountpoint, "rw", fstype, source, "rw")
+
+
+class FakeCommands:
+    """Records the umount and qemu-nbd commands run, failing for the paths in fail."""
+
+    def __init__(self, fail=()):
+        self.fail = set(fail)
+        self.calls = []
+        self.running = 0
+        self.max_running = 0
+        self._lock = threading.Lock()
+
+    def run(self, args, **kwargs):
+        with self._lock:
+            self.calls.append(args)
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(UMOUNT_SECONDS)
+        with self._lock:
+            self.running -= 1
+        if args[-1] in self.fail:
+            return SimpleNamespace(returncode=32, stderr=b"target is busy.")
+        return SimpleNamespace(returncode=0, stderr=b"")
+
+
+@pytest.fixture()
+def cleanup_app(tmp_path, monkeypatch):
+    mount_dir = tmp_path / "mnt"
+    for directory in ["disk0/lvm", "disk1", "disk2", "empty/nested", "files"]:
+        (mount_dir / directory).mkdir(parents=True)
+    (mount_dir / "files" / "notes.txt").write_text("not a mount")
+
+    app = create_app(image_dir=str(tmp_path), database=str(tmp_path / "thumbtack.db"))
+    app.config["MOUNT_DIR"] = str(mount_dir)
+    commands = FakeCommands(fail=[str(mount_dir / "disk1")])
+    monkeypatch.setattr(utils.subprocess, "run", commands.run)
+    with app.app_context():
+        yield mount_dir, commands
+
+
+def test_startup_cleanup(cleanup_app):
+    """
+    GIVEN a mount directory left behind with disks mounted from NBD devices, a logical volume mounted inside one
+        of them, a disk that cannot be unmounted, and directories that are not mounts
+    WHEN the mount directory is cleaned up at startup
+    THEN only the mounts are unmounted, nested ones first and the others in parallel, the NBD devices whose mounts
+        are all gone are detached, and every empty directory is removed
+    """
+    mount_dir, commands = cleanup_app
+    mounts = [
+        mount(20, "/", "/dev/sda1"),
+        mount(21, str(mount_dir), "tmpfs", "tmpfs"),
+        mount(22, str(mount_dir / "disk0"), "/dev/nbd0p1"),
+        mount(23, str(mount_dir / "disk0" / "lvm"), "/dev/mapper/vg-root"),
+        mount(24, str(mount_dir / "disk1"), "/dev/nbd1p2"),
+        mount(25, str(mount_dir / "disk2"), "xmount", "fuse.xmount"),
+    ]
+
+    start = time.perf_counter()
+    summary = utils.startup_remove_dirs(mounts)
+    elapsed = time.perf_counter() - start
+
+    unmounted = [args[1] for args in commands.calls if args[0] == "umount"]
+    assert unmounted[0] == str(mount_dir / "disk0" / "lvm")
+    assert sorted(unmounted[1:]) == [str(mount_dir / disk) for disk in ["disk0", "disk1", "disk2"]]
+    assert commands.max_running == 3
+    assert elapsed < 4 * UMOUNT_SECONDS
+    assert [args for args in commands.calls if args[0] == "qemu-nbd"] == [["qemu-nbd", "-d", "/dev/nbd0"]]
+
+    assert sorted(os.listdir(mount_dir)) == ["disk1", "files"]
+    assert summary["mounts"] == 4
+    assert (summary["unmounted"], summary["failed"], summary["nbd_detached"]) == (3, 1, 1)
+    assert summary["directories_removed"] == 5
@@ -0,0 +1,145 @@
+import sqlite3
+
+from types import SimpleNamespace
+
+import imagemounter_mitre
+import pytest
+
+from flask import current_app
+
+from thumbtack import create_app, utils
+from tests.conftest import make_mounted_parser
+
+
+def test_connection_is_tuned_and_reused(test_client):
+    """
+    GIVEN a Thumbtack Flask application client
+    WHEN the database is used from two app contexts on the same thread
+    THEN the same connection is reused and has the SQLITE_PRAGMAS settings applied
+    """
+    with current_app.app_context():
+        first = utils.get_db()
+        journal_mode = first.execute("PRAGMA journal_mode").fetchone()[0]
+        synchronous = first.execute("PRAGMA synchronous").fetchone()[0]
+    with current_app.app_context():
+        second = utils.get_db()
+
+    assert first is second
+    assert journal_mode == "wal"
+    assert synchronous == 1  # NORMAL
+    assert not second.in_transaction
+
+
+def test_catalog_lookups_use_indexes(test_client):
+    """
+    GIVEN a Thumbtack Flask application client
+    WHEN the query plans for image lookups by path are inspected
+    THEN they search an index instead of scanning disk_images
+    """
+    for column in ["rel_path", "full_path"]:
+        plan = utils.query_db(f"EXPLAIN QUERY PLAN SELECT id FROM disk_images WHERE {column} = ?", ["x"])
+        details = " ".join(row["detail"] for row in plan)
+        assert details.startswith("SEARCH disk_images")
+        assert f"INDEX disk_images_{column}" in details
+
+
+@pytest.fixture()
+def mounting_app(tmp_path, monkeypatch):
+    """A Thumbtack app whose mount_image builds a pretend-mounted parser instead of running the mount tools."""
+    image_dir = tmp_path / "images"
+    image_dir.mkdir()
+    (image_dir / "case.E01").touch()
+    app = create_app(image_dir=str(image_dir), database=str(tmp_path / "thumbtack.db"))
+    app.config["MOUNT_DIR"] = str(tmp_path / "mnt")
+
+    fake_imagemounter = SimpleNamespace(ImageParser=lambda paths, **kwargs: make_mounted_parser(paths[0], 4))
+    monkeypatch.setattr(utils, "imagemounter_mitre", fake_imagemounter)
+    monkeypatch.setattr(imagemounter_mitre.ImageParser, "clean", lambda self, **kwargs: True)
+    monkeypatch.setattr(utils, "process_image_parser", lambda image_parser, relative_image_path, **kwargs: image_parser)
+    with app.app_context():
+        yield app
+
+
+def test_mount_and_unmount_are_single_transactions(mounting_app):
+    """
+    GIVEN an image with four volumes
+    WHEN it is mounted twice and unmounted twice
+    THEN the ref count follows each call, and each mount or unmount commits once
+    """
+    statements = []
+    utils.get_db().set_trace_callback(statements.append)
+
+    utils.mount_image("case.E01")
+    assert statements.count("COMMIT") == 2  # claiming the image, then recording the mount
+    image_info = utils.get_image_info("case.E01")
+    assert image_info["ref_count"] == 1
+    assert [volume["status"] for volume in image_info["volume_info"]] == ["Mounted"] * 4
+
+    utils.mount_image("case.E01")
+    assert utils.get_image_info("case.E01")["ref_count"] == 2
+
+    statements.clear()
+    assert not utils.unmount_image("case.E01")
+    assert utils.unmount_image("case.E01") is True
+    assert statements.count("COMMIT") == 2
+    utils.get_db().set_trace_callback(None)
+
+    assert utils.get_image_info("case.E01")["ref_count"] == 0
+    volumes = utils.query_db("SELECT mountpoint, mount_status_id FROM volumes")
+    assert [tuple(volume) for volume in volumes] == [(None, utils.get_mount_codes()["Unmounted"])] * 4
+
+
+def test_transaction_rolls_back_on_error(mounting_app):
+    """
+    GIVEN a transaction that has updated an image's ref count and a volume
+    WHEN an exception is raised inside it
+    THEN neither change is kept
+    """
+    image_id = utils.get_image_info("case.E01", with_state=False)["id"]
+    with pytest.raises(RuntimeError):
+        with utils.transaction() as db:
+            utils.increment_ref_count("case.E01")
+            utils.upsert_volumes(db, [(image_id, utils.get_mount_codes()["Mounted"], "0", "/mnt/case-0")])
+            raise RuntimeError("mount failed")
+
+    assert utils.get_image_info("case.E01")["ref_count"] == 0
+    assert utils.query_db("SELECT * FROM volumes") == []
+
+
+def test_schema_upgrade_removes_duplicates(tmp_path):
+    """
+    GIVEN a kept database from before the unique indexes, with duplicate status codes, images and volumes
+    WHEN the schema is brought up to date
+    THEN one of each is kept (the referenced image and the newest volume) and the unique indexes are created
+    """
+    legacy = tmp_path / "legacy.db"
+    db = sqlite3.connect(legacy)
+    db.executescript(
+        """
+        CREATE TABLE mount_status_codes (id INTEGER PRIMARY KEY, status TEXT NOT NULL);
+        CREATE TABLE disk_images (id INTEGER PRIMARY KEY, mount_status_id INTEGER NOT NULL, full_path TEXT NOT NULL,
+            rel_path TEXT NOT NULL, filename TEXT NOT NULL, mountpoint TEXT, ref_count INTEGER DEFAULT 0, parser BLOB);
+        CREATE TABLE volumes (id INTEGER PRIMARY KEY, disk_id INTEGER NOT NULL, mount_status_id INTEGER NOT NULL,
+            partition_index INTEGER, mountpoint TEXT);
+        INSERT INTO mount_status_codes (id, status) VALUES (1, 'Mounted'), (2, 'Unmounted'), (3, 'Mounted');
+        INSERT INTO disk_images VALUES (1, 2, '/images/a.E01', 'a.E01', 'a.E01', NULL, 0, NULL);
+        INSERT INTO disk_images VALUES (2, 3, '/images/a.E01', 'a.E01', 'a.E01', NULL, 1, NULL);
+        INSERT INTO volumes VALUES (1, 1, 2, 0, NULL), (2, 2, 3, 0, '/mnt/old'), (3, 2, 3, 0, '/mnt/new');
+        """
+    )
+    db.commit()
+    db.close()
+
+    app = create_app(image_dir=str(tmp_path), database=str(tmp_path / "thumbtack.db"))
+    with app.app_context():
+        app.config["DATABASE"] = str(legacy)
+        utils.create_schema()
+
+        assert [tuple(row) for row in utils.query_db("SELECT id, status FROM mount_status_codes ORDER BY id")][:2] == [
+            (1, "Mounted"),
+            (2, "Unmounted"),
+        ]
+        assert [tuple(row) for row in utils.query_db("SELECT id, mount_status_id FROM disk_images")] == [(2, 1)]
+        assert [tuple(row) for row in utils.query_db("SELECT id, mountpoint FROM volumes")] == [(3, "/mnt/new")]
+        indexes = {row["name"] for row in utils.query_db("SELECT name FROM sqlite_master WHERE type = 'index'")}
+        assert {"disk_images_full_path", "disk_images_rel_path", "volumes_disk_partition"} <= indexes
@@ -0,0 +1,92 @@
+from thumbtack import utils
+
+
+def reference_image_info(rel_path, with_state):
+    """image_info as get_image_info built it with one query per table before images were listed with a JOIN."""
+    disk_image = utils.query_db("SELECT * FROM disk_images WHERE rel_path = ?", [rel_path], one=True)
+    status = utils.get_mount_status_by_id(disk_image["mount_status_id"])
+
+    volume_info = []
+    if status == "Mounted" or status == "Manual mount":
+        for volume in utils.query_db(
+            "SELECT * FROM volumes WHERE disk_id = ? ORDER BY partition_index", [disk_image["id"]]
+        ):
+            sanitized_rel_file = rel_path.replace("/", "_").replace(":", "-").replace(".", "-")
+            volume_info.append(
+                {
+                    "index": volume["partition_index"],
+                    "mountpoint": volume["mountpoint"],
+                    "uid": f"{sanitized_rel_file}_{volume['partition_index']}",
+                    "status": utils.get_mount_status_by_id(volume["mount_status_id"]),
+                }
+            )
+
+    return {
+        "id": disk_image["id"],
+        "rel_path": disk_image["rel_path"],
+        "full_path": disk_image["full_path"],
+        "filename": disk_image["filename"],
+        "status": status,
+        "disk_mountpoint": disk_image["mountpoint"],
+        "volume_info": volume_info,
+        "ref_count": disk_image["ref_count"],
+        "mount_state": utils.get_mount_state(disk_image["id"]) if with_state else None,
+    }
+
+
+def set_up_images():
+    """Mount case0 (two volumes), mark case1 as manually mounted with three volumes, and leave volume rows
+    behind for case2, which failed to mount."""
+    utils.mount_image("case0.E01")
+    codes = utils.get_mount_codes()
+    case1 = utils.get_image_info("case1.E01", with_state=False)["id"]
+    case2 = utils.get_image_info("case2.E01", with_state=False)["id"]
+    with utils.transaction() as db:
+        db.execute(
+            "UPDATE disk_images SET mount_status_id = ?, mountpoint = ?, ref_count = 1 WHERE id = ?",
+            [codes["Manual mount"], "/mnt/manual", case1],
+        )
+        db.execute("UPDATE disk_images SET mount_status_id = ? WHERE id = ?", [codes["Unable to mount"], case2])
+        # Inserted out of order, to be listed by partition index
+        utils.upsert_volumes(
+            db,
+            [
+                (case1, codes["Manual mount"], 2, "/mnt/manual/2"),
+                (case1, codes["Manual mount"], 0, "/mnt/manual/0"),
+                (case1, codes["Unmounted"], 1, None),
+                (case2, codes["Mounted"], 0, "/mnt/left-behind"),
+            ],
+        )
+
+
+def test_images_match_per_image_queries(fake_mounter):
+    """
+    GIVEN a mounted image with two volumes, a manually mounted image with three, a failed image with volume rows
+        left behind and an unmounted image
+    WHEN the images are listed or looked up, with and without volumes and mount state
+    THEN each image_info matches the one built with a query per table, volumes only listed for mounted images
+        and ordered by partition index
+    """
+    app, _ = fake_mounter
+
+    with app.app_context():
+        set_up_images()
+        rel_paths = [image["rel_path"] for image in utils.query_db("SELECT rel_path FROM disk_images ORDER BY id")]
+
+        for with_state in (False, True):
+            expected = [reference_image_info(rel_path, with_state) for rel_path in rel_paths]
+            assert utils.get_images(with_state=with_state) == expected
+            assert [utils.get_image_info(rel_path, with_state=with_state) for rel_path in rel_paths] == expected
+            assert utils.get_images(mounted=True, with_state=with_state) == expected[:2]
+
+        images = {image["rel_path"]: image for image in utils.get_images(with_state=True)}
+        assert [volume["index"] for volume in images["case0.E01"]["volume_info"]] == [0, 1]
+        assert [volume["index"] for volume in images["case1.E01"]["volume_info"]] == [0, 1, 2]
+        assert images["case2.E01"]["volume_info"] == []
+        assert images["case0.E01"]["mount_state"] is not None
+        assert images["case3.E01"]["mount_state"] is None
+
+        without_volumes = utils.get_images(with_volumes=False)
+        assert [image["volume_info"] for image in without_volumes] == [[]] * len(rel_paths)
+        expected = [reference_image_info(rel_path, False) for rel_path in rel_paths]
+        assert without_volumes == [dict(image, volume_info=[]) for image in expected]
@@ -0,0 +1,110 @@
+import time
+
+from thumbtack import utils
+from thumbtack.jobs import JobManager
+from tests.conftest import IMAGES, MOUNT_SECONDS
+
+
+def wait_for_job(client, job_id, timeout=10):
+    deadline = time.time() + timeout
+    while True:
+        job = client.get(f"/jobs/{job_id}").get_json()
+        if job["state"] in ("succeeded", "failed"):
+            return job
+        assert time.time() < deadline, f"job {job_id} did not finish"
+        time.sleep(0.01)
+
+
+def test_async_mount_and_unmount(fake_mounter):
+    """
+    GIVEN a Thumbtack Flask application client
+    WHEN an image is mounted and unmounted with ?async=true
+    THEN each request returns 202 with a job whose state, phase and timing are reported on /jobs/<id>,
+        and the job results match what the synchronous requests return
+    """
+    app, mounter = fake_mounter
+    client = app.test_client()
+
+    response = client.put(f"/mounts/{IMAGES[0]}?async=true")
+    assert response.status_code == 202
+    job_id = response.get_json()["job_id"]
+    assert response.headers["Location"].endswith(f"/jobs/{job_id}")
+
+    time.sleep(MOUNT_SECONDS / 3)
+    running = client.get(f"/jobs/{job_id}").get_json()
+    assert (running["state"], running["phase"]) == ("running", "mounting volumes")
+
+    job = wait_for_job(client, job_id)
+    assert (job["state"], job["phase"], job["operation"]) == ("succeeded", "done", "mount")
+    assert job["run_seconds"] >= MOUNT_SECONDS
+    assert job["result"]["name"] == IMAGES[0]
+    assert job["result"] == client.put(f"/mounts/{IMAGES[0]}").get_json()
+
+    response = client.delete(f"/mounts/{IMAGES[0]}?async=true")
+    assert response.status_code == 202
+    assert wait_for_job(client, response.get_json()["job_id"])["result"] == {"unmounted": False, "ref_count": 1}
+    response = client.delete(f"/mounts/{IMAGES[0]}?async=true")
+    assert wait_for_job(client, response.get_json()["job_id"])["result"] == {"unmounted": True, "ref_count": 0}
+    assert [job["id"] for job in client.get("/jobs/").get_json()][0] == job_id
+
+
+def test_failed_and_unknown_jobs(fake_mounter):
+    """
+    GIVEN a Thumbtack Flask application client
+    WHEN an image that is not in the database is mounted asynchronously, and an unknown job is requested
+    THEN the job fails with the same message as the synchronous request, and the unknown job is a 404
+    """
+    app, _ = fake_mounter
+    client = app.test_client()
+
+    job_id = client.put("/mounts/missing.E01?async=1").get_json()["job_id"]
+
+    job = wait_for_job(client, job_id)
+    assert job["state"] == "failed"
+    assert job["error"] == client.put("/mounts/missing.E01").get_json()["message"]
+    assert client.get("/jobs/0123456789abcdef").status_code == 404
+
+
+def test_job_pool_is_bounded(fake_mounter):
+    """
+    GIVEN a job pool with two workers
+    WHEN four images are mounted asynchronously at once
+    THEN no more than two mounts run at the same time and the other jobs wait in the queue
+    """
+    app, mounter = fake_mounter
+    app.jobs = JobManager(app, workers=2, history=10)
+    client = app.test_client()
+
+    job_ids = [client.put(f"/mounts/{image}?async=true").get_json()["job_id"] for image in IMAGES]
+    time.sleep(MOUNT_SECONDS / 3)
+    assert client.get("/status").get_json()["jobs"] == {"workers": 2, "queued": 2, "running": 2}
+
+    jobs = [wait_for_job(client, job_id) for job_id in job_ids]
+    assert [job["state"] for job in jobs] == ["succeeded"] * len(IMAGES)
+    assert mounter.max_mounting == 2
+    assert max(job["queued_seconds"] for job in jobs) >= MOUNT_SECONDS
+
+
+def test_mount_form_leaves_long_mounts_in_the_background(fake_mounter):
+    """
+    GIVEN a FORM_JOB_WAIT shorter than the mount of an image
+    WHEN the image is mounted from the web form
+    THEN the page links to the job instead of waiting for the mount, which completes in the background
+    """
+    app, _ = fake_mounter
+    app.config["FORM_JOB_WAIT"] = 0
+    client = app.test_client()
+    form = {"img_to_mount": IMAGES[0], "operation": "mount", "decryption method": "", "key": ""}
+
+    page = client.post("/mount_form", data=form).get_data(as_text=True)
+
+    assert "still running in the background" in page
+    job = app.jobs.jobs()[0]
+    assert f"/jobs/{job.id}" in page
+    assert job.wait(10) and job.state == "succeeded"
+
+    app.config["FORM_JOB_WAIT"] = 10
+    form["operation"] = "unmount"
+    assert "Unmounted successfully" in client.post("/mount_form", data=form).get_data(as_text=True)
+    with app.app_context():
+        assert utils.get_image_info(IMAGES[0])["status"] == "Unmounted"
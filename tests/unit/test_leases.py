@@ -0,0 +1,101 @@
+import time
+
+from thumbtack import utils
+
+IMAGE = "case0.E01"
+
+
+def test_leases_expire(fake_mounter):
+    """
+    GIVEN an image mounted twice with leases, and a third lease on an image mounted without one
+    WHEN one lease is renewed and the clock passes the other leases' expiry
+    THEN only the expired leases are released, the image stays mounted while the renewed lease holds it,
+        and it is unmounted when that lease lapses too
+    """
+    app, _ = fake_mounter
+    client = app.test_client()
+
+    short = client.put(f"/mounts/{IMAGE}?lease=30").get_json()["lease"]
+    long = client.put(f"/mounts/{IMAGE}?lease=true").get_json()["lease"]
+    assert (short["image_path"], short["ttl"], long["ttl"]) == (IMAGE, 30, app.config["LEASE_TTL"])
+    assert client.put("/mounts/case1.E01").get_json().get("lease") is None
+    assert [lease["lease_id"] for lease in client.get("/leases/").get_json()] == [short["lease_id"], long["lease_id"]]
+
+    renewed = client.put(f"/leases/{long['lease_id']}").get_json()
+    assert renewed["expires"] > long["expires"]
+
+    with app.app_context():
+        assert app.leases.expire(time.time() + 60) == 1
+        assert utils.get_ref_count(IMAGE) == 1
+        assert client.put(f"/leases/{short['lease_id']}").status_code == 404
+
+        assert app.leases.expire(time.time() + 600) == 1
+        assert utils.get_image_info(IMAGE)["status"] == "Unmounted"
+        assert utils.get_image_info("case1.E01")["status"] == "Mounted"
+
+    assert client.get("/status").get_json()["leases"]["expired"] == 2
+    assert client.get("/leases/").get_json() == []
+
+
+def test_leases_released_by_client_or_unmount(fake_mounter):
+    """
+    GIVEN mounts with leases
+    WHEN a client releases its lease, or the image is unmounted with force
+    THEN the lease's reference is dropped once, and leases on an image that is no longer mounted are gone
+    """
+    app, _ = fake_mounter
+    client = app.test_client()
+
+    first = client.put(f"/mounts/{IMAGE}?lease=60").get_json()["lease"]
+    second = client.put(f"/mounts/{IMAGE}?lease=60").get_json()["lease"]
+    assert client.put(f"/mounts/{IMAGE}?lease=soon").status_code == 400
+
+    assert client.delete(f"/leases/{first['lease_id']}").status_code == 200
+    assert client.delete(f"/leases/{first['lease_id']}").status_code == 404
+    with app.app_context():
+        assert utils.get_ref_count(IMAGE) == 1
+
+        utils.unmount_image(IMAGE, force=True)
+    assert client.get(f"/leases/{second['lease_id']}").status_code == 404
+
+
+def test_leased_references_need_their_lease(fake_mounter):
+    """
+    GIVEN an image mounted once with a lease and once without
+    WHEN it is unmounted without naming a lease
+    THEN the unleased reference is released, and another unmount is refused until the lease is named
+    """
+    app, _ = fake_mounter
+    client = app.test_client()
+
+    lease = client.put(f"/mounts/{IMAGE}?lease=60").get_json()["lease"]
+    client.put(f"/mounts/{IMAGE}")
+
+    assert client.delete(f"/mounts/{IMAGE}").status_code == 200
+    assert client.delete(f"/mounts/{IMAGE}").status_code == 409
+    assert client.delete(f"/mounts/case1.E01?lease={lease['lease_id']}").status_code == 404
+    assert client.delete(f"/mounts/{IMAGE}?lease={lease['lease_id']}").status_code == 200
+    with app.app_context():
+        assert utils.get_image_info(IMAGE)["status"] == "Unmounted"
+
+
+def test_leases_survive_remount(fake_mounter):
+    """
+    GIVEN an image mounted with a lease and without one
+    WHEN the image is remounted, e.g. because its volumes went stale
+    THEN the lease still holds its reference, can be renewed, and releases it when it expires
+    """
+    app, mounter = fake_mounter
+    client = app.test_client()
+
+    lease = client.put(f"/mounts/{IMAGE}?lease=60").get_json()["lease"]
+    client.put(f"/mounts/{IMAGE}")
+    with app.app_context():
+        assert utils.remount_image(IMAGE)
+        assert mounter.mounts == 2
+        assert utils.get_ref_count(IMAGE) == 2
+
+    assert client.put(f"/leases/{lease['lease_id']}").status_code == 200
+    with app.app_context():
+        assert app.leases.expire(time.time() + 120) == 1
+        assert utils.get_ref_count(IMAGE) == 1
@@ -0,0 +1,103 @@
+import errno
+import os
+import time
+
+from thumbtack import liveness, utils
+from thumbtack.mountinfo import MountInfo
+
+VOLUMES = ["/mnt/thumbtack/case-0-volume0", "/mnt/thumbtack/case-1-volume1"]
+# Where the FUSE tool serving the image mounted it, see make_mounted_parser
+DISK = "/tmp/image_mounter_test"
+
+
+def mount_table(*mountpoints):
+    return [MountInfo(20 + i, 1, "0:0", "/", path, "ro", "ext4", "/dev/nbd0p1", "ro") for i, path in enumerate(mountpoints)]
+
+
+def volume_statuses(client, image="case0.E01"):
+    images = {image["rel_path"]: image for image in client.get("/images").get_json()}
+    return [volume["status"] for volume in images[image]["volume_info"]]
+
+
+def test_stale_volumes_are_marked(fake_mounter, monkeypatch):
+    """
+    GIVEN an image served by a FUSE mount with two mounted volumes
+    WHEN a volume disappears from the mount table or stops answering, or the FUSE mount fails with ENOTCONN
+    THEN the volume (or every volume of the disk) is marked Stale with the reason, a hung probe is not repeated
+        while it is still blocked, and a volume that answers again is marked Mounted again
+    """
+    app, _ = fake_mounter
+    client = app.test_client()
+    app.liveness.probe.timeout = 0.1
+    failing = {}
+
+    def statvfs(path):
+        if failing.get(path) == "dead":
+            raise OSError(errno.ENOTCONN, os.strerror(errno.ENOTCONN))
+        if failing.get(path) == "hung":
+            time.sleep(0.5)
+
+    monkeypatch.setattr(liveness.os, "statvfs", statvfs)
+    # Resolving a mountpoint stats it, which would hang outside of the probe
+    resolved = []
+    realpath = os.path.realpath
+    monkeypatch.setattr(liveness.os.path, "realpath", lambda path: resolved.append(path) or realpath(path))
+
+    with app.app_context():
+        utils.mount_image("case0.E01")
+
+        stale = app.liveness.check(mount_table(DISK, VOLUMES[0]))
+        assert [(volume["mountpoint"], volume["reason"]) for volume in stale] == [(VOLUMES[1], "not in the mount table")]
+        assert volume_statuses(client) == ["Mounted", "Stale"]
+
+        # The volumes on the loop devices still answer when the FUSE process died
+        failing[DISK] = "dead"
+        stale = app.liveness.check(mount_table(DISK, *VOLUMES))
+        assert [(volume["mountpoint"], volume["reason"]) for volume in stale] == [
+            (path, f"disk mount {DISK}: {os.strerror(errno.ENOTCONN)}") for path in VOLUMES
+        ]
+        assert volume_statuses(client) == ["Stale", "Stale"]
+
+        failing = {VOLUMES[1]: "hung"}
+        assert [volume["reason"] for volume in app.liveness.check(mount_table(DISK, *VOLUMES))] == [
+            "did not answer within 0.1s"
+        ]
+        assert [volume["reason"] for volume in app.liveness.check(mount_table(DISK, *VOLUMES))] == ["still not answering"]
+        assert volume_statuses(client) == ["Mounted", "Stale"]
+
+        assert not set(resolved) & {DISK, *VOLUMES}
+
+        status = client.get("/status").get_json()["liveness"]
+        assert (status["passes"], status["volumes_checked"]) == (4, 2)
+        assert status["stale"][0]["rel_path"] == "case0.E01"
+
+        # A stale image can still be unmounted, which clears its volumes
+        utils.unmount_image("case0.E01")
+        assert app.liveness.check(mount_table()) == []
+
+
+def test_stale_images_are_remounted(fake_mounter, monkeypatch):
+    """
+    GIVEN an image mounted twice (two references) with REMOUNT_STALE set
+    WHEN its volumes are gone from the mount table
+    THEN it is remounted as a job, keeping both references, and its volumes are Mounted again
+    """
+    app, mounter = fake_mounter
+    app.config["REMOUNT_STALE"] = True
+    client = app.test_client()
+    monkeypatch.setattr(liveness.os, "statvfs", lambda path: None)
+
+    with app.app_context():
+        utils.mount_image("case0.E01")
+        utils.mount_image("case0.E01")
+        assert mounter.mounts == 1
+
+        app.liveness.check(mount_table("/"))
+        job = app.liveness.remounts["case0.E01"]
+        assert job.wait(5)
+        assert (job.operation, job.state, job.result) == ("remount", "succeeded", True)
+
+        assert mounter.mounts == 2
+        assert utils.get_ref_count("case0.E01") == 2
+        assert volume_statuses(client) == ["Mounted", "Mounted"]
+        assert app.liveness.check(mount_table(DISK, *VOLUMES)) == []
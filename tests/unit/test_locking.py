@@ -0,0 +1,136 @@
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import imagemounter_mitre
+import pytest
+
+from thumbtack import utils
+from thumbtack.exceptions import UnexpectedDiskError
+from thumbtack.mounter_strategy import MounterStrategies
+from tests.conftest import IMAGES, MOUNT_SECONDS, fake_image_parser, save_analysis
+
+
+def put_concurrently(app, rel_paths):
+    client = app.test_client()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(len(rel_paths)) as pool:
+        responses = list(pool.map(lambda rel_path: client.put(f"/mounts/{rel_path}"), rel_paths))
+    return responses, time.perf_counter() - start
+
+
+def test_different_images_mount_concurrently(fake_mounter):
+    """
+    GIVEN four images that each take MOUNT_SECONDS to mount
+    WHEN they are all mounted at the same time
+    THEN the mounts overlap, as EWF images with NTFS volumes claim no shared device, so the batch takes about as
+        long as one mount instead of four
+    """
+    app, mounter = fake_mounter
+
+    responses, elapsed = put_concurrently(app, IMAGES)
+
+    assert [response.status_code for response in responses] == [200] * len(IMAGES)
+    assert mounter.max_mounting == len(IMAGES)
+    # With the old global mount mutex this took len(IMAGES) * MOUNT_SECONDS
+    assert elapsed < len(IMAGES) * MOUNT_SECONDS / 2
+    assert len(app.mount_locks) == 0
+
+
+def test_same_image_mounts_once(fake_mounter):
+    """
+    GIVEN an image that is not mounted
+    WHEN it is mounted by two requests at the same time and then unmounted by both
+    THEN the second request waits for the first attempt and takes a reference instead of mounting it again
+    """
+    app, mounter = fake_mounter
+
+    responses, _ = put_concurrently(app, [IMAGES[0]] * 2)
+
+    assert [response.status_code for response in responses] == [200, 200]
+    assert responses[0].get_json() == responses[1].get_json()
+    assert mounter.mounts == 1
+    assert app.inflight_mounts.as_dict() == {"in_progress": 0, "coalesced": 1}
+    with app.app_context():
+        assert utils.get_image_info(IMAGES[0])["ref_count"] == 2
+        assert not utils.unmount_image(IMAGES[0])
+        assert utils.unmount_image(IMAGES[0])
+        assert utils.get_image_info(IMAGES[0])["status"] == "Unmounted"
+
+
+def test_waiting_for_a_mount_times_out(fake_mounter):
+    """
+    GIVEN a MOUNT_WAIT_TIMEOUT shorter than the mount of an image
+    WHEN the image is mounted by two requests at the same time
+    THEN the first request mounts it and the second gives up with a 400 after the timeout
+    """
+    app, mounter = fake_mounter
+    app.config["MOUNT_WAIT_TIMEOUT"] = MOUNT_SECONDS / 10
+
+    responses, _ = put_concurrently(app, [IMAGES[0]] * 2)
+
+    assert sorted(response.status_code for response in responses) == [200, 400]
+    assert "Timed out waiting" in max(responses, key=lambda response: response.status_code).get_json()["message"]
+    with app.app_context():
+        assert utils.get_image_info(IMAGES[0])["ref_count"] == 1
+
+
+def test_mounts_that_claim_devices_take_the_device_lock(fake_mounter):
+    """
+    GIVEN images attached with qemu-nbd, images with LVM volumes, and images that were not analyzed
+    WHEN two of a kind are mounted at the same time
+    THEN they mount one at a time, as each may claim a shared NBD or loop device
+    """
+    app, mounter = fake_mounter
+    app.mounter_strategies = MounterStrategies({".e01": "qemu-nbd"})
+    responses, _ = put_concurrently(app, IMAGES[:2])
+    assert [response.status_code for response in responses] == [200] * 2
+    assert mounter.max_mounting == 1
+
+    app.mounter_strategies = MounterStrategies()
+    with app.app_context():
+        save_analysis(IMAGES[2], ["ntfs", "lvm"])
+        utils.update_or_insert_db("DELETE FROM image_analysis WHERE disk_id = ?", [utils.get_image_info(IMAGES[3])["id"]])
+    responses, _ = put_concurrently(app, IMAGES[2:])
+    assert [response.status_code for response in responses] == [200] * 2
+    assert mounter.max_mounting == 1
+    assert not app.nbd_mutex.locked()
+
+
+def test_failed_mount_releases_its_claim(fake_mounter, monkeypatch):
+    """
+    GIVEN an image whose mount fails with an error other than finding no mountable volumes, whether building the
+        parser or mounting with it
+    WHEN it is mounted, and then mounted again once the error is gone
+    THEN each failed mount cleans up its parser and drops its claim, so the last mount succeeds
+    """
+    app, mounter = fake_mounter
+    cleaned = []
+    monkeypatch.setattr(imagemounter_mitre.ImageParser, "clean", lambda self, **kwargs: cleaned.append(self) or True)
+    failures = [RuntimeError("cannot read image"), UnexpectedDiskError("Unexpected number of disks")]
+    process_image_parser = utils.process_image_parser
+
+    def image_parser(paths, **kwargs):
+        if failures and isinstance(failures[0], RuntimeError):
+            raise failures.pop(0)
+        return fake_image_parser(paths, **kwargs)
+
+    def failing_process_image_parser(image_parser, relative_image_path, **kwargs):
+        if failures:
+            raise failures.pop(0)
+        return process_image_parser(image_parser, relative_image_path, **kwargs)
+
+    monkeypatch.setattr(utils, "imagemounter_mitre", SimpleNamespace(ImageParser=image_parser))
+    monkeypatch.setattr(utils, "process_image_parser", failing_process_image_parser)
+
+    with app.app_context():
+        for error, parsers_cleaned in [(RuntimeError, 0), (UnexpectedDiskError, 1)]:
+            with pytest.raises(error):
+                utils.mount_image(IMAGES[0])
+            assert utils.get_image_info(IMAGES[0])["ref_count"] == 0
+            assert len(cleaned) == parsers_cleaned
+
+        utils.mount_image(IMAGES[0])
+        image_info = utils.get_image_info(IMAGES[0])
+        assert (image_info["status"], image_info["ref_count"]) == ("Mounted", 1)
@@ -0,0 +1,154 @@
+import json
+import pickle
+import warnings
+
+import pytest
+
+from flask_restful import marshal
+
+from thumbtack import create_app, utils
+from thumbtack.mount_state import DiskState, dump_mount_state, load_mount_state
+from thumbtack.resources import disk_fields
+from tests.conftest import make_mounted_parser
+
+
+def marshal_disk(disk):
+    with warnings.catch_warnings():
+        # Volume.fstype is deprecated in imagemounter, but it is what disk_fields reads
+        warnings.simplefilter("ignore", DeprecationWarning)
+        return marshal(disk, disk_fields)
+
+
+@pytest.mark.parametrize("num_volumes,lvm_volumes", [(1, 0), (3, 0), (2, 4)])
+def test_mount_state_marshals_like_disk(tmp_path, num_volumes, lvm_volumes):
+    """
+    GIVEN a mounted ImageParser
+    WHEN its disk is serialized to mount state and loaded again
+    THEN the API returns the same fields for the loaded state as for the original disk
+    """
+    disk = make_mounted_parser(tmp_path / "case.E01", num_volumes, lvm_volumes).disks[0]
+
+    state = load_mount_state(dump_mount_state(DiskState.from_disk(disk)))
+
+    assert marshal_disk(state) == marshal_disk(disk)
+    assert len(state.volumes) == num_volumes + lvm_volumes
+
+
+def test_mount_state_rejects_unknown_version(tmp_path):
+    """
+    GIVEN mount state written with a different schema version
+    WHEN it is loaded
+    THEN a ValueError is raised instead of returning a partially understood state
+    """
+    state = DiskState.from_disk(make_mounted_parser(tmp_path / "case.E01").disks[0]).to_dict()
+    state["version"] = 99
+
+    with pytest.raises(ValueError):
+        load_mount_state(json.dumps(state))
+
+
+def test_mount_info_is_read_from_mount_state(tmp_path):
+    """
+    GIVEN images mounted with structured mount state and with only a pickled parser (older databases)
+    WHEN their mount information is requested
+    THEN both are returned as DiskState without unpickling the parser for the structured one
+    """
+    image_dir = tmp_path / "images"
+    image_dir.mkdir()
+    for filename in ["new.E01", "old.E01"]:
+        (image_dir / filename).touch()
+    app = create_app(image_dir=str(image_dir), database=str(tmp_path / "thumbtack.db"))
+
+    with app.app_context():
+        mounted = utils.get_mount_codes()["Mounted"]
+        sql = "UPDATE disk_images SET ref_count = 1, mount_status_id = ?, parser = ?, mount_state = ? WHERE rel_path = ?"
+        new_disk = make_mounted_parser(image_dir / "new.E01").disks[0]
+        # A parser blob that cannot be unpickled shows the structured state is read instead
+        utils.update_or_insert_db(sql, [mounted, b"not a pickle", dump_mount_state(DiskState.from_disk(new_disk)), "new.E01"])
+        old_parser = make_mounted_parser(image_dir / "old.E01", 2)
+        utils.update_or_insert_db(sql, [mounted, pickle.dumps(old_parser), None, "old.E01"])
+
+        assert marshal_disk(utils.get_mount_info("new.E01")["disk_info"]) == marshal_disk(new_disk)
+        assert marshal_disk(utils.get_mount_info("old.E01")["disk_info"]) == marshal_disk(old_parser.disks[0])
+        assert {info["disk_info"]._name for info in utils.get_mount_info(None)} == {"new.E01", "old.E01"}
+
+
+def test_registry_serves_live_mounts(tmp_path):
+    """
+    GIVEN an image mounted by this process, with its live ImageParser in the mount registry
+    WHEN its mount information is read and it is then unmounted
+    THEN reads use the registered state, clean() is called on the live parser and the entry is dropped
+    """
+    image_dir = tmp_path / "images"
+    image_dir.mkdir()
+    (image_dir / "case.E01").touch()
+    app = create_app(image_dir=str(image_dir), database=str(tmp_path / "thumbtack.db"))
+
+    with app.app_context():
+        image_id = utils.get_image_info("case.E01", with_state=False)["id"]
+        image_parser = make_mounted_parser(image_dir / "case.E01")
+        disk_state = DiskState.from_disk(image_parser.disks[0])
+        mount_state = dump_mount_state(disk_state)
+        utils.update_or_insert_db(
+            "UPDATE disk_images SET ref_count = 1, mount_status_id = ?, parser = ?, mount_state = ? WHERE id = ?",
+            [utils.get_mount_codes()["Mounted"], b"not a pickle", mount_state, image_id],
+        )
+        app.mount_registry.add(image_id, mount_state, disk_state, image_parser)
+
+        assert utils.get_mount_info("case.E01")["disk_info"] is disk_state
+
+        cleaned = []
+        image_parser.clean = lambda **kwargs: cleaned.append(kwargs)
+        assert utils.unmount_image("case.E01")
+
+        assert cleaned == [{"allow_lazy": True}]
+        assert len(app.mount_registry) == 0
+        assert utils.get_image_info("case.E01")["status"] == "Unmounted"
+
+
+def test_registry_ignores_entries_replaced_in_database(tmp_path):
+    """
+    GIVEN a registry entry for an image that was since unmounted and mounted again by another process
+    WHEN its mount information is read
+    THEN the state in the database is returned instead of the stale entry
+    """
+    image_dir = tmp_path / "images"
+    image_dir.mkdir()
+    (image_dir / "case.E01").touch()
+    app = create_app(image_dir=str(image_dir), database=str(tmp_path / "thumbtack.db"))
+
+    with app.app_context():
+        image_id = utils.get_image_info("case.E01", with_state=False)["id"]
+        stale = DiskState.from_disk(make_mounted_parser(image_dir / "case.E01").disks[0])
+        app.mount_registry.add(image_id, dump_mount_state(stale), stale)
+
+        current = DiskState.from_disk(make_mounted_parser(image_dir / "case.E01").disks[0])
+        utils.update_or_insert_db(
+            "UPDATE disk_images SET ref_count = 1, mount_status_id = ?, mount_state = ? WHERE id = ?",
+            [utils.get_mount_codes()["Mounted"], dump_mount_state(current), image_id],
+        )
+
+        assert utils.get_mount_info("case.E01")["disk_info"].mount_id == current.mount_id
+
+
+def test_registry_ignores_legacy_entries_after_unmount(tmp_path):
+    """
+    GIVEN an image mounted by an older version, with only a pickled parser, whose state was read into the registry
+    WHEN another process unmounts it
+    THEN it is reported as not mounted, instead of from the registry entry
+    """
+    image_dir = tmp_path / "images"
+    image_dir.mkdir()
+    (image_dir / "old.E01").touch()
+    app = create_app(image_dir=str(image_dir), database=str(tmp_path / "thumbtack.db"))
+
+    with app.app_context():
+        sql = "UPDATE disk_images SET ref_count = ?, mount_status_id = ?, parser = ? WHERE rel_path = ?"
+        mount_codes = utils.get_mount_codes()
+        old_parser = make_mounted_parser(image_dir / "old.E01")
+        utils.update_or_insert_db(sql, [1, mount_codes["Mounted"], pickle.dumps(old_parser), "old.E01"])
+        assert utils.get_mount_info("old.E01") is not None
+
+        utils.update_or_insert_db(sql, [0, mount_codes["Unmounted"], None, "old.E01"])
+        assert utils.get_mount_info("old.E01") is None
+        assert utils.get_image_parser(utils.get_image_info("old.E01", with_state=False)["id"]) is None
@@ -0,0 +1,111 @@
+from types import SimpleNamespace
+
+import pytest
+
+from thumbtack import create_app, utils
+from thumbtack.exceptions import NoMountableVolumesError
+from thumbtack.mounter_strategy import MounterStrategies, format_signature
+from tests.conftest import make_mounted_parser
+
+
+@pytest.fixture()
+def qemu_only_app(tmp_path, monkeypatch):
+    """An app whose images only mount with qemu-nbd, recording the disk_mounter of every attempt."""
+    image_dir = tmp_path / "images"
+    image_dir.mkdir()
+    for i in range(2):
+        (image_dir / f"disk{i}.vhdx").write_bytes(b"vhdxfile" + bytes(56))
+        (image_dir / f"disk{i}.qcow2").write_bytes(b"QFI\xfb" + bytes(60))
+    app = create_app(image_dir=str(image_dir), database=str(tmp_path / "thumbtack.db"))
+    app.config["MOUNT_DIR"] = str(tmp_path / "mnt")
+
+    attempts = []
+
+    def image_parser(paths, disk_mounter, **kwargs):
+        attempts.append(disk_mounter)
+        return make_mounted_parser(paths[0], 1)
+
+    def process_image_parser(image_parser, relative_image_path, **kwargs):
+        if attempts[-1] != "qemu-nbd":
+            raise NoMountableVolumesError(relative_image_path)
+        return image_parser
+
+    monkeypatch.setattr(utils, "imagemounter_mitre", SimpleNamespace(ImageParser=image_parser))
+    monkeypatch.setattr(utils, "process_image_parser", process_image_parser)
+    with app.app_context():
+        yield app, attempts
+
+
+def test_format_signature(tmp_path):
+    """
+    GIVEN images with known magic bytes, unknown contents and a missing file
+    WHEN their format signatures are computed
+    THEN they combine the detected format with the lower-cased extension
+    """
+    (tmp_path / "case.E01").write_bytes(b"EVF\x09\x0d\x0a\xff\x00" + bytes(8))
+    (tmp_path / "disk.VHDX").write_bytes(b"vhdxfile")
+    (tmp_path / "raw.dd").write_bytes(bytes(512))
+
+    assert format_signature(str(tmp_path / "case.E01")) == "ewf:.e01"
+    assert format_signature(str(tmp_path / "disk.VHDX")) == "vhdx:.vhdx"
+    assert format_signature(str(tmp_path / "raw.dd")) == "unknown:.dd"
+    assert format_signature(str(tmp_path / "missing.img")) == "unknown:.img"
+
+
+def test_mounter_is_learned_per_format(qemu_only_app):
+    """
+    GIVEN VHDX images that only mount with qemu-nbd
+    WHEN two of them are mounted
+    THEN the first tries the default mounter before qemu-nbd, and the second goes straight to qemu-nbd
+    """
+    app, attempts = qemu_only_app
+
+    utils.mount_image("disk0.vhdx")
+    assert attempts == ["auto", "qemu-nbd"]
+
+    attempts.clear()
+    utils.mount_image("disk1.vhdx")
+    assert attempts == ["qemu-nbd"]
+
+    stats = app.test_client().get("/status").get_json()["mounter_strategies"]
+    assert (stats["hits"], stats["misses"], stats["hit_rate"]) == (1, 1, 0.5)
+    assert stats["first_attempt_failures"] == 1
+    assert stats["learned"] == {"vhdx:.vhdx": "qemu-nbd"}
+
+
+def test_mounter_overrides(qemu_only_app):
+    """
+    GIVEN a MOUNTER_OVERRIDES entry for the .qcow2 extension, and an override that is wrong for VHDX
+    WHEN a qcow2 and a VHDX image are mounted
+    THEN the qcow2 image goes straight to qemu-nbd and the VHDX image falls back to it after the override fails
+    """
+    app, attempts = qemu_only_app
+    app.mounter_strategies = MounterStrategies({".qcow2": "qemu-nbd", "vhdx": "xmount"})
+
+    utils.mount_image("disk0.qcow2")
+    assert attempts == ["qemu-nbd"]
+
+    attempts.clear()
+    utils.mount_image("disk0.vhdx")
+    assert attempts == ["xmount", "auto", "qemu-nbd"]
+
+
+def test_mounter_is_not_learned_for_unknown_formats(qemu_only_app):
+    """
+    GIVEN raw images that the magic bytes do not identify, which only mount with qemu-nbd here
+    WHEN two of them are mounted
+    THEN both try the default mounter first, as one raw image needing qemu-nbd says nothing about the next
+    """
+    app, attempts = qemu_only_app
+    image_dir = app.config["IMAGE_DIR"]
+    for filename in ["raw0.dd", "raw1.dd"]:
+        with open(f"{image_dir}/{filename}", "wb") as f:
+            f.write(bytes(512))
+    utils.insert_images()
+
+    utils.mount_image("raw0.dd")
+    attempts.clear()
+    utils.mount_image("raw1.dd")
+    assert attempts == ["auto", "qemu-nbd"]
+    assert app.mounter_strategies.learned == {}
+    assert app.mounter_strategies.first_attempt_failures == 2
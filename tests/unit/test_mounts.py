@@ -75,6 +75,23 @@ def test_get_info_nonexistent_image(test_client):
     assert response.status_code == 404
 
 
+def test_mount_codes_match_database(test_client):
+    """
+    GIVEN a Thumbtack Flask application client
+    WHEN the mount status codes are looked up
+    THEN they match the mount_status_codes table and cannot be modified
+    """
+    rows = utils.query_db("SELECT id, status FROM mount_status_codes")
+    mount_codes = utils.get_mount_codes()
+
+    assert dict(mount_codes) == {row["status"]: row["id"] for row in rows}
+    assert set(mount_codes) == set(utils.MOUNT_STATUS_CODES)
+    for status, mount_status_id in mount_codes.items():
+        assert utils.get_mount_status_by_id(mount_status_id) == status
+    with pytest.raises(TypeError):
+        mount_codes["Mounted"] = 0
+
+
 def test_mount_nonexistent_image(test_client):
     """
     GIVEN a Thumbtack Flask application client
@@ -0,0 +1,116 @@
+import time
+
+from tests.conftest import IMAGES
+from tests.unit.test_locking import put_concurrently
+from thumbtack import utils
+
+
+def mounted_images():
+    return [image["rel_path"] for image in utils.get_mounts_by_last_access()]
+
+
+def test_idle_mounts_are_evicted(fake_mounter):
+    """
+    GIVEN two mounted images with IDLE_MOUNT_TIMEOUT set, one of them mounted twice and unused for longer
+    WHEN the reaper runs
+    THEN only the idle image is unmounted, dropping both of its references, and the eviction is reported
+    """
+    app, _ = fake_mounter
+    app.config["IDLE_MOUNT_TIMEOUT"] = 60
+    client = app.test_client()
+
+    with app.app_context():
+        utils.mount_image("case0.E01")
+        utils.mount_image("case0.E01")
+        utils.mount_image("case1.E01")
+        case0 = utils.get_image_info("case0.E01", with_state=False)["id"]
+        utils.update_or_insert_db("UPDATE mount_access SET last_access = ? WHERE disk_id = ?", [time.time() - 120, case0])
+
+        assert app.reaper.reap() == 1
+        assert mounted_images() == ["case1.E01"]
+        assert utils.get_image_info("case0.E01")["status"] == "Unmounted"
+
+        # Looking a mount up counts as using it
+        utils.update_or_insert_db("UPDATE mount_access SET last_access = ?", [time.time() - 120])
+        utils.get_mount_info("case1.E01")
+        assert app.reaper.reap() == 0
+
+    status = client.get("/status").get_json()["reaper"]
+    assert (status["passes"], status["evictions"]) == (2, {"idle": 1})
+    assert status["recent_evictions"][0]["image_path"] == "case0.E01"
+    assert status["recent_evictions"][0]["ref_count"] == 2
+
+
+def test_least_recently_used_mounts_are_evicted(fake_mounter):
+    """
+    GIVEN MAX_MOUNTS images mounted
+    WHEN another image is mounted, or one already mounted is mounted again
+    THEN the least recently used image is unmounted to make room for the new one, and no image is unmounted for
+        a mount that takes another reference
+    """
+    app, mounter = fake_mounter
+    app.config["MAX_MOUNTS"] = 2
+
+    with app.app_context():
+        utils.mount_image("case0.E01")
+        utils.mount_image("case1.E01")
+        utils.get_mount_info("case0.E01")
+
+        utils.mount_image("case2.E01")
+        assert sorted(mounted_images()) == ["case0.E01", "case2.E01"]
+
+        utils.mount_image("case2.E01")
+        assert sorted(mounted_images()) == ["case0.E01", "case2.E01"]
+        assert mounter.mounts == 3
+        assert dict(app.reaper.evictions) == {"max_mounts": 1}
+
+
+def test_nbd_device_budget(fake_mounter):
+    """
+    GIVEN MAX_NBD_DEVICES images attached to NBD devices
+    WHEN another image is mounted
+    THEN the least recently used image holding an NBD device is unmounted first
+    """
+    app, _ = fake_mounter
+    app.config["MAX_NBD_DEVICES"] = 2
+
+    with app.app_context():
+        for image in ["case0.E01", "case1.E01", "case2.E01", "case3.E01"]:
+            utils.mount_image(image)
+        assert sorted(mounted_images()) == ["case2.E01", "case3.E01"]
+        assert dict(app.reaper.evictions) == {"max_nbd_devices": 2}
+
+
+def test_concurrent_mounts_stay_within_budget(fake_mounter):
+    """
+    GIVEN MAX_MOUNTS of 2
+    WHEN four images are mounted at the same time
+    THEN at most two are mounted or being mounted at any time, the others wait for room and evict the
+        finished mounts, and every mount succeeds
+    """
+    app, mounter = fake_mounter
+    app.config["MAX_MOUNTS"] = 2
+
+    responses, _ = put_concurrently(app, IMAGES)
+
+    assert [response.status_code for response in responses] == [200] * len(IMAGES)
+    assert mounter.max_mounting == 2
+    with app.app_context():
+        assert len(mounted_images()) == 2
+    assert dict(app.reaper.evictions) == {"max_mounts": 2}
+
+
+def test_mount_fails_when_budget_is_held(fake_mounter):
+    """
+    GIVEN MAX_MOUNTS of 1, held by a mount in progress
+    WHEN another image is mounted
+    THEN it gives up after MOUNT_WAIT_TIMEOUT seconds instead of going over budget
+    """
+    app, _ = fake_mounter
+    app.config.update(MAX_MOUNTS=1, MOUNT_WAIT_TIMEOUT=0.1)
+    client = app.test_client()
+
+    with app.app_context(), app.reaper.reserve("case0.E01"):
+        response = client.put("/mounts/case1.E01")
+    assert response.status_code == 400
+    assert "Too many images are mounted" in response.get_json()["message"]
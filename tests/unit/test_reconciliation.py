@@ -0,0 +1,119 @@
+import time
+
+import pytest
+
+from thumbtack import create_app, utils
+from thumbtack.mountinfo import MountInfo
+
+
+def wait_for_reconciliation(app, timeout=10):
+    deadline = time.time() + timeout
+    while not app.reconciliation.done:
+        assert time.time() < deadline, "startup reconciliation did not finish"
+        time.sleep(0.01)
+
+
+def mount_entry(mountpoint):
+    return MountInfo(1, 0, "0:1", "/", mountpoint, "rw", "ext4", "/dev/loop0", "rw")
+
+
+@pytest.fixture()
+def image_dir(tmp_path):
+    image_dir = tmp_path / "images"
+    (image_dir / "case").mkdir(parents=True)
+    for filename in ["kept.E01", "removed.E01", "case/nested.dd"]:
+        (image_dir / filename).touch()
+    return image_dir
+
+
+def set_mounted(rel_path, mountpoint):
+    image_info = utils.get_image_info(rel_path, with_state=False)
+    mount_codes = utils.get_mount_codes()
+    utils.update_or_insert_db(
+        "UPDATE disk_images SET ref_count = 1, mount_status_id = ? WHERE id = ?",
+        [mount_codes["Mounted"], image_info["id"]],
+    )
+    utils.update_or_insert_db(
+        "INSERT INTO volumes (disk_id, mount_status_id, partition_index, mountpoint) VALUES (?, ?, ?, ?)",
+        [image_info["id"], mount_codes["Mounted"], 0, mountpoint],
+    )
+
+
+def test_keep_database_reconciles_in_background(tmp_path, image_dir):
+    """
+    GIVEN a database kept from a previous run, and images added and removed while the server was down
+    WHEN the app is created again with keep_database
+    THEN the kept catalog is updated in the background and /status reports the reconciliation as done
+    """
+    database = str(tmp_path / "thumbtack.db")
+    app = create_app(image_dir=str(image_dir), database=database)
+    with app.app_context():
+        assert len(utils.get_images()) == 3
+
+    (image_dir / "removed.E01").unlink()
+    (image_dir / "case" / "added.E01").touch()
+
+    app = create_app(image_dir=str(image_dir), database=database, keep_database=True)
+    wait_for_reconciliation(app)
+
+    with app.app_context():
+        rel_paths = {image["rel_path"] for image in utils.get_images()}
+    assert rel_paths == {"kept.E01", "case/nested.dd", "case/added.E01"}
+
+    status = app.test_client().get("/status").get_json()
+    assert status["startup_reconciliation"]["phase"] == "done"
+    assert status["startup_reconciliation"]["files_scanned"] >= 1
+    assert status["catalog"]["age"] is not None
+
+
+def test_reconcile_mounts_resets_missing_mounts(tmp_path, image_dir):
+    """
+    GIVEN two images recorded as mounted in the database
+    WHEN the mount state is reconciled against a mount table that only contains one of their mountpoints
+    THEN the other image is reset to Unmounted and the mounted one is left alone
+    """
+    app = create_app(image_dir=str(image_dir), database=str(tmp_path / "thumbtack.db"))
+    with app.app_context():
+        set_mounted("kept.E01", "/mnt/thumbtack/kept-1-ext4")
+        set_mounted("removed.E01", "/mnt/thumbtack/removed-1-ext4")
+
+        checked, reset = utils.reconcile_mounts([mount_entry("/"), mount_entry("/mnt/thumbtack/kept-1-ext4")])
+
+        assert (checked, reset) == (2, 1)
+        assert utils.get_image_info("kept.E01")["status"] == "Mounted"
+        removed = utils.get_image_info("removed.E01")
+        assert removed["status"] == "Unmounted"
+        assert removed["ref_count"] == 0
+        assert removed["volume_info"] == []
+
+        # An unreadable mount table must not unmount everything
+        assert utils.reconcile_mounts([]) == (0, 0)
+        assert utils.get_image_info("kept.E01")["status"] == "Mounted"
+
+
+def test_moving_image_dir_keeps_mounted_images(tmp_path, image_dir, monkeypatch):
+    """
+    GIVEN a mounted image and an unmounted one
+    WHEN IMAGE_DIR moves to a subdirectory that contains neither, the catalog is scanned, and the mounted image
+        is unmounted
+    THEN the unmounted image is dropped, the mounted one is not unmounted and stays tracked under its full path
+        until it is unmounted, and the images in the new IMAGE_DIR get new relative paths
+    """
+    app = create_app(image_dir=str(image_dir), database=str(tmp_path / "thumbtack.db"))
+    unmounted = []
+    monkeypatch.setattr(utils, "unmount_image", lambda rel_path, force=False: unmounted.append(rel_path))
+    with app.app_context():
+        set_mounted("removed.E01", "/mnt/thumbtack/removed-1-ext4")
+        mounted = utils.get_image_info("removed.E01")
+
+        app.config["IMAGE_DIR"] = str(image_dir / "case")
+        assert utils.save_scan_settings()
+        app.catalog.scan()
+
+        rel_paths = {image["rel_path"]: image["status"] for image in utils.get_images()}
+        assert rel_paths == {"nested.dd": "Unmounted", str(image_dir / "removed.E01"): "Mounted"}
+        assert unmounted == []
+
+        utils.mark_unmounted(mounted)
+        assert [image["rel_path"] for image in utils.get_images()] == ["nested.dd"]
+        assert utils.query_db("SELECT * FROM volumes WHERE disk_id = ?", [mounted["id"]]) == []
@@ -0,0 +1,81 @@
+import os
+
+import pytest
+
+from thumbtack.scanning import DirectoryIndexEntry, ScanStats, walk_image_dir
+
+
+@pytest.fixture()
+def image_tree(tmp_path):
+    for directory in ["case1", "case1/nested", "case2", "case2/skip_me", "skip_me", "empty"]:
+        (tmp_path / directory).mkdir()
+    for filename in ["top.E01", "case1/a.dd", "case1/nested/b.E01", "case2/c.vmdk", "case2/skip_me/d.dd", "skip_me/e.dd"]:
+        (tmp_path / filename).touch()
+    os.symlink(tmp_path / "case1", tmp_path / "link_to_case1")
+    os.symlink(tmp_path / "top.E01", tmp_path / "link_to_top.E01")
+    return tmp_path
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_walk_image_dir_matches_os_walk(image_tree, workers):
+    """
+    GIVEN a directory tree with nested directories and symlinks
+    WHEN it is walked with walk_image_dir
+    THEN the same directories and files are found as with os.walk and Path.is_file
+    """
+    expected = {}
+    for root, _, files in os.walk(image_tree):
+        expected[root] = sorted(f for f in files if os.path.isfile(os.path.join(root, f)))
+
+    stats = ScanStats(workers)
+    found = {}
+    for directory in walk_image_dir(str(image_tree), workers=workers, stats=stats):
+        found[directory.root] = sorted(directory.filenames)
+        assert sorted(directory.listing) == sorted(os.listdir(directory.root))
+    stats.finish()
+
+    assert found == expected
+    assert stats.directories == len(expected)
+    assert stats.files == sum(len(files) for files in expected.values())
+
+
+def test_walk_image_dir_skips_subdirectories(image_tree):
+    """
+    GIVEN a directory tree containing subdirectories named in SKIP_SUBDIRECTORY
+    WHEN it is walked with walk_image_dir
+    THEN those subdirectories are not descended into at any depth
+    """
+    roots = {directory.root for directory in walk_image_dir(str(image_tree), skip_subdirs=["skip_me"], workers=2)}
+
+    assert str(image_tree / "case2") in roots
+    assert not any(os.path.basename(root) == "skip_me" for root in roots)
+
+
+def test_walk_image_dir_skips_unchanged_directories(image_tree):
+    """
+    GIVEN a directory index recorded by a previous walk
+    WHEN the tree is walked again after one directory changed
+    THEN only the changed directory is listed, while unchanged subtrees are still descended into
+    """
+    index = {}
+    for directory in walk_image_dir(str(image_tree)):
+        index[directory.root] = DirectoryIndexEntry(directory.mtime_ns, len(directory.listing), [])
+    for path in index:
+        parent = os.path.dirname(path)
+        if parent in index and path != str(image_tree):
+            index[parent].subdirs.append(path)
+
+    (image_tree / "case1" / "nested" / "new.E01").touch()
+    os.utime(image_tree / "case1" / "nested", ns=(0, 0))
+
+    stats = ScanStats(2)
+    listed = {}
+    for directory in walk_image_dir(str(image_tree), workers=2, stats=stats, index=index, trust_index=True):
+        listed[directory.root] = directory
+
+    assert set(listed) == set(index)
+    assert not listed[str(image_tree / "case1" / "nested")].unchanged
+    assert "new.E01" in listed[str(image_tree / "case1" / "nested")].filenames
+    assert listed[str(image_tree / "case2")].unchanged
+    assert listed[str(image_tree / "case2")].filenames == []
+    assert stats.unchanged == len(index) - 1
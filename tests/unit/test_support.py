@@ -0,0 +1,97 @@
+import threading
+import time
+
+from types import SimpleNamespace
+
+from imagemounter_mitre import dependencies
+from werkzeug.http import http_date
+
+from thumbtack.support import SupportMatrix
+
+PROBE_SECONDS = 0.1
+
+
+class SlowDependency:
+    """A dependency that takes PROBE_SECONDS to check, counting how often it was checked."""
+
+    def __init__(self, name, installed):
+        self.name = name
+        self.installed = installed
+        self.probes = 0
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        return self.name
+
+    @property
+    def is_available(self):
+        with self._lock:
+            self.probes += 1
+        time.sleep(PROBE_SECONDS)
+        if self.installed is None:
+            raise RuntimeError("found another module with this name")
+        return self.installed
+
+
+def test_support_matrix_is_probed_in_parallel_and_cached(monkeypatch):
+    """
+    GIVEN four slow dependency checks, one of which fails
+    WHEN the support matrix is read several times from several threads, and then refreshed
+    THEN the dependencies are checked in parallel and only once until the refresh,
+        and a failing check reports the dependency as missing
+    """
+    deps = [SlowDependency("xmount", True), SlowDependency("qemu-nbd", False), SlowDependency("lvm", True)]
+    deps.append(SlowDependency("python-magic", None))
+    sections = [SimpleNamespace(deps=deps[:2]), SimpleNamespace(deps=deps[2:])]
+    monkeypatch.setattr(dependencies, "ALL_SECTIONS", sections)
+    support = SupportMatrix(ttl=3600, workers=4)
+
+    threads = [threading.Thread(target=support.get) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert support.get() == {"xmount": True, "qemu-nbd": False, "lvm": True, "python-magic": False}
+    assert [dep.probes for dep in deps] == [1, 1, 1, 1]
+    assert support.probe_seconds < 2 * PROBE_SECONDS
+    first_probe = support.last_probed
+
+    deps[1].installed = True
+    assert support.refresh()["qemu-nbd"]
+    assert support.last_probed > first_probe
+    assert [dep.probes for dep in deps] == [2, 2, 2, 2]
+
+
+def test_support_matrix_expires(monkeypatch):
+    """
+    GIVEN a support matrix with a TTL of zero
+    WHEN it is read twice
+    THEN the dependencies are checked both times
+    """
+    dep = SlowDependency("xmount", True)
+    monkeypatch.setattr(dependencies, "ALL_SECTIONS", [SimpleNamespace(deps=[dep])])
+    support = SupportMatrix(ttl=0, workers=1)
+
+    support.get()
+    support.get()
+    assert dep.probes == 2
+
+
+def test_supported_endpoints(test_client):
+    """
+    GIVEN a Thumbtack Flask application client
+    WHEN /supported is requested and then refreshed with a POST to /supported/refresh
+    THEN both return only {tool: installed} with when the tools were last probed in Last-Modified, and the refresh
+        probes them again
+    """
+    support = test_client.application.support_matrix
+    response = test_client.get("/supported")
+    last_probed = support.last_probed
+    assert all(isinstance(installed, bool) for installed in response.get_json().values())
+    assert response.headers["Last-Modified"] == http_date(last_probed)
+
+    refreshed = test_client.post("/supported/refresh")
+    assert support.last_probed > last_probed
+    assert refreshed.headers["Last-Modified"] == http_date(support.last_probed)
+    assert test_client.get("/supported").get_json() == refreshed.get_json()
@@ -0,0 +1,177 @@
+import os
+
+import pytest
+
+from thumbtack import create_app, directory_monitoring, utils
+from thumbtack.directory_monitoring import DirectoryMonitoring, ImageDirWatcher
+from thumbtack.inotify import IN_CREATE, IN_ISDIR, Inotify
+
+
+def inotify_available():
+    try:
+        Inotify().close()
+    except OSError:
+        return False
+    return True
+
+
+pytestmark = pytest.mark.skipif(not inotify_available(), reason="inotify is not available")
+
+
+def catalog():
+    return sorted(image["rel_path"] for image in utils.get_images(with_volumes=False))
+
+
+def apply_events(watcher, settle=0.2):
+    """Handle the events queued so far, until none arrive for settle seconds."""
+    while True:
+        events = watcher.inotify.read_events(timeout=settle)
+        if not events:
+            return
+        for event in events:
+            watcher.handle_event(event)
+
+
+@pytest.fixture()
+def watcher_app(tmp_path):
+    image_dir = tmp_path / "images"
+    (image_dir / "case").mkdir(parents=True)
+    (image_dir / "case" / "disk.E01").touch()
+    app = create_app(image_dir=str(image_dir), database=str(tmp_path / "thumbtack.db"))
+    with app.app_context():
+        watcher = ImageDirWatcher(app)
+        watcher.watch_tree(str(image_dir))
+        app.catalog.scan()
+        yield app, image_dir, watcher
+        watcher.close()
+
+
+def test_inotify_reports_created_entries(tmp_path):
+    """
+    GIVEN an inotify watch on a directory
+    WHEN a file and a directory are created in it
+    THEN both are read back as IN_CREATE events with their names, the directory flagged with IN_ISDIR
+    """
+    inotify = Inotify()
+    try:
+        wd = inotify.add_watch(str(tmp_path), IN_CREATE)
+        (tmp_path / "image.dd").touch()
+        (tmp_path / "case").mkdir()
+        events = inotify.read_events(timeout=1)
+        assert [(event.wd, event.name, bool(event.mask & IN_ISDIR)) for event in events] == [
+            (wd, "image.dd", False),
+            (wd, "case", True),
+        ]
+        assert inotify.read_events(timeout=0) == []
+        with pytest.raises(FileNotFoundError):
+            inotify.add_watch(str(tmp_path / "missing"), IN_CREATE)
+    finally:
+        inotify.close()
+
+
+def test_watcher_applies_file_events(watcher_app):
+    """
+    GIVEN a watched image directory
+    WHEN images are created, moved between directories, ignored and deleted
+    THEN the catalog follows each change without rescanning
+    """
+    app, image_dir, watcher = watcher_app
+    assert catalog() == ["case/disk.E01"]
+
+    (image_dir / "new.dd").touch()
+    (image_dir / ".hidden.dd").touch()
+    apply_events(watcher)
+    assert catalog() == ["case/disk.E01", "new.dd"]
+
+    os.rename(image_dir / "new.dd", image_dir / "case" / "moved.dd")
+    apply_events(watcher)
+    assert catalog() == ["case/disk.E01", "case/moved.dd"]
+
+    (image_dir / "case" / "disk.E01").unlink()
+    apply_events(watcher)
+    assert catalog() == ["case/moved.dd"]
+
+
+def test_watcher_applies_directory_events(watcher_app):
+    """
+    GIVEN a watched image directory
+    WHEN a directory of images is created, moved out of the image directory, and a new one is filled after creation
+    THEN the images below it are added and removed together, and files created in a new directory are seen
+    """
+    app, image_dir, watcher = watcher_app
+
+    outside = image_dir.parent / "outside"
+    (outside / "nested").mkdir(parents=True)
+    (outside / "nested" / "a.E01").touch()
+    os.rename(outside, image_dir / "moved_in")
+    apply_events(watcher)
+    assert catalog() == ["case/disk.E01", "moved_in/nested/a.E01"]
+
+    # Created after the directory is watched, so it is only seen through the new watch
+    (image_dir / "moved_in" / "nested" / "b.dd").touch()
+    apply_events(watcher)
+    assert catalog() == ["case/disk.E01", "moved_in/nested/a.E01", "moved_in/nested/b.dd"]
+
+    os.rename(image_dir / "moved_in", image_dir.parent / "gone")
+    apply_events(watcher)
+    assert catalog() == ["case/disk.E01"]
+    assert all(not path.startswith(str(image_dir / "moved_in")) for path in watcher.watches.values())
+
+
+def test_monitoring_falls_back_to_polling(watcher_app, monkeypatch):
+    """
+    GIVEN MONITOR_MODE inotify
+    WHEN the image directory is on a network filesystem, inotify cannot be set up, or the watcher fails
+    THEN the image directory is polled instead
+    """
+    app, _, _ = watcher_app
+    app.config.update(MONITOR_MODE="inotify", REMOVE_DIRECTORIES=False)
+    monitoring = DirectoryMonitoring(app)
+    polled = []
+    monkeypatch.setattr(monitoring, "poll", lambda: polled.append(True))
+
+    monkeypatch.setattr(directory_monitoring, "is_network_filesystem", lambda path: True)
+    assert monitoring.create_watcher() is None
+    monkeypatch.setattr(directory_monitoring, "is_network_filesystem", lambda path: False)
+
+    def no_inotify(app):
+        raise OSError("inotify is not available")
+
+    monkeypatch.setattr(directory_monitoring, "ImageDirWatcher", no_inotify)
+    assert monitoring.create_watcher() is None
+    monitoring.run()
+
+    class FailingWatcher:
+        closed = False
+
+        def run(self):
+            raise OSError("too many watches")
+
+        def close(self):
+            FailingWatcher.closed = True
+
+    monkeypatch.setattr(monitoring, "create_watcher", FailingWatcher)
+    monitoring.run()
+    assert FailingWatcher.closed
+    assert polled == [True, True]
+
+
+def test_watcher_refreshes_img_next_to_ewf_companions(watcher_app):
+    """
+    GIVEN a watched image directory with a .img file
+    WHEN the .E01 and .IMF files of the same multipart EWF image are created next to it, and one is deleted again
+    THEN the .img file is dropped from the catalog while both companions exist, and listed again after
+    """
+    app, image_dir, watcher = watcher_app
+    (image_dir / "case" / "part.img").touch()
+    apply_events(watcher)
+    assert catalog() == ["case/disk.E01", "case/part.img"]
+
+    (image_dir / "case" / "part.E01").touch()
+    (image_dir / "case" / "part.IMF").touch()
+    apply_events(watcher)
+    assert catalog() == ["case/disk.E01", "case/part.E01"]
+
+    (image_dir / "case" / "part.IMF").unlink()
+    apply_events(watcher)
+    assert catalog() == ["case/disk.E01", "case/part.E01", "case/part.img"]